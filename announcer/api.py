@@ -54,17 +54,28 @@ with all default configuration and permissions checked against anonymous.
 I hope this helps, because it took me a while to wrap my head around :P
 """
 
+import Queue
+import base64
+import pickle
 import pkg_resources
+import sys
+import threading
 import time
 
 from operator import itemgetter
 
-from trac.config import ExtensionOption
+from trac.config import BoolOption, ExtensionOption, IntOption
 from trac.core import *
 from trac.db import Table, Column, Index
 from trac.db import DatabaseManager
 from trac.env import IEnvironmentSetupParticipant
+from trac.util import hex_entropy
 from trac.util.compat import set
+from trac.util.text import exception_to_unicode
+from trac.web.api import IRequestFilter
+
+from announcer.metrics import Metrics, metric_name
+from announcer.model import begin_prefetch, end_prefetch
 
 
 class IAnnouncementProducer(Interface):
@@ -133,6 +144,20 @@ class IAnnouncementDefaultSubscriber(Interface):
         """
 
 
+class IAnnouncementPrefetchingSubscriber(Interface):
+    """Optional companion of IAnnouncementSubscriber that tells the
+    SubscriptionResolver which subscription data `matches` is going to look
+    up, so the data for all subscribers can be loaded in one go.
+    """
+
+    def subscription_keys(event):
+        """Yields the keys of the subscriptions and subscription attributes
+        `matches` will look up for the given event, as described in
+        `announcer.model.begin_prefetch`.  Lookups not covered by the keys
+        still work, they are just served by the database.
+        """
+
+
 class IAnnouncementSubscriptionFilter(Interface):
     """IAnnouncementSubscriptionFilter provides an interface where a component
     can filter subscribers from the final distribution list.
@@ -292,6 +317,19 @@ class IAnnouncementAddressResolver(Interface):
         returned. The next resolver will be attempted in the chain.
         """
 
+    def get_addresses_for_names(names, attributes):
+        """Optional batch variant of `get_address_for_name`.
+
+        Accepts a list of (name, authenticated) tuples and an
+        `announcer.util.settings.SessionAttributes` instance holding the
+        session attributes of these users, and returns a dictionary mapping
+        the tuples to the addresses that were found.  Names without an
+        address are left out and attempted with the next resolver.
+
+        Distributors call `get_address_for_name` for each name on
+        resolvers that don't implement this method.
+        """
+
 
 class AnnouncementEvent(object):
     """AnnouncementEvent
@@ -316,6 +354,129 @@ class AnnouncementEvent(object):
     def get_session_terms(self, session_id):
         return tuple()
 
+    def get_state(self):
+        """Returns a picklable dict that describes the event.
+
+        This is used to hand events over to the background dispatch workers.
+        Subclasses whose target (or any other attribute) holds a reference
+        to the environment must override this method and `set_state`.
+        """
+        state = {}
+        for k, v in self.__dict__.items():
+            if not k.startswith('_'):
+                state[k] = v
+        return state
+
+    def set_state(self, env, state):
+        """Restores the event from a dict returned by `get_state`."""
+        self.__dict__.update(state)
+
+    def get_coalesce_key(self):
+        """Returns a key for the resource the event is about.  Events with
+        the same key, sent shortly after each other, are passed to
+        `coalesce`.  None if the event can't be merged with others.
+        """
+        return None
+
+    def coalesce(self, later):
+        """Returns a single event announcing both this event and the `later`
+        one, or None if they can't be merged.
+        """
+        return None
+
+
+class AnnouncementDigestEvent(AnnouncementEvent):
+    """Several events announced with a single message."""
+
+    def __init__(self, events, category='batch', author=''):
+        AnnouncementEvent.__init__(self, 'digest', category, None, author)
+        self.events = list(events)
+
+    def get_state(self):
+        state = AnnouncementEvent.get_state(self)
+        state['events'] = serialize_events(self.events)
+        return state
+
+    def set_state(self, env, state):
+        state['events'] = deserialize_events(env, state['events'])
+        AnnouncementEvent.set_state(self, env, state)
+
+
+def serialize_events(events):
+    """Converts a sequence of AnnouncementEvents into a string suitable
+    for storing in the database.
+
+    Raises an exception if any of the events can not be pickled.
+    """
+    data = [(e.__class__.__module__, e.__class__.__name__, e.get_state())
+            for e in events]
+    return base64.b64encode(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+def deserialize_events(env, data):
+    """Rebuilds the events stored by `serialize_events`.
+
+    Events that can't be restored, like the events of a ticket that has been
+    deleted in the meantime, are logged and left out.
+    """
+    events = []
+    for module, name, state in pickle.loads(base64.b64decode(data)):
+        try:
+            __import__(module)
+            cls = getattr(sys.modules[module], name)
+            evt = cls.__new__(cls)
+            evt.set_state(env, state)
+        except Exception, e:
+            env.log.error("AnnouncementSystem dropped a %s that could not "
+                    "be restored: %s" % (name, exception_to_unicode(e)))
+            continue
+        events.append(evt)
+    return events
+
+def format_event(formatter, transport, style, event):
+    """Formats the event with an IAnnouncementFormatter, only once per
+    event for each formatter, transport and style.
+
+    All distributors and recipient groups of an event share the output.
+    """
+    formatted = getattr(event, '_formatted', None)
+    if formatted is None:
+        formatted = event._formatted = {}
+    key = (formatter.__class__, transport, event.realm, style)
+    if key not in formatted:
+        start = time.time()
+        formatted[key] = formatter.format(transport, event.realm, style,
+                                          event)
+        Metrics(formatter.env).timing(metric_name('format',
+                formatter.__class__.__name__, style), time.time() - start)
+    return formatted[key]
+
+def coalesce_events(events):
+    """Merges the events of a list that are about the same resource, see
+    `AnnouncementEvent.coalesce`.
+    """
+    result = []
+    positions = {}
+    for evt in events:
+        key = evt.get_coalesce_key()
+        if key is not None and key in positions:
+            merged = result[positions[key]].coalesce(evt)
+            if merged is not None:
+                result[positions[key]] = merged
+                continue
+        if key is not None:
+            positions[key] = len(result)
+        result.append(evt)
+    return result
+
+def event_cache(event, name):
+    """Returns a dictionary for memoizing lookups made while announcing
+    the event.  The events of a batch share these dictionaries.
+    """
+    caches = getattr(event, '_caches', None)
+    if caches is None:
+        caches = event._caches = {}
+    return caches.setdefault(name, {})
+
 
 class IAnnouncementSubscriptionResolver(Interface):
     """Supports new and old style of subscription resolution until new code
@@ -333,15 +494,28 @@ class SubscriptionResolver(Component):
     implements(IAnnouncementSubscriptionResolver)
 
     subscribers = ExtensionPoint(IAnnouncementSubscriber)
+    prefetchers = ExtensionPoint(IAnnouncementPrefetchingSubscriber)
 
     def subscriptions(self, event):
         """Yields all subscriptions for a given event."""
 
+        # load the subscriptions all subscribers ask for at once, instead of
+        # letting each of them query the database separately
+        keys = self.subscription_keys(event)
+
         subscriptions = []
-        for sp in self.subscribers:
-            subscriptions.extend(
-                [x for x in sp.matches(event) if x and len(x) > 6]
-            )
+        metrics = Metrics(self.env)
+        begin_prefetch(self.env, keys)
+        try:
+            for sp in self.subscribers:
+                start = time.time()
+                subscriptions.extend(
+                    [x for x in sp.matches(event) if x and len(x) > 6]
+                )
+                metrics.timing(metric_name('resolve', 'matches',
+                        sp.__class__.__name__), time.time() - start)
+        finally:
+            end_prefetch(self.env)
 
         """
         This logic is meant to generate a list of subscriptions for each
@@ -380,6 +554,19 @@ class SubscriptionResolver(Component):
 
         return resolved_subs
 
+    def subscription_keys(self, event):
+        """Returns the keys of the subscription data the subscribers will
+        look up for the event, see `announcer.model.begin_prefetch`.
+        """
+        keys = set()
+        for sp in self.prefetchers:
+            try:
+                keys.update(sp.subscription_keys(event))
+            except Exception, e:
+                self.log.warning("Unable to get subscription keys from %s: "
+                        "%s" % (sp.__class__.__name__, exception_to_unicode(e)))
+        return keys
+
 
 _TRUE_VALUES = ('yes', 'true', 'enabled', 'on', 'aye', '1', 1, True)
 
@@ -429,7 +616,7 @@ class AnnouncementSystem(Component):
     subscribers can use to pick through events, all power to you.
     """
 
-    implements(IEnvironmentSetupParticipant)
+    implements(IEnvironmentSetupParticipant, IRequestFilter)
 
     subscribers = ExtensionPoint(IAnnouncementSubscriber)
     subscription_filters = ExtensionPoint(IAnnouncementSubscriptionFilter)
@@ -442,7 +629,63 @@ class AnnouncementSystem(Component):
         order they will be called.
         """)
 
+    use_async_dispatch = BoolOption('announcer', 'use_async_dispatch',
+        'false',
+        """Resolve and distribute announcements in background threads.
+
+        When enabled, sending an announcement only stores the event in the
+        `announcement_queue` table.  Subscription resolution, filtering,
+        formatting and distribution are done by a pool of worker threads,
+        so the request that triggered the event doesn't have to wait for
+        them.  Queued events survive a restart of the server process and
+        are picked up again by the first request of the next process.
+        """)
+
+    dispatch_workers = IntOption('announcer', 'dispatch_workers', 2,
+        """Number of worker threads used for asynchronous dispatch.
+        (requires use_async_dispatch)""")
+
+    consolidate_batches = BoolOption('announcer', 'consolidate_batches',
+        'false',
+        """Send every recipient of a batch of announcements, like a bulk
+        ticket update, a single digest message instead of one message per
+        announcement.""")
+
+    coalesce_window = IntOption('announcer', 'coalesce_window', 0,
+        """Seconds to hold back announcements, so that further changes to
+        the same resource by the same author, like a ticket saved several
+        times in a row, are merged into a single announcement.  0 sends
+        announcements right away.
+
+        Held announcements are lost if the server process ends before
+        their window is over.""")
+
+    subscription_cache = BoolOption('announcer', 'subscription_cache', 'false',
+        """Keep subscriptions and subscription attributes in memory.
 
+        Each server process keeps all rows of the subscriber classes it has
+        used, so enable this only if the subscription tables comfortably
+        fit into the memory of every process.  In return, announcements
+        don't query the subscription tables.
+
+        Changes are detected with a generation token per subscriber class in
+        the `system` table, so all server processes see changes made by any
+        of them, and a change only reloads the class it affects.""")
+
+    # Seconds between checks for pending digests that are due.
+    digest_poll_interval = 300
+
+    # Paths of the requests changing many tickets at once, like the batch
+    # modification of the BatchModifyPlugin.  Their events are sent as a
+    # batch when the request is done.
+    batch_request_paths = ('/batchmodify',)
+
+    # Seconds between scans of the queue table for events that were queued
+    # by other processes, or left behind by a process that died.
+    dispatch_poll_interval = 30
+    # Seconds after which an event claimed by a worker that didn't finish
+    # it is handed out again.
+    dispatch_claim_timeout = 600
 
     # IEnvironmentSetupParticipant implementation
     """Subscriptions table will is deprecated in favor of the new
@@ -463,7 +706,9 @@ class AnnouncementSystem(Component):
             Column('distributor'),
             Column('format'),
             Column('priority', type='int'),
-            Column('adverb')
+            Column('adverb'),
+            Index(['class', 'sid', 'authenticated']),
+            Index(['sid', 'authenticated', 'distributor'])
         ],
         Table('subscription_attribute', key='id')[
             Column('id', auto_increment=True),
@@ -471,14 +716,69 @@ class AnnouncementSystem(Component):
             Column('authenticated', type='int'),
             Column('class'),
             Column('realm'),
-            Column('target')
+            Column('target'),
+            Index(['class', 'realm', 'target']),
+            Index(['sid', 'authenticated', 'class'])
+        ],
+        Table('announcement_queue', key='id')[
+            Column('id', auto_increment=True),
+            Column('time', type='int64'),
+            Column('owner'),
+            Column('claimed', type='int64'),
+            Column('data')
+        ],
+        Table('announcement_outbox', key='id')[
+            Column('id', auto_increment=True),
+            Column('time', type='int64'),
+            Column('next_attempt', type='int64'),
+            Column('attempts', type='int'),
+            Column('state'),
+            Column('owner'),
+            Column('from_addr'),
+            Column('recipients'),
+            Column('message'),
+            Index(['next_attempt'])
+        ],
+        Table('announcement_deadletter', key='id')[
+            Column('id', auto_increment=True),
+            Column('time', type='int64'),
+            Column('attempts', type='int'),
+            Column('error'),
+            Column('from_addr'),
+            Column('recipients'),
+            Column('message')
+        ],
+        Table('announcement_digest', key='id')[
+            Column('id', auto_increment=True),
+            Column('time', type='int64'),
+            Column('sid'),
+            Column('authenticated', type='int'),
+            Column('distributor'),
+            Column('address'),
+            Column('owner'),
+            Column('claimed', type='int64'),
+            Column('data'),
+            Index(['sid', 'authenticated', 'distributor'])
         ]
     ]
 
+    # Version of the schema, stored in the system table.  Version 1 added
+    # the indexes of the subscription tables.
+    SCHEMA_VERSION = 1
+
     def __init__(self):
         # bind the 'announcer' catalog to the locale directory
         locale_dir = pkg_resources.resource_filename(__name__, 'locale')
         add_domain(self.env.path, locale_dir)
+        self._dispatch_queue = None
+        self._dispatch_lock = threading.Lock()
+        self._dispatch_owner = hex_entropy(16)
+        self._batches = threading.local()
+        self._digest_thread = None
+        self._held = {}
+        self._held_cond = threading.Condition()
+        self._held_thread = None
+        self._startup_checked = False
 
     def environment_created(self):
         self._upgrade_db(self.env.get_db_cnx())
@@ -492,14 +792,25 @@ class AnnouncementSystem(Component):
             except:
                 db.rollback()
                 return True
-        return False
+        return self._get_schema_version(db) < self.SCHEMA_VERSION
 
     def upgrade_environment(self, db):
         self._upgrade_db(db)
 
+    def _get_schema_version(self, db):
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT value
+              FROM system
+             WHERE name='announcer_version'
+        """)
+        row = cursor.fetchone()
+        return row and int(row[0]) or 0
+
     def _upgrade_db(self, db):
         try:
             db_backend, _ = DatabaseManager(self.env)._get_connector()
+            version = self._get_schema_version(db)
             for table in self.SCHEMA:
                 try:
                     cursor = db.cursor()
@@ -512,19 +823,289 @@ class AnnouncementSystem(Component):
                         self.log.debug(stmt)
                         cursor.execute(stmt)
                         db.commit()
+                else:
+                    if version < 1 and table.name in ('subscription',
+                            'subscription_attribute'):
+                        # add the indexes to tables created before they
+                        # were part of the schema
+                        cursor = db.cursor()
+                        for stmt in db_backend.to_sql(table):
+                            if 'INDEX' in stmt.upper().split()[1:3]:
+                                self.log.debug(stmt)
+                                cursor.execute(stmt)
+                        db.commit()
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE system
+                   SET value=%s
+                 WHERE name='announcer_version'
+            """, (str(self.SCHEMA_VERSION),))
+            if cursor.rowcount < 1:
+                cursor.execute("""
+                    INSERT INTO system (name, value)
+                         VALUES ('announcer_version', %s)
+                """, (str(self.SCHEMA_VERSION),))
+            db.commit()
         except Exception, e:
             db.rollback()
             self.log.error(e, exc_info=True)
             raise TracError(str(e))
+
+    # IRequestFilter implementation
+
+    def pre_process_request(self, req, handler):
+        # queued events and digests left pending by a previous process are
+        # picked up by the first request of the next one
+        if not self._startup_checked:
+            self._startup_checked = True
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            cursor.execute("SELECT id FROM announcement_queue LIMIT 1")
+            if cursor.fetchall():
+                self._get_dispatch_queue()
+            cursor.execute("SELECT id FROM announcement_digest LIMIT 1")
+            if cursor.fetchall():
+                self._start_digest_thread()
+        if handler is not None and req.method == 'POST' and \
+                req.path_info in self.batch_request_paths:
+            # post_process_request is skipped when the handler redirects
+            return _BatchRequestHandler(handler, self)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
     # The actual AnnouncementSystem now..
 
     def send(self, evt):
+        batches = getattr(self._batches, 'stack', None)
+        if batches:
+            batches[-1].events.append(evt)
+            return
+        if self.coalesce_window > 0 and evt.get_coalesce_key() is not None:
+            self._hold(evt)
+            return
+        self._send_now(evt)
+
+    def _send_now(self, evt):
         start = time.time()
+        if self.use_async_dispatch and self._enqueue((evt,)):
+            stop = time.time()
+            self.log.debug("AnnouncementSystem queued event in %s seconds."\
+                    %(round(stop-start,2)))
+            return
         self._real_send(evt)
         stop = time.time()
+        Metrics(self.env).timing('send', stop - start)
         self.log.debug("AnnouncementSystem sent event in %s seconds."\
                 %(round(stop-start,2)))
 
+    def send_batch(self, events):
+        """Sends several events at once.
+
+        Subscriptions, permissions and addresses are looked up once for all
+        events.  With `consolidate_batches` enabled, every recipient gets one
+        message covering all events of the batch they are subscribed to.
+        """
+        events = list(events)
+        if self.coalesce_window > 0:
+            events = coalesce_events(events)
+        if not events:
+            return
+        start = time.time()
+        if self.use_async_dispatch and self._enqueue(events):
+            stop = time.time()
+            self.log.debug("AnnouncementSystem queued %d events in %s "
+                    "seconds." % (len(events), round(stop-start,2)))
+            return
+        self._real_send_batch(events)
+        stop = time.time()
+        Metrics(self.env).timing('send_batch', stop - start)
+        self.log.debug("AnnouncementSystem sent %d events in %s seconds."\
+                %(len(events), round(stop-start,2)))
+
+    def begin_batch(self):
+        """Collects the events sent by the current thread until the
+        matching `end_batch` call, which sends them with `send_batch`.
+
+        Producers that generate many events in one go, like bulk ticket
+        updates, should wrap their work in a batch:
+
+        {{{
+        announcer = AnnouncementSystem(env)
+        announcer.begin_batch()
+        try:
+            ...
+        finally:
+            announcer.end_batch()
+        }}}
+        """
+        batches = getattr(self._batches, 'stack', None)
+        if batches is None:
+            batches = self._batches.stack = []
+        batch = AnnouncementBatch(self)
+        batches.append(batch)
+        return batch
+
+    def end_batch(self):
+        """Sends the events collected since the matching `begin_batch`.
+        Nested batches are sent with the outermost one.
+        """
+        batches = getattr(self._batches, 'stack', None)
+        if not batches:
+            return
+        batch = batches.pop()
+        if batches:
+            batches[-1].events.extend(batch.events)
+        else:
+            self.send_batch(batch.events)
+
+    def _hold(self, evt):
+        """Holds the event for `coalesce_window` seconds, merging it with
+        an event about the same resource that is already held.
+        """
+        key = evt.get_coalesce_key()
+        ready = None
+        self._held_cond.acquire()
+        try:
+            held = self._held.get(key)
+            if held:
+                merged = held[1].coalesce(evt)
+                if merged is not None:
+                    self._held[key] = (held[0], merged)
+                    return
+                # can't be merged, announce the held one first
+                ready = held[1]
+            self._held[key] = (time.time() + self.coalesce_window, evt)
+            if not self._held_thread:
+                self._held_thread = CoalesceThread(self)
+                self._held_thread.start()
+            self._held_cond.notify()
+        finally:
+            self._held_cond.release()
+        if ready is not None:
+            self._send_now(ready)
+
+    def _release_held(self):
+        """Sends the held events whose window is over, or waits until the
+        next one is due.
+        """
+        self._held_cond.acquire()
+        try:
+            now = time.time()
+            due = []
+            for key, (deadline, evt) in self._held.items():
+                if deadline <= now:
+                    due.append((deadline, evt))
+                    del self._held[key]
+            if not due:
+                timeout = None
+                if self._held:
+                    timeout = min([d for d, e in self._held.values()]) - now
+                self._held_cond.wait(timeout)
+                return
+        finally:
+            self._held_cond.release()
+        for deadline, evt in sorted(due, key=itemgetter(0)):
+            self._send_now(evt)
+
+    def _enqueue(self, events):
+        """Stores the events in the announcement queue and wakes up the
+        dispatch workers.  Returns False if the events can't be queued, in
+        which case the caller should send them right away.
+        """
+        try:
+            data = serialize_events(events)
+        except Exception, e:
+            self.log.debug("AnnouncementSystem can't queue %s, sending it "
+                    "synchronously: %s" % (events[0].__class__.__name__, e))
+            return False
+        queue_id = []
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO announcement_queue (time, data)
+                     VALUES (%s, %s)
+            """, (int(time.time()), data))
+            queue_id.append(db.get_last_id(cursor, 'announcement_queue'))
+        self._get_dispatch_queue().put(queue_id[0])
+        return True
+
+    def _get_dispatch_queue(self):
+        self._dispatch_lock.acquire()
+        try:
+            if not self._dispatch_queue:
+                self._dispatch_queue = Queue.Queue()
+                # pick up events left behind by previous processes
+                self._dispatch_queue.put(None)
+                for i in range(max(1, self.dispatch_workers)):
+                    # only one of the workers scans the table
+                    thread = DispatchThread(self, self._dispatch_queue,
+                                            recover=(i == 0))
+                    thread.start()
+        finally:
+            self._dispatch_lock.release()
+        return self._dispatch_queue
+
+    def _dispatch_queued(self):
+        """Sends the queued events in the order they were queued, until
+        the queue is empty."""
+        while self._dispatch_next():
+            pass
+
+    def _dispatch_next(self):
+        """Claims the oldest queue entry that is unclaimed or whose claim
+        has timed out, sends its events and removes it.  Returns False if
+        there was no such entry."""
+        now = int(time.time())
+        stale = now - self.dispatch_claim_timeout
+        found = []
+        row = []
+        @self.env.with_transaction()
+        def do_claim(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                SELECT id, data
+                  FROM announcement_queue
+                 WHERE owner IS NULL
+                    OR claimed < %s
+              ORDER BY id
+                 LIMIT 1
+            """, (stale,))
+            for queue_id, data in cursor.fetchall():
+                found.append(queue_id)
+                cursor.execute("""
+                    UPDATE announcement_queue
+                       SET owner=%s, claimed=%s
+                     WHERE id=%s
+                       AND (owner IS NULL OR claimed < %s)
+                """, (self._dispatch_owner, now, queue_id, stale))
+                if cursor.rowcount == 1:
+                    row.append((queue_id, data))
+        if not row:
+            # empty, or claimed by another worker in the meantime
+            return bool(found)
+        queue_id = row[0][0]
+        try:
+            try:
+                events = deserialize_events(self.env, row[0][1])
+            except Exception, e:
+                self.log.error("AnnouncementSystem dropped queued event %s "
+                        "that could not be restored: %s" % (queue_id, e))
+            else:
+                if events:
+                    self._real_send_batch(events)
+        finally:
+            @self.env.with_transaction()
+            def do_delete(db):
+                cursor = db.cursor()
+                cursor.execute("""
+                    DELETE FROM announcement_queue
+                          WHERE id=%s
+                """, (queue_id,))
+        return True
+
     def _real_send(self, evt):
         """Accepts a single AnnouncementEvent instance (or subclass), and
         returns nothing.
@@ -534,31 +1115,388 @@ class AnnouncementSystem(Component):
         the debug logs.
         """
         try:
-            subscriptions = self.resolver.subscriptions(evt)
-            for sf in self.subscription_filters:
-                subscriptions = set(
-                    sf.filter_subscriptions(evt, subscriptions)
-            )
+            self._distribute(evt, self._get_subscriptions(evt))
+        except:
+            self.log.error("AnnouncementSystem failed.", exc_info=True)
+
+    def _real_send_batch(self, events):
+        """Sends a list of events, sharing subscription, permission and
+        address lookups between them.
+        """
+        if len(events) == 1:
+            self._real_send(events[0])
+            return
+        try:
+            caches = {}
+            keys = set()
+            for evt in events:
+                evt._caches = caches
+                if hasattr(self.resolver, 'subscription_keys'):
+                    keys.update(self.resolver.subscription_keys(evt))
+            begin_prefetch(self.env, keys)
+            try:
+                if self.consolidate_batches:
+                    self._send_consolidated(events)
+                else:
+                    for evt in events:
+                        self._real_send(evt)
+            finally:
+                end_prefetch(self.env)
+        except:
+            self.log.error("AnnouncementSystem failed.", exc_info=True)
+
+    def _send_consolidated(self, events):
+        """Sends each recipient a single digest of the events they are
+        subscribed to."""
+        recipients = {}
+        for evt in events:
+            for subscription in self._get_subscriptions(evt):
+                recipients.setdefault(subscription, []).append(evt)
+        # recipients of the same events share the digest
+        digests = {}
+        for subscription, evts in recipients.items():
+            key = tuple([id(evt) for evt in evts])
+            digests.setdefault(key, (evts, []))[1].append(subscription)
+        # announce in the order of the events
+        position = dict([(id(evt), i) for i, evt in enumerate(events)])
+        for evts, subscriptions in sorted(digests.values(),
+                key=lambda d: [position[id(evt)] for evt in d[0]]):
+            if len(evts) == 1:
+                self._distribute(evts[0], subscriptions)
+            else:
+                digest = AnnouncementDigestEvent(evts)
+                digest._caches = evts[0]._caches
+                self._distribute(digest, subscriptions)
 
-            self.log.debug(
-                "AnnouncementSystem has found the following subscriptions: " \
-                        "%s"%(', '.join(['[%s(%s) via %s]' % ((s[1] or s[3]),\
-                        s[2] and 'authenticated' or 'not authenticated',s[0])\
-                        for s in subscriptions]
-                    )
+    def _get_subscriptions(self, evt):
+        metrics = Metrics(self.env)
+        start = time.time()
+        subscriptions = self.resolver.subscriptions(evt)
+        metrics.timing('resolve', time.time() - start)
+        for sf in self.subscription_filters:
+            start = time.time()
+            subscriptions = set(
+                sf.filter_subscriptions(evt, subscriptions)
+            )
+            metrics.timing(metric_name('filter', sf.__class__.__name__),
+                           time.time() - start)
+
+        self.log.debug(
+            "AnnouncementSystem has found the following subscriptions: " \
+                    "%s"%(', '.join(['[%s(%s) via %s]' % ((s[1] or s[3]),\
+                    s[2] and 'authenticated' or 'not authenticated',s[0])\
+                    for s in subscriptions]
                 )
             )
-            packages = {}
-            for transport, sid, authenticated, address, subs_format \
-                    in subscriptions:
-                if transport not in packages:
-                    packages[transport] = set()
-                packages[transport].add((sid,authenticated,address))
+        )
+        return subscriptions
+
+    def _distribute(self, evt, subscriptions):
+        packages = {}
+        for transport, sid, authenticated, address, subs_format \
+                in subscriptions:
+            if transport not in packages:
+                packages[transport] = set()
+            packages[transport].add((sid,authenticated,address))
+        self._defer_digests(evt, packages)
+        metrics = Metrics(self.env)
+        for distributor in self.distributors:
+            for transport in distributor.transports():
+                if packages.get(transport):
+                    start = time.time()
+                    distributor.distribute(transport, packages[transport],
+                            evt)
+                    metrics.timing(metric_name('distribute', transport),
+                                   time.time() - start)
+                    metrics.increment(metric_name('recipients', transport),
+                                      len(packages[transport]))
+
+    def _defer_digests(self, evt, packages):
+        """Removes the recipients that want a digest instead of single
+        announcements from `packages` and adds the event to their pending
+        digests.
+        """
+        users = self._get_digest_users(evt)
+        if not users:
+            return
+        pending = []
+        for transport, recipients in packages.items():
+            for recipient in list(recipients):
+                sid, authenticated, address = recipient
+                if (sid, authenticated and 1 or 0, transport) in users:
+                    recipients.remove(recipient)
+                    pending.append((sid, authenticated and 1 or 0,
+                                    transport, address))
+        if not pending:
+            return
+        try:
+            data = serialize_events([evt])
+        except Exception, e:
+            self.log.warning("AnnouncementSystem can't add %s to digests, "
+                    "sending it right away: %s" % (evt.__class__.__name__,
+                    exception_to_unicode(e)))
+            for sid, authenticated, transport, address in pending:
+                packages[transport].add((sid, authenticated, address))
+            return
+        now = int(time.time())
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.executemany("""
+                INSERT INTO announcement_digest
+                            (time, sid, authenticated, distributor, address,
+                             data)
+                     VALUES (%s, %s, %s, %s, %s, %s)
+            """, [(now,) + p + (data,) for p in pending])
+        self.log.debug("AnnouncementSystem added %s to the digests of: %s"
+                % (evt.__class__.__name__,
+                   ', '.join([p[0] for p in pending])))
+        self._start_digest_thread()
+
+    # Preference values of `announcer_digest_<transport>` for which
+    # announcements are collected and sent periodically.
+    digest_schedules = ('hourly', 'daily')
+
+    def _get_digest_users(self, evt):
+        """Returns the `(sid, authenticated, transport)` tuples of the users
+        who want a digest.  They are looked up once for all the events of a
+        batch.
+        """
+        cache = event_cache(evt, 'session_attributes')
+        users = cache.get('digest')
+        if users is None:
+            users = cache['digest'] = set()
+            names = {}
             for distributor in self.distributors:
                 for transport in distributor.transports():
-                    if transport in packages:
-                        distributor.distribute(transport, packages[transport],
-                                evt)
-        except:
-            self.log.error("AnnouncementSystem failed.", exc_info=True)
+                    names['announcer_digest_%s' % transport] = transport
+            if not names:
+                return users
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            cursor.execute("""
+                SELECT sid, authenticated, name
+                  FROM session_attribute
+                 WHERE name IN (%s)
+                   AND value IN (%s)
+            """ % (','.join(['%s'] * len(names)),
+                   ','.join(['%s'] * len(self.digest_schedules))),
+                list(names) + list(self.digest_schedules))
+            for sid, authenticated, name in cursor:
+                users.add((sid, authenticated and 1 or 0, names[name]))
+        return users
+
+    def _digest_period_start(self, schedule, now):
+        """Returns the start of the current period of `schedule`.  Digests
+        with events from before it are due.
+        """
+        if schedule == 'hourly':
+            return now - now % 3600
+        if schedule == 'daily':
+            t = time.localtime(now)
+            return int(time.mktime(t[:3] + (0, 0, 0) + t[6:8] + (-1,)))
+        # not collecting digests anymore
+        return now + 1
+
+    def _start_digest_thread(self):
+        self._dispatch_lock.acquire()
+        try:
+            if not self._digest_thread:
+                self._digest_thread = DigestThread(self)
+                self._digest_thread.start()
+        finally:
+            self._dispatch_lock.release()
+
+    def _flush_digests(self, now=None):
+        """Sends the pending digests that are due.  Returns the number of
+        digests sent.
+        """
+        # imported here, announcer.util.settings depends on this module
+        from announcer.util.settings import SessionAttributes
+        if now is None:
+            now = int(time.time())
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT sid, authenticated, distributor, MIN(time)
+              FROM announcement_digest
+             WHERE owner IS NULL
+                OR claimed < %s
+          GROUP BY sid, authenticated, distributor
+        """, (now - self.dispatch_claim_timeout,))
+        groups = cursor.fetchall()
+        attributes = SessionAttributes(self.env,
+                [sid for sid, authenticated, distributor, first in groups],
+                ['announcer_digest_%s' % distributor
+                 for sid, authenticated, distributor, first in groups], db)
+        sent = 0
+        for sid, authenticated, transport, first in groups:
+            schedule = attributes.get(sid, authenticated,
+                                      'announcer_digest_%s' % transport)
+            if first >= self._digest_period_start(schedule, now):
+                continue
+            try:
+                if self._send_digest(sid, authenticated, transport, now):
+                    sent += 1
+            except:
+                self.log.error("AnnouncementSystem failed to send the "
+                        "%s digest of %s." % (transport, sid), exc_info=True)
+        return sent
+
+    def _send_digest(self, sid, authenticated, transport, now):
+        """Claims the pending events of a digest and sends them as a single
+        announcement.
+        """
+        rows = []
+        @self.env.with_transaction()
+        def do_claim(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE announcement_digest
+                   SET owner=%s, claimed=%s
+                 WHERE sid=%s
+                   AND authenticated=%s
+                   AND distributor=%s
+                   AND (owner IS NULL OR claimed < %s)
+            """, (self._dispatch_owner, now, sid, authenticated, transport,
+                   now - self.dispatch_claim_timeout))
+            cursor.execute("""
+                SELECT id, address, data
+                  FROM announcement_digest
+                 WHERE owner=%s
+                   AND sid=%s
+                   AND authenticated=%s
+                   AND distributor=%s
+              ORDER BY id
+            """, (self._dispatch_owner, sid, authenticated, transport))
+            rows.extend(cursor.fetchall())
+        if not rows:
+            # claimed by another process in the meantime
+            return False
+        try:
+            events = []
+            for digest_id, address, data in rows:
+                try:
+                    for evt in deserialize_events(self.env, data):
+                        if isinstance(evt, AnnouncementDigestEvent):
+                            events.extend(evt.events)
+                        else:
+                            events.append(evt)
+                except Exception, e:
+                    self.log.error("AnnouncementSystem dropped digest entry "
+                            "%s that could not be restored: %s"
+                            % (digest_id, exception_to_unicode(e)))
+            if not events:
+                return False
+            if len(events) == 1:
+                evt = events[0]
+            else:
+                evt = AnnouncementDigestEvent(events, category='digest')
+            recipients = set([(sid, authenticated, rows[-1][1])])
+            for distributor in self.distributors:
+                if transport in distributor.transports():
+                    distributor.distribute(transport, recipients, evt)
+        finally:
+            @self.env.with_transaction()
+            def do_delete(db):
+                cursor = db.cursor()
+                cursor.executemany("""
+                    DELETE FROM announcement_digest
+                          WHERE id=%s
+                """, [(row[0],) for row in rows])
+        return True
+
+
+class AnnouncementBatch(object):
+    """Returned by `AnnouncementSystem.begin_batch`.  Can be used as a
+    context manager, which ends the batch on exit.
+    """
+
+    def __init__(self, system):
+        self.system = system
+        self.events = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.system.end_batch()
+        return False
+
+
+class _BatchRequestHandler(object):
+    """Sends the events of a request with a single batch."""
+
+    def __init__(self, handler, system):
+        self.handler = handler
+        self.system = system
+
+    def __getattr__(self, name):
+        return getattr(self.handler, name)
 
+    def process_request(self, req):
+        self.system.begin_batch()
+        try:
+            return self.handler.process_request(req)
+        finally:
+            self.system.end_batch()
+
+
+class DispatchThread(threading.Thread):
+    """Worker that resolves and distributes queued announcements."""
+
+    def __init__(self, system, queue, recover=False):
+        threading.Thread.__init__(self)
+        self._system = system
+        self._queue = queue
+        self._recover = recover
+        self.setDaemon(True)
+
+    def run(self):
+        while 1:
+            try:
+                self._queue.get(True, self._system.dispatch_poll_interval)
+            except Queue.Empty:
+                # look for events queued by other processes
+                if not self._recover:
+                    continue
+            try:
+                self._system._dispatch_queued()
+            except:
+                self._system.log.error("AnnouncementSystem dispatch worker "
+                        "failed.", exc_info=True)
+
+
+class CoalesceThread(threading.Thread):
+    """Sends the events held for coalescing when their window is over."""
+
+    def __init__(self, system):
+        threading.Thread.__init__(self)
+        self._system = system
+        self.setDaemon(True)
+
+    def run(self):
+        while 1:
+            try:
+                self._system._release_held()
+            except:
+                self._system.log.error("AnnouncementSystem coalescing "
+                        "worker failed.", exc_info=True)
+
+
+class DigestThread(threading.Thread):
+    """Sends the pending digests when they are due."""
+
+    def __init__(self, system):
+        threading.Thread.__init__(self)
+        self._system = system
+        self.setDaemon(True)
+
+    def run(self):
+        while 1:
+            try:
+                self._system._flush_digests()
+            except:
+                self._system.log.error("AnnouncementSystem digest worker "
+                        "failed.", exc_info=True)
+            time.sleep(self._system.digest_poll_interval)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Robert Corsaro
+# Copyright (c) 2010, Steffen Hoffmann
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+
+"""Background delivery of announcements.
+
+Distributors hand finished messages to the DeliveryPool instead of sending
+them in the thread that produced them.  The pool limits how many deliveries
+run at the same time for each transport and each destination host, so a
+single slow server can't occupy all workers.
+"""
+
+import threading
+import time
+
+from trac.config import IntOption, ListOption
+from trac.core import *
+
+
+class DeliveryPool(Component):
+    """Pool of worker threads shared by the distributors."""
+
+    workers = IntOption('announcer', 'delivery_workers', 4,
+        """Number of threads delivering announcements in the background.
+        (requires use_threaded_delivery)""")
+
+    transport_limits = ListOption('announcer', 'delivery_transport_limits',
+        'email:2, xmpp:1',
+        doc="""Comma separated list of transport:count pairs limiting the
+        number of deliveries that run at the same time for a transport.
+        Transports that are not listed may use all workers.
+        """)
+
+    host_limit = IntOption('announcer', 'delivery_host_limit', 2,
+        """Maximum number of deliveries that run at the same time for a
+        single destination host.  Zero disables the limit.""")
+
+    high_water = IntOption('announcer', 'delivery_queue_high_water', 1000,
+        """Number of waiting deliveries at which new deliveries are held
+        back until the workers have caught up.""")
+
+    # Seconds between rechecks while a submitter is held back.
+    backpressure_interval = 1
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._jobs = []
+        self._active = {}
+        self._threads = []
+
+    def submit(self, transport, host, func, *args):
+        """Queues `func(*args)` for delivery over `transport` to `host`.
+
+        Blocks while the queue is above the high-water mark, unless it is
+        called from one of the pool's own workers.
+        """
+        self._cond.acquire()
+        try:
+            self._start_workers()
+            if threading.currentThread() not in self._threads:
+                while len(self._jobs) >= self.high_water:
+                    self._cond.wait(self.backpressure_interval)
+            self._jobs.append((transport, host, func, args))
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def concurrency(self, transport, host):
+        """Returns the number of deliveries over `transport` to `host` that
+        may run at the same time."""
+        count = max(1, self.workers)
+        limit = self._limits().get(transport)
+        if limit:
+            count = min(count, limit)
+        if self.host_limit:
+            count = min(count, self.host_limit)
+        return count
+
+    def pending(self):
+        """Returns the number of deliveries waiting for a worker."""
+        return len(self._jobs)
+
+    def _start_workers(self):
+        while len(self._threads) < max(1, self.workers):
+            thread = DeliveryThread(self)
+            self._threads.append(thread)
+            thread.start()
+
+    def _limits(self):
+        limits = {}
+        for item in self.transport_limits:
+            transport, _, count = item.partition(':')
+            try:
+                limits[transport.strip()] = int(count)
+            except ValueError:
+                self.log.warning("DeliveryPool ignores invalid transport "
+                        "limit '%s'" % item)
+        return limits
+
+    def _next_job(self):
+        """Removes and returns the first job that is within the limits of
+        its transport and host, or None.  Must be called with the lock
+        held."""
+        limits = self._limits()
+        for i, (transport, host, func, args) in enumerate(self._jobs):
+            limit = limits.get(transport)
+            if limit and self._active.get(transport, 0) >= limit:
+                continue
+            if self.host_limit and \
+                    self._active.get((transport, host), 0) >= self.host_limit:
+                continue
+            for key in (transport, (transport, host)):
+                self._active[key] = self._active.get(key, 0) + 1
+            del self._jobs[i]
+            return transport, host, func, args
+        return None
+
+    def _run_next(self):
+        """Waits for a job that may be run and runs it."""
+        self._cond.acquire()
+        try:
+            job = self._next_job()
+            while job is None:
+                self._cond.wait()
+                job = self._next_job()
+        finally:
+            self._cond.release()
+        transport, host, func, args = job
+        start = time.time()
+        try:
+            try:
+                func(*args)
+            except:
+                self.log.error("DeliveryPool failed to deliver over %s to "
+                        "%s." % (transport, host), exc_info=True)
+        finally:
+            self._cond.acquire()
+            try:
+                for key in (transport, (transport, host)):
+                    self._active[key] -= 1
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+        self.log.debug("DeliveryPool took %s seconds to deliver over %s "
+                "to %s." % (round(time.time() - start, 2), transport, host))
+
+
+class DeliveryThread(threading.Thread):
+    def __init__(self, pool):
+        threading.Thread.__init__(self)
+        self._pool = pool
+        self.setDaemon(True)
+
+    def run(self):
+        while 1:
+            try:
+                self._pool._run_next()
+            except:
+                self._pool.log.error("DeliveryPool worker failed.",
+                        exc_info=True)
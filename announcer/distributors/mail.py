@@ -35,10 +35,10 @@
 #       format for all announcements, but in the future we can make this more
 #       flexible, since it's in the subscription table.
 
-import Queue
 import random
 import re
 import smtplib
+import socket
 import sys
 import threading
 import time
@@ -53,13 +53,15 @@ except:
     from email.Header import Header
 from subprocess import Popen, PIPE
 
-from trac.config import BoolOption, ExtensionOption, IntOption, Option, \
-                        OrderedExtensionsOption
+from trac.config import BoolOption, ExtensionOption, FloatOption, \
+                        IntOption, Option, OrderedExtensionsOption
+from trac.admin.api import IAdminCommandProvider
 from trac.core import *
-from trac.util import get_pkginfo, md5
+from trac.util import get_pkginfo, hex_entropy, md5
 from trac.util.compat import set, sorted
-from trac.util.datefmt import to_timestamp
-from trac.util.text import CRLF, to_unicode
+from trac.util.datefmt import format_datetime, to_timestamp
+from trac.util.text import CRLF, print_table, to_unicode
+from trac.web.api import IRequestFilter
 
 from announcer.api import AnnouncementSystem
 from announcer.api import IAnnouncementAddressResolver
@@ -67,10 +69,13 @@ from announcer.api import IAnnouncementDistributor
 from announcer.api import IAnnouncementFormatter
 from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import IAnnouncementProducer
-from announcer.api import _
+from announcer.api import _, event_cache, format_event
+from announcer.delivery import DeliveryPool
+from announcer.metrics import Metrics
 
-from announcer.util.mail import set_header
+from announcer.util.mail import exception_to_unicode, set_header
 from announcer.util.mail_crypto import CryptoTxt
+from announcer.util.settings import SessionAttributes
 
 
 class IEmailSender(Interface):
@@ -79,6 +84,18 @@ class IEmailSender(Interface):
     def send(self, from_addr, recipients, message):
         """Send message to recipients."""
 
+    def send_batch(self, messages):
+        """Optional variant of `send` for several messages.
+
+        Accepts a list of (from_addr, recipients, message) tuples, which
+        the sender can deliver over a single connection.  Returns a list
+        with the result of each message: the dictionary of refused
+        recipients `send` would return, or the exception it would raise.
+        A failed message doesn't keep the following ones from being sent.
+        The distributor calls `send` for each message on senders that
+        don't implement this method.
+        """
+
 
 class IAnnouncementEmailDecorator(Interface):
     def decorate_message(event, message, decorators):
@@ -90,7 +107,8 @@ class IAnnouncementEmailDecorator(Interface):
 
 class EmailDistributor(Component):
 
-    implements(IAnnouncementDistributor)
+    implements(IAnnouncementDistributor, IAdminCommandProvider,
+               IRequestFilter)
 
     formatters = ExtensionPoint(IAnnouncementFormatter)
     # Make ordered
@@ -157,12 +175,43 @@ class EmailDistributor(Component):
         """Do message delivery in a separate thread.
 
         Enabling this will improve responsiveness for requests that end up
-        with an announcement being sent over email. It requires building
-        Python with threading support enabled-- which is usually the case.
-        To test, start Python and type 'import threading' to see
-        if it raises an error.
+        with an announcement being sent over email. Rendered messages are
+        stored in the `announcement_outbox` table and sent by a background
+        thread, so queued messages survive a restart of the server process;
+        the first request of the next process starts sending them again.
+        It requires building Python with threading support enabled-- which
+        is usually the case. To test, start Python and type
+        'import threading' to see if it raises an error.
         """)
 
+    outbox_batch_size = IntOption('announcer', 'outbox_batch_size', 25,
+        """Maximum number of messages taken from the outbox at once.
+        (requires use_threaded_delivery)""")
+
+    outbox_batch_interval = FloatOption('announcer', 'outbox_batch_interval',
+        1.0,
+        """Seconds to pause between two batches of outbox messages, which
+        spreads bursts of announcements out over time.
+        (requires use_threaded_delivery)""")
+
+    outbox_retry_interval = IntOption('announcer', 'outbox_retry_interval',
+        300,
+        """Seconds to wait before a message that could not be sent is
+        tried again.  The wait doubles with every further attempt, plus a
+        random part so messages don't all come back at once.
+        (requires use_threaded_delivery)""")
+
+    outbox_max_retry_interval = IntOption('announcer',
+        'outbox_max_retry_interval', 21600,
+        """Maximum number of seconds between two attempts to send a
+        message. (requires use_threaded_delivery)""")
+
+    outbox_max_attempts = IntOption('announcer', 'outbox_max_attempts', 10,
+        """Number of attempts after which a message that could not be sent
+        is moved to the `announcement_deadletter` table.  Messages the
+        server rejected permanently are moved there right away.
+        (requires use_threaded_delivery)""")
+
     default_email_format = Option('announcer', 'default_email_format',
         'text/plain',
         """The default mime type of the email notifications.
@@ -220,18 +269,27 @@ class EmailDistributor(Component):
         msg body will get emptied.
         """)
 
+    gpg_workers = IntOption('announcer', 'gpg_workers', 4,
+        """Maximum number of GnuPG processes encrypting the messages of an
+        announcement at the same time.""")
+
+
+    # Seconds between scans of the outbox for messages that are due for
+    # another attempt or were queued by other processes.
+    outbox_poll_interval = 30
+    # Seconds after which a message claimed by a sender that didn't finish
+    # it is handed out again.
+    outbox_claim_timeout = 600
 
     def __init__(self):
-        self.delivery_queue = None
+        self._crypto = None
+        self._outbox_thread = None
+        self._outbox_lock = threading.Lock()
+        self._outbox_wakeup = threading.Event()
+        self._outbox_owner = hex_entropy(16)
+        self._outbox_checked = False
         self._init_pref_encoding()
 
-    def get_delivery_queue(self):
-        if not self.delivery_queue:
-            self.delivery_queue = Queue.Queue()
-            thread = DeliveryThread(self.delivery_queue, self.send)
-            thread.start()
-        return self.delivery_queue
-
     # IAnnouncementDistributor
     def transports(self):
         yield "email"
@@ -267,18 +325,38 @@ class EmailDistributor(Component):
             return
         msgdict = {}
         msgdict_encrypt = {}
-        msg_pubkey_ids = []
+        rcpt_pubkey_ids = {}
         # compile pattern before use for better performance
         RCPT_ALLOW_RE = re.compile(self.rcpt_allow_regexp)
         RCPT_LOCAL_RE = re.compile(self.rcpt_local_regexp)
 
         if self.crypto != '':
             self.log.debug("EmailDistributor attempts crypto operation.")
-            self.enigma = CryptoTxt(self.gpg_binary, self.gpg_home)
+            self.enigma = self._get_crypto()
+
+        # fetch the session attributes needed for all recipients at once,
+        # and share them with the other events of a batch
+        sids = [name for name, authed, addr in recipients if name]
+        names = ('email', 'announcer_specified_email',
+                 'announcer_email_format_%s' % event.realm)
+        cache = event_cache(event, 'session_attributes')
+        attributes = cache.get('email')
+        if attributes is None:
+            attributes = cache['email'] = SessionAttributes(self.env, sids,
+                                                            names)
+        else:
+            attributes.add(sids)
+            attributes.load(names)
+        start = time.time()
+        addresses = self._resolve_addresses(
+                [(name, authed) for name, authed, addr in recipients
+                 if name and not addr], attributes)
+        Metrics(self.env).timing('email.resolve', time.time() - start)
 
         for name, authed, addr in recipients:
             fmt = name and \
-                self._get_preferred_format(event.realm, name, authed) or \
+                self._get_preferred_format(event.realm, name, authed,
+                        attributes) or \
                 self._get_default_format()
             if fmt not in fmtdict:
                 self.log.debug(("EmailDistributer format %s not available " +
@@ -301,9 +379,7 @@ class EmailDistributor(Component):
             rslvr = None
             if name and not addr:
                 # figure out what the addr should be if it's not defined
-                for rslvr in self.resolvers:
-                    addr = rslvr.get_address_for_name(name, authed)
-                    if addr: break
+                addr, rslvr = addresses.get((name, authed), (None, None))
             if addr:
                 self.log.debug("EmailDistributor found the " \
                         "address '%s' for '%s (%s)' via: %s"%(
@@ -323,7 +399,8 @@ class EmailDistributor(Component):
                         if len(pubkey_ids) > 0:
                             msgdict_encrypt.setdefault(fmt, set()).add((name,
                                                             authed, addr))
-                            msg_pubkey_ids[len(msg_pubkey_ids):] = pubkey_ids
+                            rcpt_pubkey_ids[(name, authed, addr)] = \
+                                    tuple(sorted(pubkey_ids))
                             self.log.debug("EmailDistributor got pubkeys " \
                                 "for %s: %s" % (addr, pubkey_ids))
                         else:
@@ -344,37 +421,108 @@ class EmailDistributor(Component):
                 self.log.debug("EmailDistributor was unable to find an " \
                         "address for: %s (%s)"%(name, authed and \
                         'authenticated' or 'not authenticated'))
+        # all messages of the event are handed over at once, so they can
+        # be delivered in a single SMTP session
+        packages = []
         for k, v in msgdict.items():
             if not v or not fmtdict.get(k):
                 continue
             self.log.debug(
                 "EmailDistributor is sending event as '%s' to: %s"%(
                     fmt, ', '.join(x[2] for x in v)))
-            self._do_send(transport, event, k, v, fmtdict[k])
+            packages.append(self._build_message(transport, event, k, v,
+                                                fmtdict[k]))
+        # encrypt separately for the keys of each recipient, so nobody gets
+        # a message that was encrypted for the keys of others
+        groups = []
         for k, v in msgdict_encrypt.items():
             if not v or not fmtdict.get(k):
                 continue
+            by_keys = {}
+            for rcpt in v:
+                by_keys.setdefault(rcpt_pubkey_ids[rcpt], set()).add(rcpt)
+            for pubkey_ids, rcpts in by_keys.items():
+                groups.append((k, pubkey_ids, rcpts))
+        outputs = self._encrypt([
+            (format_event(fmtdict[k], transport, k, event), list(pubkey_ids))
+            for k, pubkey_ids, v in groups])
+        for (k, pubkey_ids, v), output in zip(groups, outputs):
             self.log.debug(
                 "EmailDistributor is sending encrypted info on event " \
-                "as '%s' to: %s"%(fmt, ', '.join(x[2] for x in v)))
-            self._do_send(transport, event, k, v, fmtdict[k], msg_pubkey_ids)
+                "as '%s' to: %s"%(k, ', '.join(x[2] for x in v)))
+            packages.append(self._build_message(transport, event, k, v,
+                                                fmtdict[k], output))
+        packages = [p for p in packages if p]
+        if packages:
+            start = time.time()
+            if self.use_threaded_delivery:
+                self._queue_messages(packages)
+            else:
+                for result in self.send_batch(packages):
+                    if isinstance(result, Exception):
+                        self.log.error("EmailDistributor failed to send "
+                                "a message: %s"
+                                % exception_to_unicode(result))
+            stop = time.time()
+            Metrics(self.env).timing(self.use_threaded_delivery and
+                    'email.queue' or 'email.deliver', stop - start)
+            self.log.debug("EmailDistributor took %s seconds to send %d "
+                    "messages." % (round(stop-start,2), len(packages)))
+
+    def _get_crypto(self):
+        """Returns the crypto provider, which is kept for later events as
+        long as the GnuPG settings don't change."""
+        key = (self.gpg_binary, self.gpg_home)
+        crypto = self._crypto
+        if crypto is None or crypto[0] != key:
+            crypto = self._crypto = (key, CryptoTxt(*key))
+        return crypto[1]
 
     def _get_default_format(self):
         return self.default_email_format
 
-    def _get_preferred_format(self, realm, sid, authenticated):
+    def _resolve_addresses(self, names, attributes):
+        """Returns a dictionary mapping (name, authenticated) tuples to
+        (address, resolver) tuples, asking each resolver in turn for the
+        names that are still without an address.
+        """
+        found = {}
+        for rslvr in self.resolvers:
+            names = [n for n in names if n not in found]
+            if not names:
+                break
+            if hasattr(rslvr, 'get_addresses_for_names'):
+                addresses = rslvr.get_addresses_for_names(names, attributes)
+            else:
+                addresses = {}
+                for name, authed in names:
+                    addr = rslvr.get_address_for_name(name, authed)
+                    if addr:
+                        addresses[(name, authed)] = addr
+            for key, addr in addresses.items():
+                if addr:
+                    found[key] = (addr, rslvr)
+        return found
+
+    def _get_preferred_format(self, realm, sid, authenticated,
+                              attributes=None):
         if authenticated is None:
             authenticated = 0
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("""
-            SELECT value
-              FROM session_attribute
-             WHERE sid=%s
-               AND authenticated=%s
-               AND name=%s
-        """, (sid, int(authenticated), 'announcer_email_format_%s' % realm))
-        result = cursor.fetchone()
+        name = 'announcer_email_format_%s' % realm
+        if attributes is not None:
+            result = attributes.get(sid, authenticated, name)
+            result = result and (result,)
+        else:
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            cursor.execute("""
+                SELECT value
+                  FROM session_attribute
+                 WHERE sid=%s
+                   AND authenticated=%s
+                   AND name=%s
+            """, (sid, int(authenticated), name))
+            result = cursor.fetchone()
         if result:
             chosen = result[0]
             self.log.debug("EmailDistributor determined the preferred format" \
@@ -423,34 +571,45 @@ class EmailDistributor(Component):
     def _filter_recipients(self, rcpt):
         return rcpt
 
-    def _do_send(self, transport, event, format, recipients, formatter,
-                 pubkey_ids=[]):
-
-        output = formatter.format(transport, event.realm, format, event)
-
-        # DEVEL: force message body plaintext style for crypto operations
-        if self.crypto != '' and pubkey_ids != []:
-            if self.crypto == 'sign':
-                output = self.enigma.sign(output, self.private_key)
-            elif self.crypto == 'encrypt':
-                output = self.enigma.encrypt(output, pubkey_ids)
-            elif self.crypto == 'sign,encrypt':
-                output = self.enigma.sign_encrypt(output, pubkey_ids,
-                                                     self.private_key)
+    def _encrypt(self, jobs):
+        """Encrypts a list of (content, pubkey_ids) tuples, running up to
+        `gpg_workers` GnuPG processes at the same time.  Returns the list
+        of ciphertexts.
+        """
+        if not jobs:
+            return []
+        start = time.time()
+        outputs = self.enigma.encrypt_many(jobs,
+                sign=self.crypto == 'sign,encrypt',
+                private_key=self.private_key, workers=self.gpg_workers)
+        Metrics(self.env).timing('email.encrypt', time.time() - start)
+        self.log.debug(_("EmailDistributor crypto operaton successful."))
+        return outputs
+
+    def _build_message(self, transport, event, format, recipients,
+                       formatter, crypted_output=None):
+        """Renders the message for a group of recipients.  Returns a
+        (from_addr, recipients, message) tuple, or None if there is
+        nobody to send it to.
+
+        Encrypted messages pass the encrypted body as `crypted_output`.
+        """
 
-            self.log.debug(output)
-            self.log.debug(_("EmailDistributor crypto operaton successful."))
+        if crypted_output is not None:
+            # DEVEL: force message body plaintext style for crypto operations
+            output = crypted_output
             alternate_output = None
         else:
+            output = format_event(formatter, transport, format, event)
             alternate_style = formatter.alternative_style_for(
                 transport,
                 event.realm,
                 format
             )
             if alternate_style:
-                alternate_output = formatter.format(
+                alternate_output = format_event(
+                    formatter,
                     transport,
-                    event.realm,
                     alternate_style,
                     event
                 )
@@ -500,10 +659,13 @@ class EmailDistributor(Component):
         del msgText['Content-Transfer-Encoding']
         msgText.set_charset(self._charset)
         parentMessage.attach(msgText)
+        metrics = Metrics(self.env)
+        start = time.time()
         decorators = self._get_decorators()
         if len(decorators) > 0:
             decorator = decorators.pop()
             decorator.decorate_message(event, rootMessage, decorators)
+        metrics.timing('email.decorate', time.time() - start)
 
         recip_adds = [x[2] for x in recipients if x]
         # Append any to, cc or bccs added to the recipient list
@@ -517,23 +679,354 @@ class EmailDistributor(Component):
             set_header(rootMessage, 'To', _('undisclosed-recipients: ;'))
 
         self.log.debug("Content of recip_adds: %s" %(recip_adds))
-        package = (from_header, recip_adds, rootMessage.as_string())
-
         if len(recip_adds) > 0:
             start = time.time()
-            if self.use_threaded_delivery:
-                self.get_delivery_queue().put(package)
-            else:
-                self.send(*package)
-            stop = time.time()
-            self.log.debug("EmailDistributor took %s seconds to send."\
-                    %(round(stop-start,2)))
+            message = rootMessage.as_string()
+            metrics.timing('email.serialize', time.time() - start)
+            return (from_header, recip_adds, message)
 
     def send(self, from_addr, recipients, message):
         """Send message to recipients via e-mail."""
         # Ensure the message complies with RFC2822: use CRLF line endings
         message = CRLF.join(re.split("\r?\n", message))
-        self.email_sender.send(from_addr, recipients, message)
+        return self.email_sender.send(from_addr, recipients, message)
+
+    def send_batch(self, messages):
+        """Send several (from_addr, recipients, message) tuples via e-mail,
+        over a single connection if the sender supports it.  Returns the
+        refused recipients or the exception of each message, like
+        `IEmailSender.send_batch`."""
+        if not hasattr(self.email_sender, 'send_batch'):
+            results = []
+            for from_addr, recipients, message in messages:
+                try:
+                    results.append(self.send(from_addr, recipients,
+                                             message))
+                except Exception, e:
+                    results.append(e)
+            return results
+        return self.email_sender.send_batch([
+            (from_addr, recipients, CRLF.join(re.split("\r?\n", message)))
+            for from_addr, recipients, message in messages])
+
+    def _queue_messages(self, messages):
+        """Stores rendered messages in the outbox for the delivery
+        thread."""
+        now = int(time.time())
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.executemany("""
+                INSERT INTO announcement_outbox
+                            (time, next_attempt, attempts, state,
+                            from_addr, recipients, message)
+                     VALUES (%s, %s, 0, 'queued', %s, %s, %s)
+            """, [(now, now, from_addr, '\n'.join(recipients), message)
+                  for from_addr, recipients, message in messages])
+        self._start_outbox_thread()
+        self._outbox_wakeup.set()
+
+    def _start_outbox_thread(self):
+        self._outbox_lock.acquire()
+        try:
+            if not self._outbox_thread:
+                self._outbox_thread = OutboxThread(self)
+                self._outbox_thread.start()
+        finally:
+            self._outbox_lock.release()
+
+    def _claim_outbox(self):
+        """Claims the next batch of due messages.  Returns a list of
+        (id, attempts, from_addr, recipients, message) tuples."""
+        now = int(time.time())
+        claimed = []
+        @self.env.with_transaction()
+        def do_claim(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                SELECT id, attempts, from_addr, recipients, message
+                  FROM announcement_outbox
+                 WHERE next_attempt <= %s
+              ORDER BY next_attempt, id
+                 LIMIT %s
+            """, (now, self.outbox_batch_size))
+            for row in cursor.fetchall():
+                # a message in state 'sending' is due again once its
+                # claim has timed out
+                cursor.execute("""
+                    UPDATE announcement_outbox
+                       SET state='sending', owner=%s, next_attempt=%s
+                     WHERE id=%s
+                       AND next_attempt <= %s
+                """, (self._outbox_owner, now + self.outbox_claim_timeout,
+                       row[0], now))
+                if cursor.rowcount == 1:
+                    claimed.append(row)
+        return claimed
+
+    def _drain_outbox(self):
+        """Hands one batch of messages from the outbox to the delivery
+        pool and waits until they have been sent.  Returns the number of
+        messages that were taken from the outbox.
+
+        The batch is split among as many deliveries as the pool runs at
+        once for the relay, each sending its messages in a single session.
+        """
+        batch = self._claim_outbox()
+        pool = DeliveryPool(self.env)
+        host = self._delivery_host()
+        count = min(len(batch), pool.concurrency('email', host))
+        done = threading.Semaphore(0)
+        def send(rows):
+            try:
+                self._send_outbox_batch(rows)
+            finally:
+                done.release()
+        for i in range(count):
+            pool.submit('email', host, send, batch[i::count])
+        for i in range(count):
+            done.acquire()
+        return len(batch)
+
+    def _renew_outbox_claim(self, msg_id):
+        """Extends the claim on a message that is about to be sent.
+        Returns False if the claim timed out and the message was taken by
+        another sender."""
+        now = int(time.time())
+        renewed = []
+        @self.env.with_transaction()
+        def do_renew(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE announcement_outbox
+                   SET next_attempt=%s
+                 WHERE id=%s
+                   AND owner=%s
+            """, (now + self.outbox_claim_timeout, msg_id,
+                   self._outbox_owner))
+            renewed.append(cursor.rowcount == 1)
+        return renewed[0]
+
+    def _send_outbox_message(self, msg_id, attempts, from_addr, recipients,
+                             message):
+        self._send_outbox_batch([(msg_id, attempts, from_addr, recipients,
+                                  message)])
+
+    def _send_outbox_batch(self, rows):
+        """Sends claimed outbox messages, over a single connection if the
+        sender supports it, and records the outcome of each."""
+        claimed = []
+        for row in rows:
+            if self._renew_outbox_claim(row[0]):
+                claimed.append(row)
+            else:
+                self.log.debug("EmailDistributor skips outbox message %s, "
+                        "it was claimed by another sender" % row[0])
+        if not claimed:
+            return
+        start = time.time()
+        results = self.send_batch([
+            (from_addr, recipients.split('\n'), message)
+            for msg_id, attempts, from_addr, recipients, message in claimed])
+        Metrics(self.env).timing('email.deliver', time.time() - start)
+        for row, result in zip(claimed, results):
+            self._record_outbox_result(row[0], row[1] + 1,
+                                       row[3].split('\n'), result)
+
+    def _record_outbox_result(self, msg_id, attempts, recipients, result):
+        """Removes a sent message from the outbox, or schedules another
+        attempt or buries it for the recipients that didn't get it."""
+        if isinstance(result, Exception):
+            Metrics(self.env).increment('email.deliver.failed')
+        error = None
+        undelivered = []
+        if isinstance(result, PartialDeliveryError):
+            # the recipients that got the message are done with
+            refused = dict(result.refused)
+            error = result.error
+            undelivered = [rcpt for rcpt in recipients
+                           if rcpt not in result.delivered and
+                              rcpt not in refused]
+            self.log.warning("EmailDistributor sent outbox message %s to "
+                    "%s of %s recipients (attempt %s): %s" % (msg_id,
+                    len(result.delivered), len(recipients), attempts,
+                    exception_to_unicode(error)))
+        elif isinstance(result, smtplib.SMTPRecipientsRefused):
+            # all recipients were refused, but some maybe only for now
+            refused = dict(result.recipients)
+        elif isinstance(result, Exception):
+            reason = exception_to_unicode(result)
+            if is_permanent_failure(result) or \
+                    attempts >= self.outbox_max_attempts:
+                self.log.error("EmailDistributor gives up on outbox "
+                        "message %s after %s attempts: %s" % (msg_id,
+                        attempts, reason))
+                self._bury_outbox_message(msg_id, attempts, reason)
+            else:
+                self.log.warning("EmailDistributor failed to send outbox "
+                        "message %s (attempt %s): %s" % (msg_id,
+                        attempts, reason))
+                self._reschedule_outbox_message(msg_id, attempts)
+            return
+        else:
+            refused = dict(result or {})
+        errors = {}
+        for rcpt, (code, resp) in refused.items():
+            errors[rcpt] = u'%s %s' % (code, to_unicode(resp))
+        for rcpt in undelivered:
+            errors[rcpt] = exception_to_unicode(error)
+        # try again for the recipients that were refused temporarily, or
+        # didn't get the message because of a temporary failure
+        retry = [rcpt for rcpt, (code, resp) in refused.items()
+                 if code < 500]
+        if undelivered and not is_permanent_failure(error):
+            retry.extend(undelivered)
+        if attempts >= self.outbox_max_attempts:
+            retry = []
+        for rcpt in retry:
+            del errors[rcpt]
+        if errors:
+            self.log.error("EmailDistributor gives up on %s recipients of "
+                    "outbox message %s after %s attempts" % (len(errors),
+                    msg_id, attempts))
+            self._bury_recipients(msg_id, attempts, errors)
+        if retry:
+            retry = [rcpt for rcpt in recipients if rcpt in retry]
+            self._reschedule_outbox_message(msg_id, attempts, retry)
+            return
+        @self.env.with_transaction()
+        def do_delete(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                DELETE FROM announcement_outbox
+                      WHERE id=%s
+            """, (msg_id,))
+
+    def _retry_delay(self, attempts):
+        """Returns the seconds to wait before attempt number `attempts + 1`,
+        growing exponentially with some jitter."""
+        delay = min(self.outbox_retry_interval * 2 ** (attempts - 1),
+                    self.outbox_max_retry_interval)
+        return int(delay * random.uniform(0.5, 1.0))
+
+    def _reschedule_outbox_message(self, msg_id, attempts, recipients=None):
+        next_attempt = int(time.time()) + self._retry_delay(attempts)
+        @self.env.with_transaction()
+        def do_reschedule(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE announcement_outbox
+                   SET state='queued', owner=NULL, attempts=%s,
+                       next_attempt=%s
+                 WHERE id=%s
+            """, (attempts, next_attempt, msg_id))
+            if recipients:
+                cursor.execute("""
+                    UPDATE announcement_outbox
+                       SET recipients=%s
+                     WHERE id=%s
+                """, ('\n'.join(recipients), msg_id))
+
+    def _bury_outbox_message(self, msg_id, attempts, error):
+        """Moves a message that can't be delivered to the dead letters."""
+        @self.env.with_transaction()
+        def do_move(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO announcement_deadletter
+                            (time, attempts, error, from_addr, recipients,
+                             message)
+                     SELECT %s, %s, %s, from_addr, recipients, message
+                       FROM announcement_outbox
+                      WHERE id=%s
+            """, (int(time.time()), attempts, error, msg_id))
+            cursor.execute("""
+                DELETE FROM announcement_outbox
+                      WHERE id=%s
+            """, (msg_id,))
+
+    def _bury_recipients(self, msg_id, attempts, errors):
+        """Moves the recipients of a message that can't be delivered to
+        the dead letters.  `errors` maps each recipient to the reason
+        it failed."""
+        now = int(time.time())
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            for rcpt, error in sorted(errors.items()):
+                cursor.execute("""
+                    INSERT INTO announcement_deadletter
+                                (time, attempts, error, from_addr,
+                                 recipients, message)
+                         SELECT %s, %s, %s, from_addr, %s, message
+                           FROM announcement_outbox
+                          WHERE id=%s
+                """, (now, attempts, error, rcpt, msg_id))
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        # messages left in the outbox by a previous process are sent once
+        # the first request of the next one comes in
+        if not self._outbox_checked:
+            self._outbox_checked = True
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            cursor.execute("SELECT id FROM announcement_outbox LIMIT 1")
+            if cursor.fetchall():
+                self._start_outbox_thread()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # IAdminCommandProvider
+
+    def get_admin_commands(self):
+        yield ('announcer deadletter list', '',
+               'List the messages that could not be delivered',
+               None, self._do_deadletter_list)
+        yield ('announcer deadletter retry', '[id]',
+               """Move undelivered messages back to the outbox
+
+               Moves all messages, or the message with the given id.""",
+               None, self._do_deadletter_retry)
+
+    def _do_deadletter_list(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT id, time, attempts, recipients, error
+              FROM announcement_deadletter
+          ORDER BY id
+        """)
+        print_table([(id, format_datetime(t), attempts,
+                      ', '.join(recipients.split('\n')), error)
+                     for id, t, attempts, recipients, error in cursor],
+                    ['Id', 'Time', 'Attempts', 'Recipients', 'Error'])
+
+    def _do_deadletter_retry(self, id=None):
+        now = int(time.time())
+        where = id is not None and ' WHERE id=%s' or ''
+        args = id is not None and (int(id),) or ()
+        @self.env.with_transaction()
+        def do_move(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO announcement_outbox
+                            (time, next_attempt, attempts, state,
+                             from_addr, recipients, message)
+                     SELECT time, %s, 0, 'queued', from_addr, recipients,
+                            message
+                       FROM announcement_deadletter""" + where,
+                (now,) + args)
+            cursor.execute("DELETE FROM announcement_deadletter" + where,
+                           args)
+
+    def _delivery_host(self):
+        """Host the configured email sender delivers to, used to limit
+        concurrent deliveries per host."""
+        return getattr(self.email_sender, 'server', None) or 'localhost'
 
     def _get_decorators(self):
         return self.decorators[:]
@@ -544,8 +1037,59 @@ class EmailDistributor(Component):
 
 
 
+def is_permanent_failure(e):
+    """Returns True if the exception raised by an `IEmailSender` means the
+    message will never be accepted, so there is no point in trying again.
+    """
+    if isinstance(e, PartialDeliveryError):
+        return is_permanent_failure(e.error)
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return not [code for code, resp in e.recipients.values()
+                    if code < 500]
+    if isinstance(e, smtplib.SMTPResponseException):
+        return e.smtp_code >= 500
+    if isinstance(e, SendmailError):
+        return e.returncode in SendmailError.permanent_codes
+    return False
+
+
+class SendmailError(Exception):
+    """Raised when the sendmail program fails."""
+
+    # sysexits.h: EX_USAGE, EX_DATAERR, EX_NOUSER, EX_NOHOST
+    permanent_codes = (64, 65, 67, 68)
+
+    def __init__(self, returncode, message):
+        Exception.__init__(self, message)
+        self.returncode = returncode
+
+
+class PartialDeliveryError(smtplib.SMTPException):
+    """Raised when a message sent in several transactions failed after
+    some of its recipients got it.
+
+    `error` is the exception of the failed transaction, `delivered` the
+    list of recipients the message was delivered to, and `refused` the
+    dictionary of the recipients that were refused so far.  The remaining
+    recipients didn't get the message.
+    """
+
+    def __init__(self, error, delivered, refused):
+        smtplib.SMTPException.__init__(self, "Delivered to %d recipients "
+                "before failing: %s" % (len(delivered),
+                                        exception_to_unicode(error)))
+        self.error = error
+        self.delivered = delivered
+        self.refused = refused
+
+
 class SmtpEmailSender(Component):
-    """E-mail sender connecting to an SMTP server."""
+    """E-mail sender connecting to an SMTP server.
+
+    Authenticated connections are kept open for a while and reused for the
+    following messages, so a burst of announcements doesn't pay for a new
+    connection, EHLO, STARTTLS and LOGIN each time.
+    """
 
     implements(IEmailSender)
 
@@ -573,8 +1117,263 @@ class SmtpEmailSender(Component):
     debuglevel = IntOption('smtp', 'debuglevel', 0,
         """Set to 1 for useful smtp debugging on stdout.""")
 
+    reuse_connections = BoolOption('smtp', 'reuse_connections', 'true',
+        """Keep connections to the SMTP server open and reuse them for
+        following messages.""")
+
+    idle_timeout = IntOption('smtp', 'idle_timeout', 30,
+        """Seconds an unused connection is kept open for reuse.  Idle
+        connections are closed once this time is over, even if no further
+        message is sent.""")
+
+    max_idle_connections = IntOption('smtp', 'max_idle_connections', 4,
+        """Maximum number of unused connections kept open per server.""")
+
+    max_messages_per_connection = IntOption('smtp',
+        'max_messages_per_connection', 100,
+        """Number of messages after which a connection is closed and a new
+        one is opened.""")
+
+    max_recipients = IntOption('smtp', 'max_recipients', 100,
+        """Maximum number of recipients per mail transaction.  Messages to
+        more recipients are sent in several transactions.  Use 0 for no
+        limit.""")
+
+    def __init__(self):
+        self._pool = {}
+        self._pool_lock = threading.Lock()
+        self._reaper = None
 
     def send(self, from_addr, recipients, message):
+        conn = self._checkout()
+        try:
+            refused = self._sendmail(conn.smtp, from_addr, recipients,
+                                     message)
+        except Exception, e:
+            exc_info = sys.exc_info()
+            if self._session_lost(e):
+                self._close(conn)
+            else:
+                conn.sent += 1
+                self._checkin(conn)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        conn.sent += 1
+        self._checkin(conn)
+        return refused
+
+    def send_batch(self, messages):
+        # one mail transaction per message, all in the same session
+        results = []
+        conn = None
+        error = None
+        for from_addr, recipients, message in messages:
+            if error is not None:
+                # the server can't be reached, don't wait for it again
+                results.append(error)
+                continue
+            try:
+                if conn is None:
+                    conn = self._checkout()
+                elif conn.sent >= self.max_messages_per_connection:
+                    self._close(conn)
+                    conn = None
+                    conn = _SmtpConnection(self._pool_key(),
+                                           self._connect())
+            except Exception, e:
+                results.append(e)
+                error = e
+                continue
+            try:
+                results.append(self._sendmail(conn.smtp, from_addr,
+                                              recipients, message))
+            except Exception, e:
+                results.append(e)
+                if self._session_lost(e):
+                    self._close(conn)
+                    conn = None
+                    continue
+            conn.sent += 1
+        if conn is not None:
+            self._checkin(conn)
+        return results
+
+    def _sendmail(self, smtp, from_addr, recipients, message):
+        """Sends a message like `smtplib.SMTP.sendmail`, but splits the
+        recipients into transactions of at most `max_recipients`, and sends
+        the MAIL and RCPT commands of a transaction at once if the server
+        supports PIPELINING.
+
+        Returns a dictionary of the refused recipients, like `sendmail`.
+        Raises `SMTPRecipientsRefused` only if all recipients were refused,
+        and `PartialDeliveryError` if a transaction failed after earlier
+        ones had been delivered.
+        """
+        smtp.ehlo_or_helo_if_needed()
+        recipients = list(recipients)
+        size = self.max_recipients > 0 and self.max_recipients or \
+               len(recipients) or 1
+        refused = {}
+        delivered = []
+        try:
+            for i in range(0, len(recipients), size):
+                chunk = recipients[i:i + size]
+                replies = self._envelope(smtp, from_addr, chunk,
+                                         len(message))
+                code, resp = replies.pop(0)
+                if code != 250:
+                    smtp.rset()
+                    raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+                accepted = []
+                for rcpt, (code, resp) in zip(chunk, replies):
+                    if code in (250, 251):
+                        accepted.append(rcpt)
+                    else:
+                        refused[rcpt] = (code, resp)
+                if not accepted:
+                    smtp.rset()
+                    continue
+                try:
+                    code, resp = smtp.data(message)
+                except smtplib.SMTPResponseException:
+                    # DATA itself was refused, end the transaction
+                    smtp.rset()
+                    raise
+                if code != 250:
+                    smtp.rset()
+                    raise smtplib.SMTPDataError(code, resp)
+                delivered.extend(accepted)
+        except Exception, e:
+            if not delivered:
+                raise
+            raise PartialDeliveryError(e, delivered, refused)
+        for rcpt, (code, resp) in refused.items():
+            self.log.warning("SmtpEmailSender: %s was refused by the "
+                    "server: %s %s" % (rcpt, code, resp))
+        if refused and len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+    def _session_lost(self, e):
+        """Returns True if the session can't be used anymore after
+        `_sendmail` raised `e`.  Transactions the server refused are reset,
+        other failures leave the session in an unknown state."""
+        if isinstance(e, PartialDeliveryError):
+            e = e.error
+        return not isinstance(e, (smtplib.SMTPResponseException,
+                                  smtplib.SMTPRecipientsRefused))
+
+    def _envelope(self, smtp, from_addr, recipients, size):
+        """Sends the MAIL and RCPT commands of a transaction, and returns
+        their replies."""
+        options = ''
+        if smtp.has_extn('size'):
+            options = ' SIZE=%d' % size
+        commands = ['MAIL FROM:%s%s' % (smtplib.quoteaddr(from_addr),
+                                        options)]
+        commands += ['RCPT TO:%s' % smtplib.quoteaddr(rcpt)
+                     for rcpt in recipients]
+        if not smtp.has_extn('pipelining'):
+            replies = []
+            for command in commands:
+                smtp.putcmd(command)
+                replies.append(smtp.getreply())
+            return replies
+        # one round-trip for the whole envelope (RFC 2920)
+        smtp.send(''.join(['%s%s' % (command, CRLF)
+                           for command in commands]))
+        return [smtp.getreply() for command in commands]
+
+    def _pool_key(self):
+        return (self.server, self.port, self.user, self.use_tls, self.use_ssl)
+
+    def _checkout(self):
+        """Returns a healthy pooled connection, or a new one."""
+        key = self._pool_key()
+        self._expire_idle()
+        while True:
+            self._pool_lock.acquire()
+            try:
+                idle = self._pool.get(key)
+                conn = idle and idle.pop() or None
+            finally:
+                self._pool_lock.release()
+            if conn is None:
+                break
+            try:
+                # make sure the server didn't drop the connection meanwhile
+                # and that no transaction is left over
+                if conn.smtp.rset()[0] == 250:
+                    return conn
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self._close(conn)
+        return _SmtpConnection(key, self._connect())
+
+    def _checkin(self, conn):
+        """Returns a connection to the pool, or closes it if it shouldn't
+        be reused."""
+        if not self.reuse_connections or conn.key != self._pool_key() or \
+                conn.sent >= self.max_messages_per_connection:
+            self._close(conn)
+            return
+        conn.last_used = time.time()
+        self._expire_idle()
+        self._pool_lock.acquire()
+        try:
+            idle = self._pool.setdefault(conn.key, [])
+            if len(idle) < self.max_idle_connections:
+                idle.append(conn)
+                conn = None
+            # close the connection if no message comes along
+            self._schedule_reaper()
+        finally:
+            self._pool_lock.release()
+        if conn is not None:
+            self._close(conn)
+
+    def _expire_idle(self):
+        """Closes the pooled connections that have been unused for longer
+        than `idle_timeout`."""
+        deadline = time.time() - self.idle_timeout
+        expired = []
+        self._pool_lock.acquire()
+        try:
+            for key, idle in self._pool.items():
+                expired.extend([c for c in idle if c.last_used < deadline])
+                idle[:] = [c for c in idle if c.last_used >= deadline]
+                if not idle:
+                    del self._pool[key]
+        finally:
+            self._pool_lock.release()
+        for conn in expired:
+            self._close(conn)
+
+    def _reap(self):
+        self._pool_lock.acquire()
+        try:
+            self._reaper = None
+        finally:
+            self._pool_lock.release()
+        try:
+            self._expire_idle()
+        except:
+            self.log.error("SmtpEmailSender failed to close idle "
+                    "connections.", exc_info=True)
+        self._pool_lock.acquire()
+        try:
+            if self._pool:
+                self._schedule_reaper()
+        finally:
+            self._pool_lock.release()
+
+    def _schedule_reaper(self):
+        # must be called with the pool lock held
+        if not self._reaper:
+            self._reaper = threading.Timer(self.idle_timeout + 1, self._reap)
+            self._reaper.setDaemon(True)
+            self._reaper.start()
+
+    def _connect(self):
         # use defaults to make sure connect() is called in the constructor
         smtpclass = smtplib.SMTP
         if self.use_ssl:
@@ -603,17 +1402,26 @@ class SmtpEmailSender(Component):
                 self.user.encode('utf-8'),
                 self.password.encode('utf-8')
             )
-        smtp.sendmail(from_addr, recipients, message)
-        if self.use_tls or self.use_ssl:
-            # avoid false failure detection when the server closes
-            # the SMTP connection with TLS/SSL enabled
-            import socket
-            try:
-                smtp.quit()
-            except socket.sslerror:
-                pass
-        else:
-            smtp.quit()
+        return smtp
+
+    def _close(self, conn):
+        # avoid false failure detection when the server closes
+        # the SMTP connection with TLS/SSL enabled, or has already
+        # dropped an idle connection
+        try:
+            conn.smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            conn.smtp.close()
+
+
+class _SmtpConnection(object):
+    """An SMTP session together with its pool bookkeeping."""
+
+    def __init__(self, key, smtp):
+        self.key = key
+        self.smtp = smtp
+        self.last_used = time.time()
+        self.sent = 0
 
 
 class SendmailEmailSender(Component):
@@ -637,23 +1445,39 @@ class SendmailEmailSender(Component):
             child = Popen(cmdline, bufsize=-1, stdin=PIPE, stdout=PIPE,
                           stderr=PIPE)
             (out, err) = child.communicate(message)
-            if child.returncode or err:
-                raise Exception("Sendmail failed with (%s, %s), command: '%s'"
-                                % (child.returncode, err.strip(), cmdline))
         except OSError, e:
-            self.log.error("Failed to run sendmail[%s] with error %s"%\
-                    (self.sendmail_path, e))
+            # worth another try, the program may be installed by then
+            raise SendmailError(None, "Failed to run sendmail[%s] with "
+                    "error %s" % (self.sendmail_path, e))
+        if child.returncode:
+            raise SendmailError(child.returncode,
+                    "Sendmail failed with (%s, %s), command: '%s'"
+                    % (child.returncode, err.strip(), cmdline))
+        if err:
+            self.log.warning("Sendmail reported: %s" % err.strip())
+
 
+class OutboxThread(threading.Thread):
+    """Sends the messages stored in the outbox in batches."""
 
-class DeliveryThread(threading.Thread):
-    def __init__(self, queue, sender):
+    def __init__(self, distributor):
         threading.Thread.__init__(self)
-        self._sender = sender
-        self._queue = queue
+        self._distributor = distributor
         self.setDaemon(True)
 
     def run(self):
+        distributor = self._distributor
         while 1:
-            sendfrom, recipients, message = self._queue.get()
-            self._sender(sendfrom, recipients, message)
+            distributor._outbox_wakeup.clear()
+            try:
+                count = distributor._drain_outbox()
+            except:
+                distributor.log.error("EmailDistributor outbox delivery "
+                        "failed.", exc_info=True)
+                count = 0
+            if count and count >= distributor.outbox_batch_size:
+                # more messages are waiting, but give the relay a break
+                time.sleep(distributor.outbox_batch_interval)
+                continue
+            distributor._outbox_wakeup.wait(distributor.outbox_poll_interval)
 
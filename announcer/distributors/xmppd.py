@@ -28,10 +28,8 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
-import Queue
 import time
 
-from threading import Thread
 from xmpp import Client
 from xmpp.protocol import Message, JID
 
@@ -44,6 +42,9 @@ from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import IAnnouncementAddressResolver
 from announcer.api import IAnnouncementFormatter
 from announcer.api import IAnnouncementProducer
+from announcer.api import format_event
+from announcer.delivery import DeliveryPool
+from announcer.metrics import Metrics
 from announcer.resolvers import SpecifiedXmppResolver
 from announcer.util.settings import SubscriptionSetting
 
@@ -84,26 +85,19 @@ class XmppDistributor(Component):
     use_threaded_delivery = BoolOption('announcer', 'use_threaded_delivery',
             False,
             """If true, the actual delivery of the message will occur
-            in a separate thread.  Enabling this will improve responsiveness
-            for requests that end up with an announcement being sent over
-            email. It requires building Python with threading support
-            enabled-- which is usually the case. To test, start Python and
-            type 'import threading' to see if it raises an error.
+            in the background threads of the delivery pool.  Enabling this
+            will improve responsiveness for requests that end up with an
+            announcement being sent over email. It requires building Python
+            with threading support enabled-- which is usually the case. To
+            test, start Python and type 'import threading' to see if it
+            raises an error.
             """)
 
     def __init__(self):
         self.connections = {}
-        self.delivery_queue = None
         self.xmpp_format_setting = SubscriptionSetting(self.env, 'xmpp_format',
                 self.default_format)
 
-    def get_delivery_queue(self):
-        if not self.delivery_queue:
-            self.delivery_queue = Queue.Queue()
-            thread = DeliveryThread(self.delivery_queue, self.send)
-            thread.start()
-        return self.delivery_queue
-
     # IAnnouncementDistributor
     def transports(self):
         yield "xmpp"
@@ -193,13 +187,14 @@ class XmppDistributor(Component):
         return self.xmpp_format_setting.get_user_setting(sid)[0]
 
     def _do_send(self, transport, event, format, recipients, formatter):
-        message = formatter.format(transport, event.realm, format, event)
+        message = format_event(formatter, transport, format, event)
 
         package = (recipients, message)
 
         start = time.time()
         if self.use_threaded_delivery:
-            self.get_delivery_queue().put(package)
+            host = self.server or JID(self.user).getDomain()
+            DeliveryPool(self.env).submit('xmpp', host, self.send, *package)
         else:
             self.send(*package)
         stop = time.time()
@@ -221,8 +216,10 @@ class XmppDistributor(Component):
             cl.Connection.disconnect()
             raise IOError("Xmpp auth erro using %s to %s"%(jid, server))
         default_domain = jid.getDomain()
+        start = time.time()
         for recip in recipients:
             cl.send(Message(recip[2], message))
+        Metrics(self.env).timing('xmpp.deliver', time.time() - start)
 
 
 class XmppPreferencePanel(Component):
@@ -267,17 +264,3 @@ class XmppPreferencePanel(Component):
         )
         return "prefs_announcer_xmpp.html", data
 
-
-class DeliveryThread(Thread):
-
-    def __init__(self, queue, sender):
-        Thread.__init__(self)
-        self._sender = sender
-        self._queue = queue
-        self.setDaemon(True)
-
-    def run(self):
-        while 1:
-            sendfrom, recipients, message = self._queue.get()
-            self._sender(sendfrom, recipients, message)
-
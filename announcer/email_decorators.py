@@ -35,10 +35,9 @@ from trac.config import ListOption, Option
 from trac.core import *
 from trac.util.text import to_unicode
 
-from genshi.template import NewTextTemplate
-
 from announcer.distributors.mail import IAnnouncementEmailDecorator
 from announcer.util.mail import set_header, msgid, next_decorator, uid_encode
+from announcer.util.mail import subject_template
 
 """Email decorators have the chance to modify emails or their headers before
 the email distributor sends them out.
@@ -167,7 +166,7 @@ class TicketSubjectEmailDecorator(Component):
             if event.changes:
                 if 'status' in event.changes:
                     action = 'Status -> %s' % (event.target['status'])
-            template = NewTextTemplate(self.ticket_email_subject.encode('utf8'))
+            template = subject_template(self.ticket_email_subject)
             subject = template.generate(
                 ticket=event.target,
                 event=event,
@@ -218,7 +217,7 @@ class WikiSubjectEmailDecorator(Component):
 
     def decorate_message(self, event, message, decorates=None):
         if event.realm == 'wiki':
-            template = NewTextTemplate(self.wiki_email_subject.encode('utf8'))
+            template = subject_template(self.wiki_email_subject)
             subject = template.generate(
                 page=event.target,
                 event=event,
@@ -235,3 +234,34 @@ class WikiSubjectEmailDecorator(Component):
             set_header(message, 'Subject', subject)
 
         return next_decorator(event, message, decorates)
+
+
+class DigestSubjectEmailDecorator(Component):
+    """Formats the subject headers of announcements combining several
+    events based on the digest_email_subject configuration.
+    """
+
+    implements(IAnnouncementEmailDecorator)
+
+    digest_email_subject = Option('announcer', 'digest_email_subject',
+            "${len(events)} changes",
+            """Format string for the subject of emails announcing several
+               events at once.  This is a mini genshi template and it is
+               passed the digest event and the list of its events.""")
+
+    def decorate_message(self, event, message, decorates=None):
+        if event.realm == 'digest':
+            template = subject_template(self.digest_email_subject)
+            subject = template.generate(
+                event=event,
+                events=event.events
+            ).render('text', encoding=None)
+
+            prefix = self.config.get('announcer', 'email_subject_prefix')
+            if prefix == '__default__':
+                prefix = '[%s] ' % self.env.project_name
+            if prefix:
+                subject = "%s%s"%(prefix, subject)
+            set_header(message, 'Subject', subject)
+
+        return next_decorator(event, message, decorates)
@@ -33,13 +33,15 @@
 """Filters can remove subscriptions after they are collected.
 """
 import re
+import time
 
 from trac.core import *
-from trac.config import ListOption
+from trac.config import IntOption, ListOption
 from trac.perm import PermissionCache
+from trac.web.api import IRequestFilter
 
 from announcer.api import IAnnouncementSubscriptionFilter
-from announcer.api import _
+from announcer.api import _, event_cache
 
 class DefaultPermissionFilter(Component):
     """DefaultPermissionFilter simply checks that each subscription
@@ -47,6 +49,7 @@ class DefaultPermissionFilter(Component):
     to be sent.
     """
     implements(IAnnouncementSubscriptionFilter)
+    implements(IRequestFilter)
 
     exception_realms = ListOption('announcer', 'filter_exception_realms', '',
             """The PermissionFilter will filter an announcements for with the
@@ -57,6 +60,23 @@ class DefaultPermissionFilter(Component):
             bypassed using the AnnouncerPlugin.
             """)
 
+    permission_cache_ttl = IntOption('announcer', 'permission_cache_ttl', 0,
+            """Number of seconds the results of permission checks are reused
+            for later announcements.  0 disables the cache, so permissions
+            are checked once per user and announcement.  Permission changes
+            made in the web admin clear the cache of the server process
+            handling the change.  Other server processes, and changes made
+            otherwise (e.g. using trac-admin), keep using the old
+            permissions until the cached results expire.
+            """)
+
+    # Number of cached permission checks above which expired ones are
+    # dropped.
+    permission_cache_size = 10000
+
+    def __init__(self):
+        self._permissions = {}
+
     def filter_subscriptions(self, event, subscriptions):
         action = '%s_VIEW'%event.realm.upper()
         for subscription in subscriptions:
@@ -64,11 +84,63 @@ class DefaultPermissionFilter(Component):
             # PermissionCache already takes care of sid = None
             if not auth:
                 sid = 'anonymous'
-            perm = PermissionCache(self.env, sid)
-            if event.realm in self.exception_realms or perm.has_permission(action):
+            if event.realm in self.exception_realms or \
+                    self._has_permission(event, sid, action):
                 yield subscription
             else:
                 self.log.debug(
                     "Filtering %s with realm %s because of rule: DefaultPermissionFilter"\
                     % (sid, event.realm)
                 )
+
+    def _has_permission(self, event, sid, action):
+        """Checks a permission, expanding the permissions of each user only
+        once per event.
+        """
+        ttl = self.permission_cache_ttl
+        now = time.time()
+        if ttl > 0:
+            expires, allowed = self._permissions.get((sid, action), (0, None))
+            if expires > now:
+                return allowed
+        perms = event_cache(event, 'permissions')
+        if sid not in perms:
+            perms[sid] = PermissionCache(self.env, sid)
+        allowed = perms[sid].has_permission(action)
+        if ttl > 0:
+            if len(self._permissions) > self.permission_cache_size:
+                for key, (expires, value) in self._permissions.items():
+                    if expires <= now:
+                        self._permissions.pop(key, None)
+            self._permissions[(sid, action)] = (now + ttl, allowed)
+        return allowed
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        if handler is not None and req.method == 'POST' and \
+                req.path_info.startswith('/admin/general/perm'):
+            # the admin panel redirects after the change, which skips
+            # post_process_request
+            return _PermissionChangeHandler(handler, self._permissions)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+
+class _PermissionChangeHandler(object):
+    """Clears the cached permission checks once the wrapped handler has
+    committed a permission change."""
+
+    def __init__(self, handler, permissions):
+        self.handler = handler
+        self.permissions = permissions
+
+    def __getattr__(self, name):
+        return getattr(self.handler, name)
+
+    def process_request(self, req):
+        try:
+            return self.handler.process_request(req)
+        finally:
+            self.permissions.clear()
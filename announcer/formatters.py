@@ -31,6 +31,7 @@
 # ----------------------------------------------------------------------------
 
 import difflib
+import threading
 
 from genshi import HTML
 from genshi.template import NewTextTemplate, MarkupTemplate, TemplateLoader
@@ -47,10 +48,36 @@ from trac.web.href import Href
 from trac.wiki.formatter import HtmlFormatter
 from trac.wiki.model import WikiPage
 
-from announcer.api import IAnnouncementFormatter
+from announcer.api import IAnnouncementFormatter, format_event
 from announcer.util.mail import exception_to_unicode
 
 
+_template_loaders = {}
+_template_loaders_lock = threading.Lock()
+
+def load_template(env, filename, cls=NewTextTemplate):
+    """Loads an announcement template from the template directories of the
+    enabled template providers.
+
+    The loader, and with it the parsed templates, are shared by all callers
+    using the same directories, so templates are only parsed again when
+    their files change.
+    """
+    dirs = []
+    for provider in Chrome(env).template_providers:
+        dirs += provider.get_templates_dirs()
+    key = tuple(dirs)
+    _template_loaders_lock.acquire()
+    try:
+        loader = _template_loaders.get(key)
+        if loader is None:
+            loader = _template_loaders[key] = TemplateLoader(dirs,
+                    variable_lookup='lenient', auto_reload=True)
+    finally:
+        _template_loaders_lock.release()
+    return loader.load(filename, cls=cls)
+
+
 def diff_cleanup(gen):
     for value in gen:
         if value.startswith('---'):
@@ -163,12 +190,7 @@ class TicketFormatter(Component):
             short_changes = short_changes,
             attachment= event.attachment
         )
-        chrome = Chrome(self.env)
-        dirs = []
-        for provider in chrome.template_providers:
-            dirs += provider.get_templates_dirs()
-        templates = TemplateLoader(dirs, variable_lookup='lenient')
-        template = templates.load('ticket_email_plaintext.txt',
+        template = load_template(self.env, 'ticket_email_plaintext.txt',
                 cls=NewTextTemplate)
         if template:
             stream = template.generate(**data)
@@ -254,12 +276,7 @@ class TicketFormatter(Component):
             attachment = event.attachment,
             attachment_link = self.env.abs_href('attachment/ticket',ticket.id)
         )
-        chrome = Chrome(self.env)
-        dirs = []
-        for provider in chrome.template_providers:
-            dirs += provider.get_templates_dirs()
-        templates = TemplateLoader(dirs, variable_lookup='lenient')
-        template = templates.load('ticket_email_mimic.html',
+        template = load_template(self.env, 'ticket_email_mimic.html',
                 cls=MarkupTemplate)
         if template:
             stream = template.generate(**data)
@@ -314,14 +331,58 @@ class WikiFormatter(Component):
                                          page.text.splitlines(), context=3):
                     diff += "%s\n" % line
                 data["diff"] = diff
-        chrome = Chrome(self.env)
-        dirs = []
-        for provider in chrome.template_providers:
-            dirs += provider.get_templates_dirs()
-        templates = TemplateLoader(dirs, variable_lookup='lenient')
-        template = templates.load('wiki_email_plaintext.txt',
+        template = load_template(self.env, 'wiki_email_plaintext.txt',
                 cls=NewTextTemplate)
         if template:
             stream = template.generate(**data)
             output = stream.render('text')
         return output
+
+
+class DigestFormatter(Component):
+    """Formats several events announced in a single message by joining
+    the plain text output of the formatters of each event.
+    """
+
+    implements(IAnnouncementFormatter)
+
+    formatters = ExtensionPoint(IAnnouncementFormatter)
+
+    def styles(self, transport, realm):
+        if realm == "digest":
+            yield "text/plain"
+
+    def alternative_style_for(self, transport, realm, style):
+        if realm == "digest" and style != "text/plain":
+            return "text/plain"
+
+    def format(self, transport, realm, style, event):
+        if realm == "digest" and style == "text/plain":
+            return self._format_plaintext(transport, event)
+
+    def _format_plaintext(self, transport, event):
+        entries = []
+        for evt in event.events:
+            formatter = self._formatter_for(transport, evt.realm)
+            if formatter is None:
+                self.log.warning("DigestFormatter has no plain text "
+                        "formatter for realm %s" % evt.realm)
+                continue
+            entries.append(to_unicode(format_event(formatter, transport,
+                    "text/plain", evt)))
+        data = dict(
+            entries = entries,
+            event = event,
+            project_name = self.env.project_name,
+            project_desc = self.env.project_description,
+            project_link = self.env.project_url or self.env.abs_href(),
+        )
+        template = load_template(self.env, 'digest_email_plaintext.txt')
+        return template.generate(**data).render('text')
+
+    def _formatter_for(self, transport, realm):
+        for formatter in self.formatters:
+            if formatter is self:
+                continue
+            if "text/plain" in formatter.styles(transport, realm):
+                return formatter
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Robert Corsaro
+# Copyright (c) 2010, Steffen Hoffmann
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+
+"""Timing of the stages of the announcement pipeline.
+
+The pipeline reports how long each stage took to the `Metrics` component,
+which passes the measurements on to the sinks enabled with the
+`[announcer] metrics_sinks` option.  Without sinks, nothing is recorded.
+
+Stage names are dotted paths, e.g. `resolve.matches.WatchSubscriber` or
+`format.TicketFormatter.text_plain`.
+"""
+
+import re
+import socket
+import threading
+
+from trac.config import IntOption, Option, OrderedExtensionsOption
+from trac.core import *
+
+
+class IAnnouncementMetricsSink(Interface):
+    """Receives the measurements of the announcement pipeline."""
+
+    def timing(name, seconds):
+        """Records that the stage `name` took `seconds`."""
+
+    def increment(name, count=1):
+        """Adds `count` to the counter `name`."""
+
+
+class Metrics(Component):
+    """Passes measurements to the enabled metrics sinks."""
+
+    sinks = OrderedExtensionsOption('announcer', 'metrics_sinks',
+        IAnnouncementMetricsSink, '',
+        include_missing=False,
+        doc="""Comma separated list of components receiving the timings of
+        the announcement pipeline stages, e.g. `InProcessMetricsSink` or
+        `StatsdMetricsSink`.  Empty disables the measurements.""")
+
+    def timing(self, name, seconds):
+        for sink in self.sinks:
+            try:
+                sink.timing(name, seconds)
+            except Exception, e:
+                self.log.debug("Metrics sink %s failed: %s"
+                        % (sink.__class__.__name__, e))
+
+    def increment(self, name, count=1):
+        for sink in self.sinks:
+            try:
+                sink.increment(name, count)
+            except Exception, e:
+                self.log.debug("Metrics sink %s failed: %s"
+                        % (sink.__class__.__name__, e))
+
+
+def metric_name(*parts):
+    """Joins the parts of a metric name, replacing the characters that
+    can't be used in statsd names."""
+    return '.'.join([re.sub(r'[^\w\-]', '_', str(part)) for part in parts])
+
+
+class Histogram(object):
+    """Count, sum, minimum, maximum and distribution of timings."""
+
+    # Upper bounds of the buckets in seconds.
+    bounds = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(self.bounds) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        for i, bound in enumerate(self.bounds):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    @property
+    def mean(self):
+        return self.count and self.total / self.count or 0.0
+
+
+class InProcessMetricsSink(Component):
+    """Keeps counters and timing histograms in memory, see `snapshot`."""
+
+    implements(IAnnouncementMetricsSink)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def timing(self, name, seconds):
+        self._lock.acquire()
+        try:
+            histogram = self._timings.get(name)
+            if histogram is None:
+                histogram = self._timings[name] = Histogram()
+            histogram.add(seconds)
+        finally:
+            self._lock.release()
+
+    def increment(self, name, count=1):
+        self._lock.acquire()
+        try:
+            self._counters[name] = self._counters.get(name, 0) + count
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Returns a `(counters, timings)` tuple of dictionaries, the latter
+        mapping stage names to `Histogram`s."""
+        self._lock.acquire()
+        try:
+            return dict(self._counters), dict(self._timings)
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """Forgets the measurements taken so far."""
+        self._lock.acquire()
+        try:
+            self._counters = {}
+            self._timings = {}
+        finally:
+            self._lock.release()
+
+
+class StatsdMetricsSink(Component):
+    """Sends the measurements to a statsd server over UDP."""
+
+    implements(IAnnouncementMetricsSink)
+
+    host = Option('announcer', 'statsd_host', 'localhost',
+        """Host of the statsd server receiving the announcement metrics.""")
+
+    port = IntOption('announcer', 'statsd_port', 8125,
+        """Port of the statsd server receiving the announcement metrics.""")
+
+    prefix = Option('announcer', 'statsd_prefix', 'trac.announcer',
+        """Prefix of the names of the metrics sent to statsd.""")
+
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, name, seconds):
+        self._send('%s:%d|ms' % (self._name(name), round(seconds * 1000)))
+
+    def increment(self, name, count=1):
+        self._send('%s:%d|c' % (self._name(name), count))
+
+    def _name(self, name):
+        return self.prefix and '%s.%s' % (self.prefix, name) or name
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data, (self.host, self.port))
+        except socket.error, e:
+            self.log.debug("StatsdMetricsSink failed to send %s: %s"
+                    % (data, e))
@@ -36,9 +36,460 @@
 # checking for unauthenticated users should be done against the 'anonymous'
 # user.
 
+import threading
+import weakref
+
+from trac.util import hex_entropy
 from trac.util.datefmt import utc
+from trac.util.text import to_unicode
+
+__all__ = ['Subscription', 'SubscriptionAttribute', 'begin_prefetch',
+           'end_prefetch', 'subscription_generation']
+
+# Maximum number of values passed to a single IN clause, well below the
+# limit of 999 bind parameters of SQLite.
+_MAX_IN_ARGS = 400
+
+def _chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+_prefetch = threading.local()
+
+def begin_prefetch(env, keys, db=None):
+    """Load the subscription data named by `keys` in a few queries and
+    answer the matching `Subscription` and `SubscriptionAttribute` lookups
+    of the current thread from memory until `end_prefetch` is called.
+
+    Keys are tuples of the following forms:
+     * ('class', klass): all subscriptions of a class
+     * ('sid', klass, sid): the subscriptions of a user for a class
+     * ('realm', klass, realm): all subscription attributes of a realm
+     * ('target', klass, realm, target): the subscription attributes of a
+       single target
+
+    The subscriptions of every user found in the loaded attributes are
+    fetched too.  Lookups that are not covered by the keys still go to the
+    database.
+
+    When the subscription cache is enabled, the cache is checked for changes
+    once and then serves all lookups until `end_prefetch`.
+
+    Nested calls only load what the enclosing call didn't.
+    """
+    stack = getattr(_prefetch, 'stack', None)
+    if stack is None:
+        stack = _prefetch.stack = []
+    if stack and stack[-1].env is env:
+        scope = stack[-1]
+        scope.extend(keys, db)
+        stack.append(scope)
+        return
+    cache = _get_cache(env)
+    scope = []
+    @env.with_transaction(db)
+    def do_select(db):
+        if cache is not None:
+            classes = set([key[1] for key in keys])
+            scope.append(_CacheScope(cache, cache.get(db, classes)))
+        else:
+            index = _SubscriptionIndex(env)
+            index.load(db.cursor(), keys)
+            scope.append(index)
+    stack.append(scope[0])
+
+def end_prefetch(env):
+    """Drop the data loaded by the matching `begin_prefetch` call."""
+    stack = getattr(_prefetch, 'stack', None)
+    if stack and stack[-1].env is env:
+        stack.pop()
+
+def _lookup_index(env, klass, db):
+    """Returns the in-memory index that answers lookups for `klass`, or
+    `None` if the database has to be queried.
+    """
+    if db is not None:
+        # the caller is in the middle of a transaction that may have
+        # changed the subscriptions
+        return None
+    stack = getattr(_prefetch, 'stack', None)
+    if stack and stack[-1].env is env:
+        return stack[-1].index_for(klass)
+    cache = _get_cache(env)
+    if cache is not None:
+        return cache.get(env.get_db_cnx(), (klass,))
+
+
+_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+def _get_cache(env):
+    if not env.config.getbool('announcer', 'subscription_cache', False):
+        return None
+    _caches_lock.acquire()
+    try:
+        cache = _caches.get(env)
+        if cache is None:
+            cache = _caches[env] = _SubscriptionCache(env)
+        return cache
+    finally:
+        _caches_lock.release()
+
+def _generation_name(klass):
+    return 'announcer_subscription_generation:' + klass
+
+def _get_generations(db, classes):
+    """Returns the generation tokens of `classes`, by class name."""
+    generations = dict.fromkeys(classes)
+    names = dict([(_generation_name(k), k) for k in classes])
+    cursor = db.cursor()
+    for chunk in _chunks(sorted(names), _MAX_IN_ARGS):
+        cursor.execute("""
+            SELECT name, value
+              FROM system
+             WHERE name IN (%s)
+        """ % ','.join(['%s'] * len(chunk)), chunk)
+        for name, value in cursor.fetchall():
+            generations[names[name]] = value
+    return generations
+
+def subscription_generation(env, klass, db=None):
+    """Returns a token that changes whenever the subscriptions or
+    subscription attributes of `klass` are changed, in any process.
+
+    Components can use it to tell whether data they derived from the
+    subscriptions of `klass` is still current.
+    """
+    if db is None:
+        db = env.get_db_cnx()
+    return _get_generations(db, (klass,))[klass]
+
+def _subscriptions_changed(env, db, classes):
+    """Invalidate the cached subscriptions of `classes` in all processes.
+    Called by the methods changing subscriptions, in their transaction.
+    """
+    classes = set([k for k in classes if k])
+    cursor = db.cursor()
+    for klass in classes:
+        generation = hex_entropy(16)
+        cursor.execute("""
+            UPDATE system
+               SET value=%s
+             WHERE name=%s
+        """, (generation, _generation_name(klass)))
+        if cursor.rowcount < 1:
+            cursor.execute("""
+                INSERT INTO system (name, value)
+                     VALUES (%s, %s)
+            """, (_generation_name(klass), generation))
+    _caches_lock.acquire()
+    try:
+        cache = _caches.get(env)
+    finally:
+        _caches_lock.release()
+    if cache is not None:
+        cache.clear(classes)
+
+def _classes_of_sid(cursor, sid, authenticated, distributor=None):
+    """Returns the classes of the subscriptions of a user, which are all
+    affected when the priorities or formats of the user change."""
+    sql = """
+        SELECT DISTINCT class
+          FROM subscription
+         WHERE sid=%s
+           AND authenticated=%s"""
+    args = [sid, authenticated]
+    if distributor is not None:
+        sql += " AND distributor=%s"
+        args.append(distributor)
+    cursor.execute(sql, args)
+    return [row[0] for row in cursor.fetchall()]
+
+
+class _SubscriptionCache(object):
+    """Subscriptions and subscription attributes of the classes used so far,
+    shared by all threads of the process.
+
+    Each class is checked against a generation token in the system table,
+    which every change to the subscriptions of the class replaces.
+    """
 
-__all__ = ['Subscription', 'SubscriptionAttribute']
+    def __init__(self, env):
+        self.env = env
+        self.lock = threading.Lock()
+        self.index = _SubscriptionIndex(env)
+        self.generations = {}
+
+    def get(self, db, classes):
+        """Returns an index holding all data of `classes`, loading what is
+        missing or has been changed.
+        """
+        # read the generations first, so that changes made while loading
+        # cause another reload
+        generations = _get_generations(db, classes)
+        self.lock.acquire()
+        try:
+            changed = [k for k in classes if k in self.index.classes and
+                       generations[k] != self.generations.get(k)]
+            if changed:
+                self._drop(changed)
+            return self._load(db, generations)
+        finally:
+            self.lock.release()
+
+    def extend(self, index, classes):
+        """Add `classes` to `index`, without checking for changes of the
+        classes already in `index`."""
+        db = self.env.get_db_cnx()
+        generations = _get_generations(db, classes)
+        self.lock.acquire()
+        try:
+            # the index may have been replaced by a change meanwhile
+            return self._load(db, generations)
+        finally:
+            self.lock.release()
+
+    def clear(self, classes):
+        self.lock.acquire()
+        try:
+            self._drop(classes)
+        finally:
+            self.lock.release()
+
+    def _drop(self, classes):
+        # lookups in progress keep using the old index
+        self.index = self.index.without(classes)
+        for klass in classes:
+            self.generations.pop(klass, None)
+
+    def _load(self, db, generations):
+        missing = [k for k in generations if k not in self.index.classes]
+        if missing:
+            self.index.load_classes(db.cursor(), missing)
+            for klass in missing:
+                self.generations[klass] = generations[klass]
+        return self.index
+
+
+class _CacheScope(object):
+    """Serves the lookups of a prefetch scope from the subscription cache."""
+
+    def __init__(self, cache, index):
+        self.env = cache.env
+        self.cache = cache
+        self.index = index
+
+    def index_for(self, klass):
+        if klass not in self.index.classes:
+            self.index = self.cache.extend(self.index, (klass,))
+        return self.index
+
+    def extend(self, keys, db=None):
+        classes = set([key[1] for key in keys]) - self.index.classes
+        if classes:
+            self.index = self.cache.extend(self.index, classes)
+
+
+class _SubscriptionIndex(object):
+    """In-memory index over a subset of the subscription tables."""
+
+    def __init__(self, env):
+        self.env = env
+        # what has been loaded
+        self.classes = set()
+        self.attribute_classes = set()
+        self.sids = set()
+        self.realms = set()
+        self.targets = set()
+        # the loaded rows
+        self.by_class = {}
+        self.by_sid = {}
+        self.by_realm = {}
+        self.by_target = {}
+        # data computed from the loaded rows, see
+        # `SubscriptionAttribute.derive_by_class_and_realm`
+        self.derived = {}
+
+    def extend(self, keys, db=None):
+        keys = [key for key in keys if not self.covers(key)]
+        if keys:
+            @self.env.with_transaction(db)
+            def do_select(db):
+                self.load(db.cursor(), keys)
+
+    def covers(self, key):
+        """Whether the data named by `key` has been loaded."""
+        klass = key[1]
+        if key[0] == 'class':
+            return klass in self.classes
+        elif key[0] == 'sid':
+            return klass in self.classes or \
+                (klass, to_unicode(key[2])) in self.sids
+        elif key[0] == 'realm':
+            return klass in self.attribute_classes or \
+                (klass, key[2]) in self.realms
+        elif key[0] == 'target':
+            return klass in self.attribute_classes or \
+                (klass, key[2]) in self.realms or \
+                (klass, key[2], to_unicode(key[3])) in self.targets
+        return False
+
+    def load(self, cursor, keys):
+        """Load the data named by `keys`, which must not have been loaded
+        before."""
+        classes, sid_classes, sids = set(), set(), set()
+        realms, targets = set(), {}
+        for key in keys:
+            if key[0] == 'class':
+                classes.add(key[1])
+            elif key[0] == 'sid':
+                if key[2]:
+                    sid_classes.add(key[1])
+                    sids.add(to_unicode(key[2]))
+            elif key[0] == 'realm':
+                realms.add((key[1], key[2]))
+            elif key[0] == 'target':
+                targets.setdefault((key[1], key[2]), set()).add(
+                    to_unicode(key[3]))
+
+        clauses = [('(class=%s AND realm=%s)', list(realm))
+                   for realm in realms]
+        for realm, values in targets.items():
+            if realm in realms:
+                continue
+            for chunk in _chunks(sorted(values), _MAX_IN_ARGS - 2):
+                clauses.append(('(class=%%s AND realm=%%s AND target IN (%s))'
+                                % ','.join(['%s'] * len(chunk)),
+                                list(realm) + chunk))
+        for row in self._select(cursor, """
+                SELECT id, sid, authenticated, class, realm, target
+                  FROM subscription_attribute
+                 WHERE """, clauses):
+            row = tuple(row)
+            klass, realm, target = row[3:6]
+            if (klass, realm) in realms:
+                self.by_realm.setdefault((klass, realm), []).append(row)
+            if not self.covers(('target', klass, realm, target)):
+                self.by_target.setdefault((klass, realm, target),
+                                          []).append(row)
+            if row[1]:
+                sid_classes.add(klass)
+                sids.add(row[1])
+        self.realms.update(realms)
+        for (klass, realm), values in targets.items():
+            self.targets.update([(klass, realm, v) for v in values])
+
+        clauses = []
+        if classes:
+            clauses.append(('class IN (%s)' % ','.join(['%s'] * len(classes)),
+                            list(classes)))
+        sid_classes = list(sid_classes - classes)
+        if sid_classes and sids:
+            size = max(_MAX_IN_ARGS - len(sid_classes), 1)
+            for chunk in _chunks(sorted(sids), size):
+                clauses.append(('(class IN (%s) AND sid IN (%s))'
+                                % (','.join(['%s'] * len(sid_classes)),
+                                   ','.join(['%s'] * len(chunk))),
+                                sid_classes + chunk))
+        for row in self._select(cursor, """
+                SELECT id, sid, authenticated, distributor,
+                       format, priority, adverb, class
+                  FROM subscription
+                 WHERE """, clauses):
+            row = tuple(row)
+            klass = row[7]
+            if klass in classes:
+                self.by_class.setdefault(klass, []).append(row)
+            if not self.covers(('sid', klass, row[1])):
+                self.by_sid.setdefault((klass, row[1], row[2]), []).append(row)
+        self.classes.update(classes)
+        self.sids.update([(k, s) for k in sid_classes for s in sids])
+
+    def load_classes(self, cursor, classes):
+        """Load all subscriptions and attributes of `classes`."""
+        classes = set(classes)
+        clauses = [('class IN (%s)' % ','.join(['%s'] * len(chunk)), chunk)
+                   for chunk in _chunks(sorted(classes), _MAX_IN_ARGS)]
+        for row in self._select(cursor, """
+                SELECT id, sid, authenticated, class, realm, target
+                  FROM subscription_attribute
+                 WHERE """, list(clauses)):
+            row = tuple(row)
+            klass, realm, target = row[3:6]
+            self.by_realm.setdefault((klass, realm), []).append(row)
+            self.by_target.setdefault((klass, realm, target), []).append(row)
+        for row in self._select(cursor, """
+                SELECT id, sid, authenticated, distributor,
+                       format, priority, adverb, class
+                  FROM subscription
+                 WHERE """, list(clauses)):
+            row = tuple(row)
+            klass = row[7]
+            self.by_class.setdefault(klass, []).append(row)
+            self.by_sid.setdefault((klass, row[1], row[2]), []).append(row)
+        self.attribute_classes.update(classes)
+        self.classes.update(classes)
+
+    def index_for(self, klass):
+        return self
+
+    def without(self, classes):
+        """Returns a copy of the index without the data of `classes`."""
+        classes = set(classes)
+        def keep(keys):
+            return [k for k in keys if k[0] not in classes]
+        index = _SubscriptionIndex(self.env)
+        index.classes = self.classes - classes
+        index.attribute_classes = self.attribute_classes - classes
+        index.sids = set(keep(self.sids))
+        index.realms = set(keep(self.realms))
+        index.targets = set(keep(self.targets))
+        index.by_class = dict([(k, v) for k, v in self.by_class.items()
+                               if k not in classes])
+        for name in ('by_sid', 'by_realm', 'by_target', 'derived'):
+            rows = getattr(self, name)
+            setattr(index, name, dict([(k, rows[k]) for k in keep(rows)]))
+        return index
+
+    def _select(self, cursor, sql, clauses):
+        """Run `sql` for the OR of `clauses`, using as few queries as the
+        parameter limit allows."""
+        rows = []
+        while clauses:
+            batch, params = [], []
+            while clauses and (not batch or
+                    len(params) + len(clauses[0][1]) <= _MAX_IN_ARGS):
+                clause, args = clauses.pop(0)
+                batch.append(clause)
+                params.extend(args)
+            cursor.execute(sql + ' OR '.join(batch), params)
+            rows.extend(cursor.fetchall())
+        return rows
+
+    def subscriptions_by_class(self, klass):
+        if klass in self.classes:
+            return self.by_class.get(klass, [])
+
+    def subscriptions_by_sids(self, uids, klass):
+        rows = []
+        for sid, authenticated in set(uids):
+            sid = to_unicode(sid)
+            if klass not in self.classes and (klass, sid) not in self.sids:
+                return None
+            rows.extend(self.by_sid.get((klass, sid, authenticated), []))
+        return rows
+
+    def attributes_by_realm(self, klass, realm):
+        if klass in self.attribute_classes or (klass, realm) in self.realms:
+            return self.by_realm.get((klass, realm), [])
+
+    def attributes_by_target(self, klass, realm, target):
+        target = to_unicode(target)
+        if klass in self.attribute_classes or \
+                (klass, realm) in self.realms or \
+                (klass, realm, target) in self.targets:
+            return self.by_target.get((klass, realm, target), [])
 
 class Subscription(object):
 
@@ -59,6 +510,19 @@ class Subscription(object):
             raise KeyError(name)
         self.values[name] = value
 
+    @classmethod
+    def _from_row(cls, env, row):
+        sub = Subscription(env)
+        sub['id'] = row[0]
+        sub['sid'] = row[1]
+        sub['authenticated'] = row[2]
+        sub['distributor'] = row[3]
+        sub['format'] = row[4]
+        sub['priority'] = int(row[5])
+        sub['adverb'] = row[6]
+        sub['class'] = row[7]
+        return sub
+
     @classmethod
     def add(cls, env, subscription, db=None):
         """id and priority overwritten."""
@@ -77,6 +541,7 @@ class Subscription(object):
             subscription['distributor'], subscription['format'],
             int(priority), subscription['adverb'],
             subscription['class']))
+            _subscriptions_changed(env, db, (subscription['class'],))
 
     @classmethod
     def delete(cls, env, rule_id, db=None):
@@ -89,6 +554,8 @@ class Subscription(object):
              WHERE id=%s
             """, (rule_id,))
             sid, authenticated, distributor = cursor.fetchone()
+            classes = _classes_of_sid(cursor, sid, authenticated,
+                                      distributor)
             cursor.execute("""
             DELETE FROM subscription
                   WHERE id = %s
@@ -98,6 +565,7 @@ class Subscription(object):
                 s['priority'] = i
                 s._update_priority(db)
                 i += 1
+            _subscriptions_changed(env, db, classes)
 
     @classmethod
     def move(cls, env, rule_id, priority, db=None):
@@ -126,6 +594,8 @@ class Subscription(object):
                     s['priority'] = i
                     s._update_priority(db)
                 i+=1
+            _subscriptions_changed(env, db, _classes_of_sid(cursor, sid,
+                                   authenticated, distributor))
 
     @classmethod
     def update_format_by_distributor_and_sid(cls, env, distributor, sid, authenticated, format, db=None):
@@ -139,6 +609,8 @@ class Subscription(object):
                AND sid=%s
                AND authenticated=%s
             """, (format, distributor, sid, authenticated))
+            _subscriptions_changed(env, db, _classes_of_sid(cursor, sid,
+                                   authenticated, distributor))
 
     @classmethod
     def find_by_sid_and_distributor(cls, env, sid, authenticated, distributor, db=None):
@@ -176,36 +648,55 @@ class Subscription(object):
         if not uids:
             return []
 
+        index = _lookup_index(env, klass, db)
+        if index is not None:
+            rows = index.subscriptions_by_sids(uids, klass)
+            if rows is not None:
+                return [cls._from_row(env, row) for row in rows]
+
         subs = []
+        # look up all sids with the same authentication in one go instead of
+        # issuing a query per user
+        sids_by_auth = {}
+        for sid, authenticated in uids:
+            sids_by_auth.setdefault(authenticated, set()).add(sid)
 
         @env.with_transaction(db)
         def do_select(db):
             cursor = db.cursor()
-            for sid, authenticated in uids:
-                cursor.execute("""
-                    SELECT id, sid, authenticated, distributor,
-                           format, priority, adverb, class
-                      FROM subscription
-                     WHERE class=%s
-                       AND sid = %s
-                       AND authenticated = %s
-                """, (klass,sid,authenticated))
-                for i in cursor.fetchall():
-                    sub = Subscription(env)
-                    sub['id'] = i[0]
-                    sub['sid'] = i[1]
-                    sub['authenticated'] = i[2]
-                    sub['distributor'] = i[3]
-                    sub['format'] = i[4]
-                    sub['priority'] = int(i[5])
-                    sub['adverb'] = i[6]
-                    sub['class'] = i[7]
-                    subs.append(sub)
+            for authenticated, sids in sids_by_auth.items():
+                for chunk in _chunks(sorted(sids), _MAX_IN_ARGS):
+                    cursor.execute("""
+                        SELECT id, sid, authenticated, distributor,
+                               format, priority, adverb, class
+                          FROM subscription
+                         WHERE class=%%s
+                           AND authenticated=%%s
+                           AND sid IN (%s)
+                    """ % ','.join(['%s'] * len(chunk)),
+                    [klass, authenticated] + chunk)
+                    for i in cursor.fetchall():
+                        sub = Subscription(env)
+                        sub['id'] = i[0]
+                        sub['sid'] = i[1]
+                        sub['authenticated'] = i[2]
+                        sub['distributor'] = i[3]
+                        sub['format'] = i[4]
+                        sub['priority'] = int(i[5])
+                        sub['adverb'] = i[6]
+                        sub['class'] = i[7]
+                        subs.append(sub)
 
         return subs
 
     @classmethod
     def find_by_class(cls, env, klass, db=None):
+        index = _lookup_index(env, klass, db)
+        if index is not None:
+            rows = index.subscriptions_by_class(klass)
+            if rows is not None:
+                return [cls._from_row(env, row) for row in rows]
+
         subs = []
 
         @env.with_transaction(db)
@@ -273,6 +764,17 @@ class SubscriptionAttribute(object):
             raise KeyError(name)
         self.values[name] = value
 
+    @classmethod
+    def _from_row(cls, env, row):
+        attr = SubscriptionAttribute(env)
+        attr['id'] = row[0]
+        attr['sid'] = row[1]
+        attr['authenticated'] = row[2]
+        attr['class'] = row[3]
+        attr['realm'] = row[4]
+        attr['target'] = row[5]
+        return attr
+
     @classmethod
     def add(cls, env, sid, authenticated, klass, realm, attributes, db=None):
         """id and priority overwritten."""
@@ -285,6 +787,7 @@ class SubscriptionAttribute(object):
                             (sid, authenticated, class, realm, target)
                      VALUES (%s, %s, %s, %s, %s)
                 """, (sid, authenticated, klass, realm, a))
+            _subscriptions_changed(env, db, (klass,))
 
     @classmethod
     def delete(cls, env, attribute_id, db=None):
@@ -292,9 +795,16 @@ class SubscriptionAttribute(object):
         def do_delete(db):
             cursor = db.cursor()
             cursor.execute("""
+            SELECT class
+              FROM subscription_attribute
+             WHERE id=%s
+            """, (attribute_id,))
+            classes = [row[0] for row in cursor.fetchall()]
+            cursor.execute("""
             DELETE FROM subscription_attribute
                   WHERE id = %s
             """, (attribute_id,))
+            _subscriptions_changed(env, db, classes)
 
     @classmethod
     def delete_by_sid_and_class(cls, env, sid, authenticated, klass, db=None):
@@ -307,6 +817,7 @@ class SubscriptionAttribute(object):
                     AND authenticated = %s
                     AND class = %s
             """, (sid, authenticated, klass))
+            _subscriptions_changed(env, db, (klass,))
 
     @classmethod
     def delete_by_sid_class_and_target(cls, env, sid, authenticated, klass, target, db=None):
@@ -320,6 +831,7 @@ class SubscriptionAttribute(object):
                     AND class = %s
                     AND target = %s
             """, (sid, authenticated, klass, target))
+            _subscriptions_changed(env, db, (klass,))
 
     @classmethod
     def delete_by_class_realm_and_target(cls, env, klass, realm, target, db=None):
@@ -332,6 +844,7 @@ class SubscriptionAttribute(object):
                     AND class = %s
                     AND target = %s
             """, (realm, klass, target))
+            _subscriptions_changed(env, db, (klass,))
 
     @classmethod
     def find_by_sid_and_class(cls, env, sid, authenticated, klass, db=None):
@@ -419,6 +932,12 @@ class SubscriptionAttribute(object):
 
     @classmethod
     def find_by_class_realm_and_target(cls, env, klass, realm, target, db=None):
+        index = _lookup_index(env, klass, db)
+        if index is not None:
+            rows = index.attributes_by_target(klass, realm, target)
+            if rows is not None:
+                return [cls._from_row(env, row) for row in rows]
+
         attrs = []
 
         @env.with_transaction(db)
@@ -443,8 +962,35 @@ class SubscriptionAttribute(object):
 
         return attrs
 
+    @classmethod
+    def derive_by_class_and_realm(cls, env, klass, realm, name, build):
+        """Returns `build(attributes)` for the attributes of `klass` in
+        `realm`.
+
+        With the subscription cache, the result is kept until the
+        subscriptions change, so `build` can prepare data structures that
+        would be too expensive to build for every lookup.  `name` tells
+        apart the results of different `build` functions.
+        """
+        index = _lookup_index(env, klass, None)
+        if index is not None:
+            rows = index.attributes_by_realm(klass, realm)
+            if rows is not None:
+                key = (klass, realm, name)
+                if key not in index.derived:
+                    index.derived[key] = build([cls._from_row(env, row)
+                                                for row in rows])
+                return index.derived[key]
+        return build(cls.find_by_class_and_realm(env, klass, realm))
+
     @classmethod
     def find_by_class_and_realm(cls, env, klass, realm, db=None):
+        index = _lookup_index(env, klass, db)
+        if index is not None:
+            rows = index.attributes_by_realm(klass, realm)
+            if rows is not None:
+                return [cls._from_row(env, row) for row in rows]
+
         attrs = []
 
         @env.with_transaction(db)
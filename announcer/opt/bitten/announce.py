@@ -30,15 +30,15 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
 from trac.core import *
-from trac.web.chrome import Chrome
 
-from genshi.template import NewTextTemplate, TemplateLoader
+from genshi.template import NewTextTemplate
 
 from announcer.api import AnnouncementSystem, AnnouncementEvent
 from announcer.api import IAnnouncementFormatter, IAnnouncementSubscriber
 from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import _
 from announcer.distributors.mail import IAnnouncementEmailDecorator
+from announcer.formatters import load_template
 from announcer.util.mail import set_header, next_decorator
 from announcer.util.settings import BoolSubscriptionSetting
 
@@ -195,12 +195,7 @@ class BittenAnnouncement(Component):
                 'descr': self.env.project_description
             }
         }
-        chrome = Chrome(self.env)
-        dirs = []
-        for provider in chrome.template_providers:
-            dirs += provider.get_templates_dirs()
-        templates = TemplateLoader(dirs, variable_lookup='lenient')
-        template = templates.load('bitten_plaintext.txt', 
+        template = load_template(self.env, 'bitten_plaintext.txt',
                 cls=NewTextTemplate)
         if template:
             stream = template.generate(**data)
@@ -34,18 +34,21 @@ import re
 from trac.config import BoolOption, Option
 from trac.core import *
 from trac.web.api import IRequestFilter, IRequestHandler
-from trac.web.chrome import Chrome, add_notice, add_ctxtnav
+from trac.web.chrome import add_notice, add_ctxtnav
 
 from genshi.builder import tag
-from genshi.template import NewTextTemplate, TemplateLoader
+from genshi.template import NewTextTemplate
 
 from announcer.api import AnnouncementSystem, AnnouncementEvent
 from announcer.api import IAnnouncementFormatter, IAnnouncementSubscriber
+from announcer.api import IAnnouncementPrefetchingSubscriber
 from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import _
 from announcer.distributors.mail import IAnnouncementEmailDecorator
+from announcer.formatters import load_template
 from announcer.model import Subscription, SubscriptionAttribute
 from announcer.util.mail import set_header, next_decorator
+from announcer.util.mail import subject_template
 
 from tracfullblog.api import IBlogChangeListener
 from tracfullblog.model import BlogPost, BlogComment
@@ -75,6 +78,7 @@ class FullBlogAllSubscriber(Component):
     """Subscriber for any blog changes."""
 
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
 
     def matches(self, event):
         if event.realm != 'blog':
@@ -91,6 +95,10 @@ class FullBlogAllSubscriber(Component):
         for i in Subscription.find_by_class(self.env, klass):
             yield i.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'blog':
+            yield ('class', self.__class__.__name__)
+
     def description(self):
         return _("notify me when any blog is modified, "
                 "changed, deleted or commented on.")
@@ -100,6 +108,7 @@ class FullBlogNewSubscriber(Component):
     """Subscriber for any blog post creation."""
 
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
 
     def matches(self, event):
         if event.realm != 'blog':
@@ -111,6 +120,10 @@ class FullBlogNewSubscriber(Component):
         for i in Subscription.find_by_class(self.env, klass):
             yield i.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'blog':
+            yield ('class', self.__class__.__name__)
+
     def description(self):
         return "notify me when any blog post is created."
 
@@ -119,6 +132,7 @@ class FullBlogMyPostSubscriber(Component):
     """Subscriber for any blog changes to my posts."""
 
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
 
     always_notify_author = BoolOption('fullblog-announcement',
             'always_notify_author', 'true',
@@ -141,6 +155,10 @@ class FullBlogMyPostSubscriber(Component):
         for i in Subscription.find_by_sids_and_class(self.env, sids, klass):
             yield i.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'blog':
+            yield ('sid', self.__class__.__name__, event.blog_post.author)
+
     def description(self):
         return _("notify me when any blog that I posted "
             "is modified or commented on.")
@@ -149,6 +167,7 @@ class FullBlogWatchSubscriber(Component):
     """Subscriber to watch individual blogs."""
 
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
     implements(IRequestFilter)
     implements(IRequestHandler)
 
@@ -173,6 +192,11 @@ class FullBlogWatchSubscriber(Component):
         for i in Subscription.find_by_sids_and_class(self.env, sids, klass):
             yield i.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'blog':
+            yield ('target', self.__class__.__name__, 'blog',
+                    event.blog_post.name)
+
     def description(self):
         return "notify me when a blog that I'm watching changes."
 
@@ -243,6 +267,7 @@ class FullBlogBloggerSubscriber(Component):
     """Subscriber for any blog changes to bloggers that I follow."""
 
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
     implements(IAnnouncementPreferenceProvider)
 
     def matches(self, event):
@@ -265,6 +290,11 @@ class FullBlogBloggerSubscriber(Component):
         for i in Subscription.find_by_sids_and_class(self.env, sids, klass):
             yield i.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'blog':
+            yield ('target', self.__class__.__name__, 'blog',
+                    event.blog_post.author)
+
     def description(self):
         return "notify me when any blogger that I follow has a blog update."
 
@@ -385,7 +415,7 @@ class FullBlogAnnouncement(Component):
     # IAnnouncementEmailDecorator
     def decorate_message(self, event, message, decorates=None):
         if event.realm == "blog":
-            template = NewTextTemplate(self.blog_email_subject.encode('utf8'))
+            template = subject_template(self.blog_email_subject)
             subject = template.generate(
                 blog=event.blog_post,
                 action=event.category
@@ -421,15 +451,8 @@ class FullBlogAnnouncement(Component):
             body = blog_post.body,
             comment = event.comment,
         )
-        chrome = Chrome(self.env)
-        dirs = []
-        for provider in chrome.template_providers:
-            dirs += provider.get_templates_dirs()
-        templates = TemplateLoader(dirs, variable_lookup='lenient')
-        template = templates.load(
-            'fullblog_plaintext.txt',
-            cls=NewTextTemplate
-        )
+        template = load_template(self.env, 'fullblog_plaintext.txt',
+                cls=NewTextTemplate)
         if template:
             stream = template.generate(**data)
             output = stream.render('text')
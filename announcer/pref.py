@@ -115,7 +115,8 @@ class SubscriptionManagementPanel(Component):
             'add-rule': self._add_rule,
             'delete-rule': self._delete_rule,
             'move-rule': self._move_rule,
-            'set-format': self._set_format
+            'set-format': self._set_format,
+            'set-digest': self._set_digest
         }
 
     def get_htdocs_dirs(self):
@@ -150,6 +151,10 @@ class SubscriptionManagementPanel(Component):
         data['formatters'] = ('text/plain', 'text/html')
         data['selected_format'] = {}
         data['adverbs'] = ('always', 'never')
+        data['digests'] = (('', _('immediately')),
+                           ('hourly', _('hourly digest')),
+                           ('daily', _('daily digest')))
+        data['selected_digest'] = {}
 
         for i in self.subscribers:
             if not i.description():
@@ -166,6 +171,8 @@ class SubscriptionManagementPanel(Component):
         for i in self.distributors:
             for j in i.transports():
                 data['rules'][j] = []
+                data['selected_digest'][j] = req.session.get(
+                        'announcer_digest_%s'%j, '')
                 for r in Subscription.find_by_sid_and_distributor(self.env,
                         req.session.sid, req.session.authenticated, j):
                     if desc_map.get(r['class']):
@@ -223,3 +230,11 @@ class SubscriptionManagementPanel(Component):
         Subscription.update_format_by_distributor_and_sid(self.env, arg,
                 req.session.sid, req.session.authenticated,
                 req.args['format-%s'%arg])
+
+    def _set_digest(self, arg, req):
+        schedule = req.args.get('digest-%s'%arg)
+        if schedule:
+            req.session['announcer_digest_%s'%arg] = schedule
+        elif 'announcer_digest_%s'%arg in req.session:
+            del req.session['announcer_digest_%s'%arg]
+        req.session.save()
@@ -30,11 +30,14 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
 
-from trac.attachment import IAttachmentChangeListener
+from datetime import datetime
+
+from trac.attachment import Attachment, IAttachmentChangeListener
 from trac.config import BoolOption
 from trac.core import *
 from trac.ticket.api import ITicketChangeListener
 from trac.ticket.model import Ticket
+from trac.util.datefmt import from_utimestamp, to_utimestamp
 from trac.wiki.api import IWikiChangeListener
 from trac.wiki.model import WikiPage
 
@@ -72,6 +75,15 @@ class AttachmentChangeProducer(Component):
     def attachment_deleted(self, attachment):
         pass
 
+def _attachment_state(attachment):
+    if attachment is not None:
+        return (attachment.parent_realm, attachment.parent_id,
+                attachment.filename)
+
+def _restore_attachment(env, state):
+    if state is not None:
+        return Attachment(env, *state)
+
 class TicketChangeEvent(AnnouncementEvent):
     def __init__(self, realm, category, target,
                  comment=None, author=None, changes={},
@@ -97,6 +109,55 @@ class TicketChangeEvent(AnnouncementEvent):
         if session_id == ticket['reporter']:
             yield "reporter"
 
+    def get_coalesce_key(self):
+        if self.category in ('created', 'changed'):
+            return (self.realm, self.target.id)
+
+    def coalesce(self, later):
+        if later.category != 'changed' or later.author != self.author or \
+                later.get_coalesce_key() != self.get_coalesce_key():
+            return None
+        if self.category == 'created':
+            # the new ticket is announced with its latest values
+            if later.comment:
+                return None
+            return TicketChangeEvent(self.realm, self.category, later.target,
+                                     author=self.author)
+        # keep the oldest value of each field, and drop the fields that
+        # were changed back
+        changes = dict(later.changes)
+        changes.update(self.changes)
+        for name, old_value in changes.items():
+            if old_value == later.target[name]:
+                del changes[name]
+        comment = '\n\n'.join([c for c in (self.comment, later.comment) if c])
+        return TicketChangeEvent(self.realm, self.category, later.target,
+                                 comment, self.author, changes)
+
+    def get_state(self):
+        state = AnnouncementEvent.get_state(self)
+        # keep the field values of the ticket as they were when the event
+        # happened, a later change may already be in the database
+        values = {}
+        for name, value in self.target.values.items():
+            if isinstance(value, datetime):
+                value = (to_utimestamp(value),)
+            values[name] = value
+        state['target'] = (self.target.id, values)
+        state['attachment'] = _attachment_state(self.attachment)
+        return state
+
+    def set_state(self, env, state):
+        tkt_id, values = state.pop('target')
+        ticket = Ticket(env, tkt_id)
+        for name, value in values.items():
+            if isinstance(value, tuple):
+                value = from_utimestamp(value[0])
+            ticket.values[name] = value
+        state['target'] = ticket
+        state['attachment'] = _restore_attachment(env, state['attachment'])
+        AnnouncementEvent.set_state(self, env, state)
+
 class TicketChangeProducer(Component):
     implements(ITicketChangeListener, IAnnouncementProducer)
 
@@ -147,6 +208,23 @@ class WikiChangeEvent(AnnouncementEvent):
         self.remote_addr = remote_addr
         self.attachment = attachment
 
+    def get_state(self):
+        state = AnnouncementEvent.get_state(self)
+        state['target'] = (self.target.name, self.target.version)
+        # the tzinfo of trac's datetimes can't be unpickled
+        if self.timestamp is not None:
+            state['timestamp'] = to_utimestamp(self.timestamp)
+        state['attachment'] = _attachment_state(self.attachment)
+        return state
+
+    def set_state(self, env, state):
+        name, version = state.pop('target')
+        state['target'] = WikiPage(env, name, version)
+        if state['timestamp'] is not None:
+            state['timestamp'] = from_utimestamp(state['timestamp'])
+        state['attachment'] = _restore_attachment(env, state['attachment'])
+        AnnouncementEvent.set_state(self, env, state)
+
 class WikiChangeProducer(Component):
     implements(IWikiChangeListener, IAnnouncementProducer)
 
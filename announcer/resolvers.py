@@ -50,6 +50,14 @@ class DefaultDomainEmailResolver(Component):
             return '%s@%s' % (name, self.default_domain)
         return None
 
+    def get_addresses_for_names(self, names, attributes):
+        addresses = {}
+        if self.default_domain:
+            for name, authenticated in names:
+                addresses[(name, authenticated)] = '%s@%s' % (name,
+                        self.default_domain)
+        return addresses
+
 class SessionEmailResolver(Component):
     implements(IAnnouncementAddressResolver)
 
@@ -68,6 +76,14 @@ class SessionEmailResolver(Component):
             return result[0]
         return None
 
+    def get_addresses_for_names(self, names, attributes):
+        addresses = {}
+        for name, authenticated in names:
+            addr = attributes.get(name, authenticated, 'email')
+            if addr:
+                addresses[(name, authenticated)] = addr
+        return addresses
+
 class SpecifiedEmailResolver(Component):
     implements(IAnnouncementAddressResolver, IAnnouncementPreferenceProvider)
 
@@ -86,6 +102,14 @@ class SpecifiedEmailResolver(Component):
             return result[0]
         return None
 
+    def get_addresses_for_names(self, names, attributes):
+        addresses = {}
+        for name, authenticated in names:
+            addr = attributes.get(name, 1, 'announcer_specified_email')
+            if addr:
+                addresses[(name, authenticated)] = addr
+        return addresses
+
     # IAnnouncementDistributor
     def get_announcement_preference_boxes(self, req):
         if req.authname != "anonymous":
@@ -34,9 +34,9 @@
 # TODO: Test all anonymous subscribers
 # TODO: Subscriptions admin page
 
-import re, urllib
+import re, threading, urllib
 
-from fnmatch import fnmatch
+from fnmatch import translate
 
 from trac.config import BoolOption, Option, ListOption
 from trac.core import *
@@ -52,10 +52,12 @@ from trac.wiki.api import IWikiChangeListener
 from genshi.builder import tag
 
 from announcer.api import IAnnouncementDefaultSubscriber
+from announcer.api import IAnnouncementPrefetchingSubscriber
 from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import IAnnouncementSubscriber
 from announcer.api import _, istrue
 from announcer.model import Subscription, SubscriptionAttribute
+from announcer.model import subscription_generation
 from announcer.util.settings import BoolSubscriptionSetting
 from announcer.util.settings import SubscriptionSetting
 
@@ -93,6 +95,7 @@ will probably be lowest priority.
 class AllTicketSubscriber(Component):
     """Subscriber for all ticket changes."""
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
 
     def description(self):
         return _("notify me when any ticket changes")
@@ -107,6 +110,10 @@ class AllTicketSubscriber(Component):
         for i in Subscription.find_by_class(self.env, klass):
             yield i.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'ticket':
+            yield ('class', self.__class__.__name__)
+
     def requires_authentication(self):
         return False
 
@@ -114,6 +121,7 @@ class AllTicketSubscriber(Component):
 class TicketOwnerSubscriber(Component):
     """Allows ticket owners to subscribe to their tickets."""
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
     implements(IAnnouncementDefaultSubscriber)
 
     default_on = BoolOption("announcer", "always_notify_owner", 'true',
@@ -155,6 +163,10 @@ class TicketOwnerSubscriber(Component):
                 yield s.subscription_tuple()
 
 
+    def subscription_keys(self, event):
+        if event.realm == 'ticket':
+            yield ('sid', self.__class__.__name__, event.target['owner'])
+
     def description(self):
         return _("notify me when a ticket that I own is created or modified")
 
@@ -173,6 +185,7 @@ class TicketComponentOwnerSubscriber(Component):
     """
     implements(IAnnouncementDefaultSubscriber)
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
 
     default_on = BoolOption("announcer", "always_notify_component_owner",
         'true',
@@ -217,6 +230,15 @@ class TicketComponentOwnerSubscriber(Component):
         except:
             self.log.debug("Component for ticket (%s) not found"%ticket['id'])
 
+    def subscription_keys(self, event):
+        if event.realm == 'ticket' and event.target['component']:
+            try:
+                component = model.Component(self.env,
+                        event.target['component'])
+            except ResourceNotFound:
+                return
+            yield ('sid', self.__class__.__name__, component.owner)
+
     def description(self):
         return _("notify me when a ticket that belongs to a component "
                 "that I own is created or modified")
@@ -234,6 +256,7 @@ class TicketUpdaterSubscriber(Component):
     """Allows updaters to subscribe to their own updates."""
     implements(IAnnouncementDefaultSubscriber)
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
 
     default_on = BoolOption("announcer", "never_notify_updater", 'false',
         """The never_notify_updater stops users from recieving announcements
@@ -270,6 +293,10 @@ class TicketUpdaterSubscriber(Component):
                     ((sid,auth),), klass):
                 yield s.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'ticket':
+            yield ('sid', self.__class__.__name__, event.author)
+
     def description(self):
         return _("notify me when I update a ticket")
 
@@ -284,6 +311,7 @@ class TicketUpdaterSubscriber(Component):
 class TicketReporterSubscriber(Component):
     """Allows the users to subscribe to tickets that they report."""
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
     implements(IAnnouncementDefaultSubscriber)
 
     default_on = BoolOption("announcer", "always_notify_reporter", 'true',
@@ -323,6 +351,10 @@ class TicketReporterSubscriber(Component):
                     ((sid,auth),), klass):
                 yield s.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'ticket':
+            yield ('sid', self.__class__.__name__, event.target['reporter'])
+
     def description(self):
         return _("notify me when a ticket that I reported is modified")
 
@@ -339,6 +371,7 @@ class CarbonCopySubscriber(Component):
     """Carbon copy subscriber for cc ticket field."""
     implements(IAnnouncementDefaultSubscriber)
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
 
     default_on = BoolOption("announcer", "always_notify_cc", 'true',
         """The always_notify_cc will notify the users in the cc field by
@@ -381,6 +414,12 @@ class CarbonCopySubscriber(Component):
         for s in Subscription.find_by_sids_and_class(self.env, sids, klass):
             yield s.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'ticket':
+            klass = self.__class__.__name__
+            for chunk in re.split('\s|,', event.target['cc'] or ''):
+                yield ('sid', klass, chunk.strip())
+
     def description(self):
         return _("notify me when I'm listed in the CC field of a ticket "
                  "that is modified")
@@ -399,6 +438,7 @@ class TicketComponentSubscriber(Component):
     choice.
     """
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
     implements(IAnnouncementPreferenceProvider)
 
     def matches(self, event):
@@ -420,6 +460,11 @@ class TicketComponentSubscriber(Component):
         for i in Subscription.find_by_sids_and_class(self.env, sids, klass):
             yield i.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'ticket' and event.target['component']:
+            yield ('target', self.__class__.__name__, 'ticket',
+                    event.target['component'])
+
     def description(self):
         return _("notify me when a ticket associated with " \
                 "a component I'm watching is modified")
@@ -471,6 +516,7 @@ class TicketCustomFieldSubscriber(Component):
     """
     implements(IAnnouncementDefaultSubscriber)
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
 
     custom_cc_fields = ListOption('announcer', 'custom_cc_fields',
             doc="Field names that contain users that should be notified on "
@@ -520,6 +566,13 @@ class TicketCustomFieldSubscriber(Component):
         for i in Subscription.find_by_sids_and_class(self.env, sids, klass):
             yield i.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'ticket':
+            klass = self.__class__.__name__
+            for field in self.custom_cc_fields:
+                for chunk in re.split('\s|,', event.target[field] or ''):
+                    yield ('sid', klass, chunk.strip())
+
     def description(self):
         if self.custom_cc_fields:
             return _("notify me when I'm listed in any of the (%s) "
@@ -541,6 +594,7 @@ class JoinableGroupSubscriber(Component):
     field will trigger announcements to users in the group.
     """
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
     implements(IAnnouncementPreferenceProvider)
 
     joinable_groups = ListOption('announcer', 'joinable_groups', [],
@@ -579,6 +633,14 @@ class JoinableGroupSubscriber(Component):
         for i in Subscription.find_by_sids_and_class(self.env, sids, klass):
             yield i.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'ticket':
+            klass = self.__class__.__name__
+            for chunk in re.split('\s|,', event.target['cc'] or ''):
+                chunk = chunk.strip()
+                if chunk.startswith('@'):
+                    yield ('target', klass, 'ticket', chunk[1:])
+
     def description(self):
         return _("notify me on ticket changes in one of my subscribed groups")
 
@@ -625,6 +687,7 @@ class UserChangeSubscriber(Component):
     triggers an event.
     """
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
     implements(IAnnouncementPreferenceProvider)
 
     def matches(self, event):
@@ -637,6 +700,9 @@ class UserChangeSubscriber(Component):
         for i in Subscription.find_by_sids_and_class(self.env, sids, klass):
             yield i.subscription_tuple()
 
+    def subscription_keys(self, event):
+        yield ('target', self.__class__.__name__, 'user', event.author)
+
     def description(self):
         return _("notify me when one of my watched users changes something")
 
@@ -681,6 +747,7 @@ class WatchSubscriber(Component):
     implements(IRequestFilter)
     implements(IRequestHandler)
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
     implements(ITicketChangeListener)
     implements(IWikiChangeListener)
 
@@ -694,6 +761,15 @@ class WatchSubscriber(Component):
 
     path_match = re.compile(r'/watch(/.*)')
 
+    # Maximum number of users whose watched resources are kept in memory
+    # for the watch links.
+    watch_cache_size = 1000
+
+    def __init__(self):
+        self._watches = {}
+        self._watches_lock = threading.Lock()
+        self._watchable = (None, None)
+
     # IRequestHandler methods
     def match_request(self, req):
         m = self.path_match.match(req.path_info)
@@ -710,13 +786,25 @@ class WatchSubscriber(Component):
         realm, target = self.path_info_to_realm_target(path_info)
 
         req.perm.require('%s_VIEW' % realm.upper())
-        self.toggle_watched(req.session.sid, req.session.authenticated,
-                realm, target, req)
+        # the links tell what to do, so a link rendered before the watches
+        # changed elsewhere doesn't do the opposite of what it says
+        action = req.args.get('action')
+        if action in ('watch', 'unwatch'):
+            self._set_watched(req.session.sid, req.session.authenticated,
+                    realm, target, action == 'watch', req)
+        else:
+            self.toggle_watched(req.session.sid, req.session.authenticated,
+                    realm, target, req)
 
         req.redirect(req.href(realm, target))
 
     def toggle_watched(self, sid, authenticated, realm, target, req=None):
-        if self.is_watching(sid, authenticated, realm, target):
+        self._set_watched(sid, authenticated, realm, target,
+                not self.is_watching(sid, authenticated, realm, target), req)
+
+    def _set_watched(self, sid, authenticated, realm, target, watch,
+                     req=None):
+        if not watch:
             self.set_unwatch(sid, authenticated, realm, target)
             self._schedule_notice(req, _('You are no longer receiving ' \
                     'change notifications about this resource.'))
@@ -726,7 +814,8 @@ class WatchSubscriber(Component):
                     'change notifications about this resource.'))
 
     def _schedule_notice(self, req, message):
-        req.session['_announcer_watch_message_'] = message
+        if req is not None:
+            req.session['_announcer_watch_message_'] = message
 
     def _add_notice(self, req):
         if '_announcer_watch_message_' in req.session:
@@ -743,17 +832,58 @@ class WatchSubscriber(Component):
             return False
 
     def set_watch(self, sid, authenticated, realm, target):
+        if self.is_watching(sid, authenticated, realm, target):
+            return
         klass = self.__class__.__name__
         SubscriptionAttribute.add(self.env, sid, authenticated, klass,
                 realm, (target,))
 
     def set_unwatch(self, sid, authenticated, realm, target):
         klass = self.__class__.__name__
-        (attr,) = SubscriptionAttribute.find_by_sid_class_realm_and_target(
-                self.env, sid, authenticated, klass, realm, target)
-        if attr:
+        for attr in SubscriptionAttribute.find_by_sid_class_realm_and_target(
+                self.env, sid, authenticated, klass, realm, target):
             SubscriptionAttribute.delete(self.env, attr['id'])
 
+    def _get_watches(self, sid, authenticated):
+        """Returns the set of (realm, target) tuples the user watches,
+        from memory unless the watches have been changed since they were
+        loaded, in any process."""
+        uid = (sid, authenticated and 1 or 0)
+        klass = self.__class__.__name__
+        # read the generation first, so that changes made while loading
+        # cause another load
+        generation = subscription_generation(self.env, klass)
+        self._watches_lock.acquire()
+        try:
+            entry = self._watches.get(uid)
+        finally:
+            self._watches_lock.release()
+        if entry and entry[0] == generation:
+            return entry[1]
+        watches = frozenset([(attr['realm'], to_unicode(attr['target']))
+                for attr in SubscriptionAttribute.find_by_sid_and_class(
+                    self.env, sid, authenticated, klass)])
+        self._watches_lock.acquire()
+        try:
+            if len(self._watches) >= self.watch_cache_size:
+                self._watches.clear()
+            self._watches[uid] = (generation, watches)
+        finally:
+            self._watches_lock.release()
+        return watches
+
+    def _is_watchable(self, path):
+        """Whether `path` matches one of the `watchable_paths` globs."""
+        patterns = tuple(self.watchable_paths)
+        if self._watchable[0] != patterns:
+            regexp = None
+            if patterns:
+                regexp = re.compile('|'.join(['(?:%s)' % translate(p)
+                                              for p in patterns]))
+            self._watchable = (patterns, regexp)
+        regexp = self._watchable[1]
+        return regexp is not None and regexp.match(path) is not None
+
     # IRequestFilter methods
     def pre_process_request(self, req, handler):
         return handler
@@ -762,13 +892,11 @@ class WatchSubscriber(Component):
         self._add_notice(req)
 
         if req.authname != "anonymous" or 'email' in req.session:
-            for pattern in self.watchable_paths:
-                realm, target = self.path_info_to_realm_target(req.path_info)
-                if fnmatch('%s/%s'%(realm,target), pattern):
-                    if '%s_VIEW'%realm.upper() not in req.perm:
-                        return (template, data, content_type)
-                    self.render_watcher(req)
-                    break
+            realm, target = self.path_info_to_realm_target(req.path_info)
+            if self._is_watchable('%s/%s'%(realm,target)):
+                if '%s_VIEW'%realm.upper() not in req.perm:
+                    return (template, data, content_type)
+                self.render_watcher(req)
         return (template, data, content_type)
 
     # Internal methods
@@ -776,16 +904,19 @@ class WatchSubscriber(Component):
         if not self.ctxtnav_names:
           return
         realm, target = self.path_info_to_realm_target(req.path_info)
-        if self.is_watching(req.session.sid, req.session.authenticated,
-                realm, target):
+        if (realm, to_unicode(target)) in self._get_watches(req.session.sid,
+                req.session.authenticated):
+            action = 'unwatch'
             action_name = len(self.ctxtnav_names) >= 2 and \
                     self.ctxtnav_names[1] or 'Unwatch This'
         else:
+            action = 'watch'
             action_name = len(self.ctxtnav_names) and \
                     self.ctxtnav_names[0] or 'Watch This'
         add_ctxtnav(req,
             tag.a(
-                _(action_name), href=req.href.watch(realm, target)
+                _(action_name), href=req.href.watch(realm, target,
+                                                    action=action)
             )
         )
 
@@ -843,6 +974,10 @@ class WatchSubscriber(Component):
         for i in Subscription.find_by_sids_and_class(self.env, sids, klass):
             yield i.subscription_tuple()
 
+    def subscription_keys(self, event):
+        yield ('target', self.__class__.__name__, event.realm,
+                self._get_target_id(event.target))
+
     def description(self):
         return _("notify me when one of my watched wiki or tickets is updated")
 
@@ -858,6 +993,96 @@ class WatchSubscriber(Component):
             tid = str(target)
         return tid
 
+class WikiPatternIndex(object):
+    """Finds the users whose wiki watch patterns match a page name.
+
+    Patterns match the beginning of the name, `*` matching anything.
+    Patterns without other regular expression syntax are kept in a trie of
+    their characters.  The others are joined into regular expressions with
+    a lookahead group per pattern, so a single match tells all patterns
+    that match the name.
+    """
+
+    _regex_syntax = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+    # Patterns with backreferences can't be joined, their group numbers
+    # would change.
+    _backreference = re.compile(r'\\[1-9]|\(\?P=')
+
+    # Python's re module supports at most 100 groups per expression.
+    max_groups = 99
+
+    def __init__(self, attributes, log=None):
+        self.trie = {}
+        patterns = {}
+        for attr in attributes:
+            uid = (attr['sid'], attr['authenticated'])
+            for raw in (attr['target'] or '').split(' '):
+                if raw == '':
+                    continue
+                pat = urllib.unquote(raw).replace('*', '.*')
+                prefix = pat
+                while prefix.endswith('.*'):
+                    prefix = prefix[:-2]
+                if not self._regex_syntax.search(prefix):
+                    node = self.trie
+                    for c in prefix:
+                        node = node.setdefault(c, {})
+                    node.setdefault(None, set()).add(uid)
+                    continue
+                try:
+                    re.compile(pat)
+                except re.error, e:
+                    if log:
+                        log.warning("Ignoring invalid wiki pattern '%s' of "
+                                    "%s: %s" % (pat, uid[0], e))
+                    continue
+                patterns.setdefault(pat, set()).add(uid)
+        # (regexp, [(group, uids)]) tuples
+        self.combined = []
+        # (regexp, uids) tuples of the patterns that are tried one by one
+        self.patterns = []
+        joinable = []
+        for pat, uids in sorted(patterns.items()):
+            if self._backreference.search(pat):
+                self.patterns.append((re.compile(pat), uids))
+            else:
+                joinable.append((pat, uids))
+        for i in range(0, len(joinable), self.max_groups):
+            chunk = joinable[i:i + self.max_groups]
+            groups = [('p%d' % j, uids) for j, (pat, uids) in enumerate(chunk)]
+            try:
+                regexp = re.compile(''.join(['(?:(?=(?P<p%d>%s)))?' % (j, pat)
+                                             for j, (pat, uids)
+                                             in enumerate(chunk)]))
+            except (re.error, AssertionError):
+                # e.g. too many groups with the ones of the patterns
+                self.patterns.extend([(re.compile(pat), uids)
+                                      for pat, uids in chunk])
+                continue
+            self.combined.append((regexp, groups))
+
+    def match(self, name):
+        """Returns the set of (sid, authenticated) tuples of the users with
+        a pattern matching `name`."""
+        node = self.trie
+        uids = set(node.get(None, ()))
+        for c in name:
+            node = node.get(c)
+            if node is None:
+                break
+            uids.update(node.get(None, ()))
+        for regexp, groups in self.combined:
+            m = regexp.match(name)
+            for group, group_uids in groups:
+                if m.group(group) is not None:
+                    uids.update(group_uids)
+        for regexp, pattern_uids in self.patterns:
+            if regexp.match(name):
+                uids.update(pattern_uids)
+        return uids
+
+
 class GeneralWikiSubscriber(Component):
     """Allows users to subscribe to wiki announcements based on a pattern
     that they define.  Any wiki announcements whose page name matches the
@@ -865,8 +1090,14 @@ class GeneralWikiSubscriber(Component):
     """
 
     implements(IAnnouncementSubscriber)
+    implements(IAnnouncementPrefetchingSubscriber)
     implements(IAnnouncementPreferenceProvider)
 
+    def __init__(self):
+        # (generation, WikiPatternIndex) of the watch patterns
+        self._index = (None, None)
+        self._index_lock = threading.Lock()
+
     def matches(self, event):
         if event.realm != 'wiki':
             return
@@ -876,21 +1107,38 @@ class GeneralWikiSubscriber(Component):
 
         klass = self.__class__.__name__
 
-        attrs = SubscriptionAttribute.find_by_class_and_realm(
-                self.env, klass, 'wiki')
-
-        def match(pattern):
-            for raw in pattern['target'].split(' '):
-                if raw != '':
-                    pat = urllib.unquote(raw).replace('*', '.*')
-                    if re.match(pat, event.target.name):
-                        return True
-
-        sids = set(map(lambda x: (x['sid'],x['authenticated']), filter(match, attrs)))
+        sids = self._get_index().match(event.target.name)
 
         for i in Subscription.find_by_sids_and_class(self.env, sids, klass):
             yield i.subscription_tuple()
 
+    def subscription_keys(self, event):
+        if event.realm == 'wiki':
+            yield ('realm', self.__class__.__name__, 'wiki')
+
+    def _get_index(self):
+        """Returns the index of the watch patterns, which is built again
+        only after the patterns have been changed, in any process."""
+        klass = self.__class__.__name__
+        # read the generation first, so that changes made while building
+        # cause another build
+        generation = subscription_generation(self.env, klass)
+        self._index_lock.acquire()
+        try:
+            built, index = self._index
+        finally:
+            self._index_lock.release()
+        if index is not None and built == generation:
+            return index
+        index = WikiPatternIndex(SubscriptionAttribute.
+                find_by_class_and_realm(self.env, klass, 'wiki'), self.log)
+        self._index_lock.acquire()
+        try:
+            self._index = (generation, index)
+        finally:
+            self._index_lock.release()
+        return index
+
 
     def description(self):
         return _("notify me when a wiki that matches my wiki watch pattern "
@@ -31,10 +31,18 @@
 
 import unittest
 
+from announcer.tests import digests, metrics, model, outbox, producers, \
+                            smtp, subscribers
+
 def suite():
     suite = unittest.TestSuite()
-    suite.addTest(ticket_compat.suite())
-    suite.addTest(ticket_formatter.suite())
+    suite.addTest(digests.suite())
+    suite.addTest(metrics.suite())
+    suite.addTest(model.suite())
+    suite.addTest(outbox.suite())
+    suite.addTest(producers.suite())
+    suite.addTest(smtp.suite())
+    suite.addTest(subscribers.suite())
     return suite
 
 if __name__ == '__main__':
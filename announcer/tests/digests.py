@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+from email.MIMEText import MIMEText
+
+from trac.core import *
+from trac.test import EnvironmentStub, Mock
+from trac.web.api import RequestDone
+from trac.web.href import Href
+from trac.web.session import DetachedSession
+from trac.ticket.model import Ticket
+
+from announcer.api import AnnouncementDigestEvent, AnnouncementSystem, \
+                          IAnnouncementDistributor, serialize_events
+from announcer.email_decorators import DigestSubjectEmailDecorator
+from announcer.formatters import DigestFormatter
+from announcer.pref import SubscriptionManagementPanel
+from announcer.producers import TicketChangeEvent
+
+class TestDistributor(Component):
+    """Records the announcements it is asked to distribute."""
+
+    implements(IAnnouncementDistributor)
+
+    def __init__(self):
+        self.sent = []
+
+    def transports(self):
+        return ['test']
+
+    def distribute(self, transport, recipients, event):
+        self.sent.append((sorted(recipients), event))
+
+class DigestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                enable=['trac.*', 'announcer.api.*', TestDistributor])
+        self.announcer = AnnouncementSystem(self.env)
+        self.announcer.upgrade_environment(self.env.get_db_cnx())
+        # the digest thread isn't needed, digests are flushed by the tests
+        self.announcer._start_digest_thread = lambda: None
+        self.distributor = TestDistributor(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _set_schedule(self, sid, schedule):
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO session_attribute (sid, authenticated, name,
+                                               value)
+                     VALUES (%s, 1, 'announcer_digest_test', %s)
+            """, (sid, schedule))
+
+    def _event(self, summary):
+        ticket = Ticket(self.env)
+        ticket['summary'] = summary
+        ticket['reporter'] = 'joe'
+        ticket.insert()
+        return TicketChangeEvent('ticket', 'created', ticket)
+
+    def _digest(self, sid, time, evt):
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO announcement_digest
+                            (time, sid, authenticated, distributor, address,
+                             data)
+                     VALUES (%s, %s, 1, 'test', NULL, %s)
+            """, (time, sid, serialize_events([evt])))
+
+    def _rows(self):
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT sid, owner FROM announcement_digest")
+        return cursor.fetchall()
+
+    def test_without_digest_users(self):
+        evt = self._event('One')
+        self.announcer._distribute(evt, [('test', 'joe', 1, None, None)])
+        self.assertEqual([[('joe', 1, None)]],
+                         [r for r, e in self.distributor.sent])
+        self.assertEqual([], self._rows())
+
+    def test_digest_users_are_looked_up_once_per_batch(self):
+        self._set_schedule('joe', 'daily')
+        first, second = self._event('One'), self._event('Two')
+        second._caches = first._caches = {}
+        self.announcer._distribute(first, [('test', 'joe', 1, None, None)])
+        # a schedule set in the middle of a batch applies to the next one
+        self._set_schedule('ann', 'hourly')
+        self.announcer._distribute(second, [('test', 'joe', 1, None, None),
+                                            ('test', 'ann', 1, None, None)])
+        self.assertEqual([[('ann', 1, None)]],
+                         [r for r, e in self.distributor.sent])
+        self.assertEqual([('joe', None), ('joe', None)], self._rows())
+
+    def test_flush_due_digests(self):
+        self._set_schedule('joe', 'hourly')
+        self._set_schedule('ann', 'hourly')
+        now = 7300
+        self._digest('joe', 10, self._event('One'))
+        self._digest('joe', 20, self._event('Two'))
+        # collected in the current hour, not due yet
+        self._digest('ann', now - 10, self._event('Three'))
+        self.assertEqual(1, self.announcer._flush_digests(now))
+        ((recipients, evt),) = self.distributor.sent
+        self.assertEqual([('joe', 1, None)], recipients)
+        self.assertTrue(isinstance(evt, AnnouncementDigestEvent))
+        self.assertEqual(['One', 'Two'],
+                         [e.target['summary'] for e in evt.events])
+        self.assertEqual([('ann', None)], self._rows())
+
+    def test_flush_without_schedule(self):
+        # the user stopped collecting digests, send what is pending
+        self._digest('joe', 7000, self._event('One'))
+        self.assertEqual(1, self.announcer._flush_digests(7200))
+        self.assertEqual([], self._rows())
+
+    def test_send_single_event(self):
+        self._digest('joe', 10, self._event('One'))
+        self.assertTrue(self.announcer._send_digest('joe', 1, 'test', 7200))
+        ((recipients, evt),) = self.distributor.sent
+        self.assertEqual('One', evt.target['summary'])
+        self.assertEqual([], self._rows())
+
+    def test_send_claimed_digest(self):
+        self._digest('joe', 10, self._event('One'))
+        @self.env.with_transaction()
+        def do_claim(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE announcement_digest SET owner='other', claimed=7000
+            """)
+        self.assertFalse(self.announcer._send_digest('joe', 1, 'test', 7200))
+        self.assertEqual([], self.distributor.sent)
+        self.assertEqual([('joe', 'other')], self._rows())
+
+class DigestPreferenceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+                enable=['trac.*', 'announcer.api.*', 'announcer.pref.*',
+                        TestDistributor])
+        AnnouncementSystem(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.panel = SubscriptionManagementPanel(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _post(self, schedule):
+        def redirect(url):
+            raise RequestDone
+        req = Mock(method='POST', href=Href('/trac'), redirect=redirect,
+                   session=DetachedSession(self.env, 'joe'),
+                   args={'method': 'set-digest_test',
+                         'digest-test': schedule})
+        self.assertRaises(RequestDone, self.panel.render_preference_panel,
+                          req, 'subscriptions')
+        return DetachedSession(self.env, 'joe')
+
+    def test_set_digest(self):
+        session = self._post('daily')
+        self.assertEqual('daily', session.get('announcer_digest_test'))
+
+    def test_clear_digest(self):
+        self._post('hourly')
+        session = self._post('')
+        self.assertFalse('announcer_digest_test' in session)
+
+class DigestFormatterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'announcer.*'])
+        created = Ticket(self.env)
+        created['summary'] = 'New one'
+        created['reporter'] = 'joe'
+        created.insert()
+        changed = Ticket(self.env)
+        changed['summary'] = 'Old one'
+        changed['reporter'] = 'joe'
+        changed.insert()
+        changed['status'] = 'closed'
+        changed['resolution'] = 'fixed'
+        changed.save_changes('ann', 'Done')
+        self.event = AnnouncementDigestEvent([
+            TicketChangeEvent('ticket', 'created', created, author='joe'),
+            TicketChangeEvent('ticket', 'changed', changed, comment='Done',
+                              author='ann',
+                              changes={'status': 'new', 'resolution': ''})])
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _subject(self):
+        message = MIMEText('Body')
+        DigestSubjectEmailDecorator(self.env).decorate_message(self.event,
+                                                               message, [])
+        return str(message['Subject'])
+
+    def test_format(self):
+        output = DigestFormatter(self.env).format('email', 'digest',
+                                                  'text/plain', self.event)
+        first, second, footer = output.split('=' * 78)
+        self.assertTrue('#1: New one' in first)
+        self.assertFalse('Changes' in first)
+        self.assertTrue('#2: Old one' in second)
+        self.assertTrue("Status from 'new' to 'closed'" in second)
+        self.assertTrue('Done' in second)
+        self.assertTrue('My Project URL: <http://example.org/trac.cgi>'
+                        in footer)
+
+    def test_subject(self):
+        self.assertEqual('[My Project] 2 changes', self._subject())
+
+    def test_custom_subject(self):
+        self.env.config.set('announcer', 'email_subject_prefix', '')
+        self.env.config.set('announcer', 'digest_email_subject',
+                "${len([e for e in events if e.category == 'created'])} "
+                "new, ${len(events)} changes")
+        self.assertEqual('1 new, 2 changes', self._subject())
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(DigestTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(DigestPreferenceTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(DigestFormatterTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
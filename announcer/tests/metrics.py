@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+
+import socket
+import threading
+import unittest
+
+from trac.test import EnvironmentStub
+
+from announcer.metrics import *
+
+class InProcessMetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'announcer.*'])
+        self.env.config.set('announcer', 'metrics_sinks',
+                            'InProcessMetricsSink')
+        self.sink = InProcessMetricsSink(self.env)
+
+    def test_disabled(self):
+        self.env.config.set('announcer', 'metrics_sinks', '')
+        Metrics(self.env).timing('send', 0.5)
+        self.assertEqual(({}, {}), self.sink.snapshot())
+
+    def test_timing(self):
+        metrics = Metrics(self.env)
+        metrics.timing('send', 0.002)
+        metrics.timing('send', 0.2)
+        metrics.increment('recipients.email', 3)
+        counters, timings = self.sink.snapshot()
+        self.assertEqual({'recipients.email': 3}, counters)
+        histogram = timings['send']
+        self.assertEqual(2, histogram.count)
+        self.assertEqual(0.002, histogram.min)
+        self.assertEqual(0.2, histogram.max)
+        self.assertAlmostEqual(0.101, histogram.mean)
+        self.assertEqual(1, histogram.buckets[1])
+        self.assertEqual(1, histogram.buckets[5])
+
+    def test_reset(self):
+        Metrics(self.env).increment('recipients.email')
+        # reset waits for measurements that are being recorded
+        self.sink._lock.acquire()
+        thread = threading.Thread(target=self.sink.reset)
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.isAlive())
+        self.sink._lock.release()
+        thread.join()
+        self.assertEqual(({}, {}), self.sink.snapshot())
+
+    def test_metric_name(self):
+        self.assertEqual('format.TicketFormatter.text_plain',
+                         metric_name('format', 'TicketFormatter',
+                                     'text/plain'))
+
+class StatsdMetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.settimeout(5)
+        self.env = EnvironmentStub(enable=['trac.*', 'announcer.*'])
+        self.env.config.set('announcer', 'metrics_sinks',
+                            'StatsdMetricsSink')
+        self.env.config.set('announcer', 'statsd_host', '127.0.0.1')
+        self.env.config.set('announcer', 'statsd_port',
+                            str(self.listener.getsockname()[1]))
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_timing(self):
+        Metrics(self.env).timing('email.deliver', 0.25)
+        self.assertEqual('trac.announcer.email.deliver:250|ms',
+                         self.listener.recv(1024))
+
+    def test_increment(self):
+        self.env.config.set('announcer', 'statsd_prefix', '')
+        Metrics(self.env).increment('recipients.email', 4)
+        self.assertEqual('recipients.email:4|c', self.listener.recv(1024))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(InProcessMetricsTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(StatsdMetricsTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+from trac.core import *
+from trac.test import EnvironmentStub
+from trac.ticket.model import Ticket
+
+from announcer.api import AnnouncementSystem, SubscriptionResolver
+from announcer.model import *
+from announcer.producers import TicketChangeEvent
+import announcer.subscribers
+
+class CountingCursor(object):
+    def __init__(self, cursor, queries):
+        self.cursor = cursor
+        self.queries = queries
+
+    def execute(self, sql, args=None):
+        self.queries.append(sql)
+        return self.cursor.execute(sql, args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+class CountingConnection(object):
+    def __init__(self, db):
+        self.db = db
+        self.queries = []
+
+    def cursor(self):
+        return CountingCursor(self.db.cursor(), self.queries)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+class SubscriptionTestBase(unittest.TestCase):
+    subscription_cache = 'false'
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'announcer.*'])
+        self.env.config.set('announcer', 'subscription_cache',
+                            self.subscription_cache)
+        AnnouncementSystem(self.env).upgrade_environment(self.env.get_db_cnx())
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _add(self, sid, authenticated=1, klass='CarbonCopySubscriber'):
+        sub = Subscription(self.env)
+        sub['sid'] = sid
+        sub['authenticated'] = authenticated
+        sub['distributor'] = 'email'
+        sub['format'] = 'text/plain'
+        sub['adverb'] = 'always'
+        sub['class'] = klass
+        Subscription.add(self.env, sub)
+
+    def _count_queries(self, func, *args):
+        db = self.env.db
+        self.env.db = CountingConnection(db)
+        try:
+            result = func(*args)
+            return result, len(self.env.db.queries)
+        finally:
+            self.env.db = db
+
+    def _ticket_event(self, cc):
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'Test'
+        ticket['reporter'] = 'reporter'
+        ticket['owner'] = 'owner'
+        ticket['cc'] = ', '.join(cc)
+        ticket.insert()
+        return TicketChangeEvent('ticket', 'changed', ticket,
+                                 author='updater')
+
+class SubscriptionTestCase(SubscriptionTestBase):
+    def test_find_by_sids_and_class(self):
+        self._add('joe')
+        self._add('joe', 0)
+        self._add('bob')
+        self._add('bob', klass='TicketOwnerSubscriber')
+        subs = Subscription.find_by_sids_and_class(self.env,
+                (('joe', 1), ('bob', 1), ('alice', 1)), 'CarbonCopySubscriber')
+        self.assertEqual(set([('joe', 1), ('bob', 1)]),
+                set([(s['sid'], s['authenticated']) for s in subs]))
+        subs = Subscription.find_by_sids_and_class(self.env,
+                (('joe', 0), ('joe', 1)), 'CarbonCopySubscriber')
+        self.assertEqual(2, len(subs))
+        self.assertEqual([], Subscription.find_by_sids_and_class(self.env,
+                (), 'CarbonCopySubscriber'))
+
+    def test_find_by_sids_and_class_query_count(self):
+        """The number of queries doesn't grow with the number of sids."""
+        counts = []
+        for size in (1, 10, 40, 200):
+            uids = [('user%d' % i, 1) for i in range(size)]
+            subs, queries = self._count_queries(
+                Subscription.find_by_sids_and_class, self.env, uids,
+                'CarbonCopySubscriber')
+            counts.append(queries)
+        self.assertEqual([1, 1, 1, 1], counts)
+
+        for i in range(40):
+            self._add('user%d' % i)
+        uids = [('user%d' % i, 1) for i in range(40)]
+        subs, queries = self._count_queries(
+            Subscription.find_by_sids_and_class, self.env, uids,
+            'CarbonCopySubscriber')
+        self.assertEqual(40, len(subs))
+        self.assertEqual(1, queries)
+
+    def test_find_by_sids_and_class_chunks(self):
+        uids = [('user%d' % i, 1) for i in range(1000)]
+        self._add('user999')
+        subs, queries = self._count_queries(
+            Subscription.find_by_sids_and_class, self.env, uids,
+            'CarbonCopySubscriber')
+        self.assertEqual(['user999'], [s['sid'] for s in subs])
+        self.assertEqual(3, queries)
+
+    def test_resolver_query_count(self):
+        """Resolving an event takes the same number of queries, however
+        many users and subscribers are involved."""
+        for i in range(60):
+            self._add('user%d' % i)
+            self._add('user%d' % i, klass='TicketOwnerSubscriber')
+        self._add('owner', klass='TicketOwnerSubscriber')
+        self._add('updater', klass='AllTicketSubscriber')
+        SubscriptionAttribute.add(self.env, 'watcher', 1,
+                'WatchSubscriber', 'ticket', ('1',))
+        self._add('watcher', klass='WatchSubscriber')
+
+        resolver = SubscriptionResolver(self.env)
+        counts = []
+        for size in (60, 2):
+            event = self._ticket_event(['user%d' % i for i in range(size)])
+            subs, queries = self._count_queries(resolver.subscriptions, event)
+            counts.append(queries)
+            sids = set([s[1] for s in subs])
+            self.assertTrue('user%d' % (size - 1) in sids)
+            self.assertTrue('updater' in sids)
+            self.assertTrue('owner' in sids)
+            self.assertEqual(size == 60, 'watcher' in sids)
+        self.assertEqual(counts[0], counts[1])
+        self.assertTrue(counts[1] <= 4, counts)
+
+    def test_batch_query_count(self):
+        """The events of a batch look up the subscriptions together."""
+        for i in range(20):
+            self._add('user%d' % i)
+        self._add('updater', klass='AllTicketSubscriber')
+        announcer = AnnouncementSystem(self.env)
+        counts = []
+        for size in (1, 20):
+            tickets = [self._ticket_event(['user%d' % i]).target
+                       for i in range(size)]
+            def save_all():
+                announcer.begin_batch()
+                try:
+                    for ticket in tickets:
+                        ticket['summary'] = 'Changed'
+                        ticket.save_changes('updater', 'Bulk change')
+                finally:
+                    announcer.end_batch()
+            db = self.env.db
+            self.env.db = CountingConnection(db)
+            try:
+                save_all()
+                counts.append(len([q for q in self.env.db.queries
+                                   if 'subscription' in q]))
+            finally:
+                self.env.db = db
+        self.assertEqual(counts[0], counts[1])
+
+    def test_prefetch(self):
+        self._add('joe')
+        self._add('bob', klass='WatchSubscriber')
+        SubscriptionAttribute.add(self.env, 'bob', 1,
+                'WatchSubscriber', 'ticket', ('1', '2'))
+        begin_prefetch(self.env, [('sid', 'CarbonCopySubscriber', 'joe'),
+                                  ('target', 'WatchSubscriber', 'ticket', 1)])
+        try:
+            subs, queries = self._count_queries(
+                Subscription.find_by_sids_and_class, self.env,
+                [('joe', 1), ('joe', 0)], 'CarbonCopySubscriber')
+            self.assertEqual(0, queries)
+            self.assertEqual(['joe'], [s['sid'] for s in subs])
+            attrs, queries = self._count_queries(
+                SubscriptionAttribute.find_by_class_realm_and_target,
+                self.env, 'WatchSubscriber', 'ticket', '1')
+            self.assertEqual(0, queries)
+            self.assertEqual(['bob'], [a['sid'] for a in attrs])
+            # the users found in attributes are loaded as well
+            subs, queries = self._count_queries(
+                Subscription.find_by_sids_and_class, self.env,
+                [('bob', 1)], 'WatchSubscriber')
+            self.assertEqual(0, queries)
+            self.assertEqual(1, len(subs))
+            # lookups that weren't asked for go to the database
+            attrs, queries = self._count_queries(
+                SubscriptionAttribute.find_by_class_realm_and_target,
+                self.env, 'WatchSubscriber', 'ticket', '2')
+            self.assertEqual(1, queries)
+            self.assertEqual(['bob'], [a['sid'] for a in attrs])
+        finally:
+            end_prefetch(self.env)
+        subs, queries = self._count_queries(
+            Subscription.find_by_sids_and_class, self.env,
+            [('joe', 1)], 'CarbonCopySubscriber')
+        self.assertEqual(1, queries)
+
+class SubscriptionCacheTestCase(SubscriptionTestBase):
+    subscription_cache = 'true'
+
+    def test_cached_lookups(self):
+        self._add('joe')
+        self._add('bob', klass='AllTicketSubscriber')
+        subs, queries = self._count_queries(
+            Subscription.find_by_class, self.env, 'AllTicketSubscriber')
+        self.assertEqual(['bob'], [s['sid'] for s in subs])
+        # only the generation is checked once the class is cached
+        subs, queries = self._count_queries(
+            Subscription.find_by_class, self.env, 'AllTicketSubscriber')
+        self.assertEqual(['bob'], [s['sid'] for s in subs])
+        self.assertEqual(1, queries)
+        subs, queries = self._count_queries(
+            Subscription.find_by_sids_and_class, self.env,
+            [('joe', 1), ('bob', 1)], 'CarbonCopySubscriber')
+        self.assertEqual(['joe'], [s['sid'] for s in subs])
+
+    def test_invalidated_by_changes(self):
+        self._add('bob', klass='WatchSubscriber')
+        self.assertEqual([], SubscriptionAttribute.
+            find_by_class_realm_and_target(self.env, 'WatchSubscriber',
+                                           'ticket', '1'))
+        SubscriptionAttribute.add(self.env, 'bob', 1, 'WatchSubscriber',
+                                  'ticket', ('1',))
+        attrs = SubscriptionAttribute.find_by_class_realm_and_target(
+            self.env, 'WatchSubscriber', 'ticket', '1')
+        self.assertEqual(['bob'], [a['sid'] for a in attrs])
+        Subscription.delete(self.env, Subscription.find_by_class(
+            self.env, 'WatchSubscriber')[0]['id'])
+        self.assertEqual([], Subscription.find_by_class(self.env,
+                                                         'WatchSubscriber'))
+
+    def test_invalidated_by_other_process(self):
+        self._add('bob', klass='AllTicketSubscriber')
+        self.assertEqual(1, len(Subscription.find_by_class(self.env,
+                                                'AllTicketSubscriber')))
+        # change the subscriptions and the generation behind the back of
+        # the cache, like another process would
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM subscription")
+        cursor.execute("UPDATE system SET value='other' WHERE name="
+                "'announcer_subscription_generation:AllTicketSubscriber'")
+        db.commit()
+        self.assertEqual([], Subscription.find_by_class(self.env,
+                                                         'AllTicketSubscriber'))
+
+    def test_changes_invalidate_their_class(self):
+        self._add('joe')
+        self._add('bob', klass='AllTicketSubscriber')
+        Subscription.find_by_class(self.env, 'CarbonCopySubscriber')
+        Subscription.find_by_class(self.env, 'AllTicketSubscriber')
+        SubscriptionAttribute.add(self.env, 'bob', 1, 'WatchSubscriber',
+                                  'ticket', ('1',))
+        # the other classes are still cached
+        subs, queries = self._count_queries(
+            Subscription.find_by_class, self.env, 'AllTicketSubscriber')
+        self.assertEqual(['bob'], [s['sid'] for s in subs])
+        self.assertEqual(1, queries)
+        # a new subscription reloads the class
+        self._add('alice', klass='AllTicketSubscriber')
+        subs, queries = self._count_queries(
+            Subscription.find_by_class, self.env, 'AllTicketSubscriber')
+        self.assertEqual(['alice', 'bob'], sorted([s['sid'] for s in subs]))
+        self.assertEqual(3, queries)
+
+    def test_resolver_query_count(self):
+        for i in range(10):
+            self._add('user%d' % i)
+        resolver = SubscriptionResolver(self.env)
+        resolver.subscriptions(self._ticket_event(['user1']))
+        # once warm, only the generation of the cache is checked
+        event = self._ticket_event(['user%d' % i for i in range(10)])
+        subs, queries = self._count_queries(resolver.subscriptions, event)
+        self.assertEqual(1, queries)
+        self.assertTrue('user9' in [s[1] for s in subs])
+
+class SchemaUpgradeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'announcer.*'])
+        self.announcer = AnnouncementSystem(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _indexes(self, table):
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT name FROM sqlite_master "
+                       "WHERE type='index' AND tbl_name=%s", (table,))
+        return set([row[0] for row in cursor if not
+                    row[0].startswith('sqlite_autoindex')])
+
+    def test_upgrade_adds_indexes(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        # tables as created by earlier versions, without indexes
+        cursor.execute("CREATE TABLE subscription (id integer PRIMARY KEY, "
+                       "time integer, changetime integer, class text, "
+                       "sid text, authenticated integer, distributor text, "
+                       "format text, priority integer, adverb text)")
+        cursor.execute("CREATE TABLE subscription_attribute (id integer "
+                       "PRIMARY KEY, sid text, authenticated integer, "
+                       "class text, realm text, target text)")
+        db.commit()
+        self.assertTrue(self.announcer.environment_needs_upgrade(db))
+        self.announcer.upgrade_environment(db)
+        self.assertFalse(self.announcer.environment_needs_upgrade(db))
+        self.assertEqual(AnnouncementSystem.SCHEMA_VERSION,
+                         self.announcer._get_schema_version(db))
+        self.assertEqual(2, len(self._indexes('subscription')))
+        self.assertEqual(2, len(self._indexes('subscription_attribute')))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SubscriptionTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SubscriptionCacheTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SchemaUpgradeTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
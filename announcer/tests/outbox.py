@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import os
+import smtplib
+import tempfile
+import unittest
+
+from trac.core import *
+from trac.test import EnvironmentStub
+
+from announcer.api import AnnouncementSystem
+from announcer.distributors.mail import EmailDistributor, IEmailSender, \
+                                        PartialDeliveryError, \
+                                        SendmailEmailSender, SendmailError, \
+                                        is_permanent_failure
+
+class TestEmailSender(Component):
+    """Fails or refuses recipients as told by `results`."""
+
+    implements(IEmailSender)
+
+    def __init__(self):
+        self.results = []
+
+    def send(self, from_addr, recipients, message):
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+class PermanentFailureTestCase(unittest.TestCase):
+    def test_smtp_replies(self):
+        self.assertTrue(is_permanent_failure(
+            smtplib.SMTPDataError(554, 'Rejected')))
+        self.assertFalse(is_permanent_failure(
+            smtplib.SMTPDataError(451, 'Try again later')))
+        self.assertFalse(is_permanent_failure(
+            smtplib.SMTPServerDisconnected('Gone')))
+
+    def test_refused_recipients(self):
+        self.assertTrue(is_permanent_failure(smtplib.SMTPRecipientsRefused(
+            {'a@example.org': (550, 'Unknown')})))
+        self.assertFalse(is_permanent_failure(smtplib.SMTPRecipientsRefused(
+            {'a@example.org': (550, 'Unknown'),
+             'b@example.org': (452, 'Mailbox full')})))
+
+    def test_sendmail(self):
+        self.assertTrue(is_permanent_failure(SendmailError(67, 'No user')))
+        self.assertFalse(is_permanent_failure(SendmailError(75, 'Temp')))
+        self.assertFalse(is_permanent_failure(SendmailError(None, 'Missing')))
+        self.assertFalse(is_permanent_failure(IOError('Broken pipe')))
+
+class OutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'announcer.*'])
+        self.env.config.set('announcer', 'email_sender', 'TestEmailSender')
+        self.env.config.set('announcer', 'outbox_max_attempts', '3')
+        AnnouncementSystem(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.distributor = EmailDistributor(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _insert(self, recipients, attempts=0):
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO announcement_outbox
+                            (time, next_attempt, attempts, state,
+                             from_addr, recipients, message)
+                     VALUES (0, 0, %s, 'queued', 'trac@example.org', %s,
+                             'Subject: Test\n\nBody')
+            """, (attempts, '\n'.join(recipients)))
+
+    def _queue(self, recipients, attempts=0):
+        self._insert(recipients, attempts)
+        (row,) = self.distributor._claim_outbox()
+        return row
+
+    def _send(self, row, *results):
+        self.distributor.email_sender.results.extend(results)
+        self.distributor._send_outbox_message(*row)
+
+    def _rows(self, table, columns):
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT %s FROM %s ORDER BY id" % (columns, table))
+        return cursor.fetchall()
+
+    def test_retry_delay(self):
+        self.env.config.set('announcer', 'outbox_retry_interval', '100')
+        self.env.config.set('announcer', 'outbox_max_retry_interval', '1000')
+        for attempts, low, high in ((1, 50, 100), (2, 100, 200),
+                                    (3, 200, 400), (10, 500, 1000)):
+            for i in range(20):
+                delay = self.distributor._retry_delay(attempts)
+                self.assertTrue(low <= delay <= high, (attempts, delay))
+
+    def test_transient_failure_is_retried(self):
+        self._send(self._queue(['a@example.org']),
+                   smtplib.SMTPServerDisconnected('Gone'))
+        ((attempts, state, owner),) = self._rows('announcement_outbox',
+                                                 'attempts, state, owner')
+        self.assertEqual((1, 'queued', None), (attempts, state, owner))
+        self.assertEqual([], self._rows('announcement_deadletter', 'id'))
+
+    def test_permanent_failure_is_buried(self):
+        self._send(self._queue(['a@example.org']),
+                   smtplib.SMTPDataError(554, 'Rejected'))
+        self.assertEqual([], self._rows('announcement_outbox', 'id'))
+        ((attempts, recipients),) = self._rows('announcement_deadletter',
+                                               'attempts, recipients')
+        self.assertEqual((1, 'a@example.org'), (attempts, recipients))
+
+    def test_buried_after_max_attempts(self):
+        self._send(self._queue(['a@example.org'], attempts=2),
+                   smtplib.SMTPServerDisconnected('Gone'))
+        self.assertEqual([], self._rows('announcement_outbox', 'id'))
+        self.assertEqual([(3,)], self._rows('announcement_deadletter',
+                                            'attempts'))
+
+    def test_refused_recipients(self):
+        self._send(self._queue(['a@example.org', 'b@example.org',
+                                'c@example.org']),
+                   {'a@example.org': (550, 'Unknown user'),
+                    'b@example.org': (452, 'Mailbox full')})
+        # the temporarily refused recipient is tried again
+        self.assertEqual([(1, 'b@example.org')],
+                         self._rows('announcement_outbox',
+                                    'attempts, recipients'))
+        self.assertEqual([('a@example.org', '550 Unknown user')],
+                         self._rows('announcement_deadletter',
+                                    'recipients, error'))
+
+    def test_all_recipients_refused(self):
+        self._send(self._queue(['a@example.org', 'b@example.org']),
+                   smtplib.SMTPRecipientsRefused(
+                       {'a@example.org': (550, 'Unknown user'),
+                        'b@example.org': (550, 'Unknown user')}))
+        self.assertEqual([], self._rows('announcement_outbox', 'id'))
+        self.assertEqual([('a@example.org',), ('b@example.org',)],
+                         self._rows('announcement_deadletter', 'recipients'))
+
+    def _partial(self, attempts, error):
+        self._send(self._queue(['a@example.org', 'b@example.org',
+                                'c@example.org', 'd@example.org'],
+                               attempts),
+                   PartialDeliveryError(error, ['a@example.org'],
+                                        {'b@example.org': (550, 'Unknown')}))
+
+    def test_partial_delivery_is_retried(self):
+        self._partial(0, smtplib.SMTPDataError(452, 'Insufficient storage'))
+        # only the recipients that didn't get the message are left
+        self.assertEqual([(1, 'c@example.org\nd@example.org')],
+                         self._rows('announcement_outbox',
+                                    'attempts, recipients'))
+        self.assertEqual([('b@example.org', '550 Unknown')],
+                         self._rows('announcement_deadletter',
+                                    'recipients, error'))
+
+    def test_partial_delivery_permanent_failure(self):
+        self._partial(0, smtplib.SMTPDataError(554, 'Rejected'))
+        self.assertEqual([], self._rows('announcement_outbox', 'id'))
+        self.assertEqual(['b@example.org', 'c@example.org', 'd@example.org'],
+                         [r for r, in self._rows('announcement_deadletter',
+                                                 'recipients')])
+
+    def test_partial_delivery_after_max_attempts(self):
+        self._partial(2, smtplib.SMTPServerDisconnected('Gone'))
+        self.assertEqual([], self._rows('announcement_outbox', 'id'))
+        self.assertEqual([('b@example.org', 3), ('c@example.org', 3),
+                          ('d@example.org', 3)],
+                         self._rows('announcement_deadletter',
+                                    'recipients, attempts'))
+
+    def test_batch_continues_after_failure(self):
+        self._insert(['a@example.org'])
+        self._insert(['b@example.org'])
+        self._insert(['c@example.org'])
+        self.distributor.email_sender.results.extend([
+            smtplib.SMTPDataError(554, 'Rejected'),
+            smtplib.SMTPServerDisconnected('Gone'), {}])
+        self.distributor._send_outbox_batch(self.distributor._claim_outbox())
+        self.assertEqual([(1, 'b@example.org')],
+                         self._rows('announcement_outbox',
+                                    'attempts, recipients'))
+        self.assertEqual([('a@example.org',)],
+                         self._rows('announcement_deadletter', 'recipients'))
+
+class SendmailTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'announcer.*'])
+        self.sender = SendmailEmailSender(self.env)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _sendmail(self, script):
+        f = open(self.path, 'w')
+        f.write('#!/bin/sh\ncat >/dev/null\n' + script)
+        f.close()
+        os.chmod(self.path, 0700)
+        self.env.config.set('sendmail', 'sendmail_path', self.path)
+        self.sender.send('trac@example.org', ['a@example.org'], 'Body')
+
+    def test_warning(self):
+        self._sendmail('echo warning >&2\n')
+
+    def test_failure(self):
+        try:
+            self._sendmail('exit 67\n')
+            self.fail('SendmailError not raised')
+        except SendmailError, e:
+            self.assertEqual(67, e.returncode)
+
+    def test_missing_program(self):
+        self.env.config.set('sendmail', 'sendmail_path', self.path + '.x')
+        try:
+            self.sender.send('trac@example.org', ['a@example.org'], 'Body')
+            self.fail('SendmailError not raised')
+        except SendmailError, e:
+            self.assertFalse(is_permanent_failure(e))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(PermanentFailureTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(OutboxTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SendmailTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
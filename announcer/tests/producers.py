@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+from datetime import datetime
+
+from trac.attachment import Attachment
+from trac.test import EnvironmentStub
+from trac.ticket.model import Ticket
+from trac.util.datefmt import utc
+from trac.wiki.model import WikiPage
+
+from announcer.api import AnnouncementDigestEvent, AnnouncementSystem
+from announcer.api import deserialize_events, serialize_events
+from announcer.producers import TicketChangeEvent, WikiChangeEvent
+
+class EventStateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _roundtrip(self, event):
+        (restored,) = deserialize_events(self.env, serialize_events([event]))
+        self.assertEqual(event.__class__, restored.__class__)
+        return restored
+
+    def _attach(self, realm, id):
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO attachment (type, id, filename, size, time,
+                                        description, author, ipnr)
+                     VALUES (%s, %s, 'file.txt', 4, 0, '', 'joe', '')
+            """, (realm, str(id)))
+        return Attachment(self.env, realm, id, 'file.txt')
+
+    def test_ticket_change_event(self):
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'Test'
+        ticket['reporter'] = 'joe'
+        ticket.insert()
+        event = TicketChangeEvent('ticket', 'changed', ticket,
+                                  'A comment', 'joe', {'summary': 'Old'},
+                                  self._attach('ticket', ticket.id))
+        restored = self._roundtrip(event)
+        self.assertEqual(ticket.id, restored.target.id)
+        self.assertEqual('Test', restored.target['summary'])
+        self.assertEqual(ticket.time_created, restored.target.time_created)
+        self.assertEqual('A comment', restored.comment)
+        self.assertEqual('joe', restored.author)
+        self.assertEqual({'summary': 'Old'}, restored.changes)
+        self.assertEqual('file.txt', restored.attachment.filename)
+
+    def test_wiki_change_event(self):
+        page = WikiPage(self.env)
+        page.name = 'TestPage'
+        page.text = 'Text'
+        page.save('joe', 'A comment', '127.0.0.1')
+        when = datetime(2010, 5, 1, 12, 30, tzinfo=utc)
+        event = WikiChangeEvent('wiki', 'changed', page, 'A comment', 'joe',
+                                1, when, '127.0.0.1',
+                                self._attach('wiki', 'TestPage'))
+        restored = self._roundtrip(event)
+        self.assertEqual('TestPage', restored.target.name)
+        self.assertEqual(1, restored.target.version)
+        self.assertEqual(when, restored.timestamp)
+        self.assertEqual('A comment', restored.comment)
+        self.assertEqual('127.0.0.1', restored.remote_addr)
+        self.assertEqual('file.txt', restored.attachment.filename)
+
+    def test_wiki_event_without_timestamp(self):
+        page = WikiPage(self.env, 'WikiStart')
+        restored = self._roundtrip(WikiChangeEvent('wiki', 'deleted', page))
+        self.assertEqual(None, restored.timestamp)
+        self.assertEqual(None, restored.attachment)
+
+    def test_digest_event(self):
+        page = WikiPage(self.env, 'WikiStart')
+        when = datetime(2010, 5, 1, tzinfo=utc)
+        event = AnnouncementDigestEvent([
+            WikiChangeEvent('wiki', 'changed', page, timestamp=when)])
+        restored = self._roundtrip(event)
+        self.assertEqual(when, restored.events[0].timestamp)
+
+class QueuedEventTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'announcer.*'])
+        self.announcer = AnnouncementSystem(self.env)
+        self.announcer.upgrade_environment(self.env.get_db_cnx())
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _tickets(self, *summaries):
+        tickets = []
+        for summary in summaries:
+            ticket = Ticket(self.env)
+            ticket['summary'] = summary
+            ticket['reporter'] = 'joe'
+            ticket.insert()
+            tickets.append(ticket)
+        return tickets
+
+    def _queue(self, events):
+        data = serialize_events(events)
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO announcement_queue (time, data)
+                     VALUES (0, %s)
+            """, (data,))
+
+    def test_dispatch_order(self):
+        tickets = self._tickets(*['Ticket %d' % i for i in range(5)])
+        for ticket in tickets:
+            self._queue([TicketChangeEvent('ticket', 'created', ticket)])
+        sent = []
+        self.announcer._real_send_batch = sent.extend
+        self.announcer._dispatch_queued()
+        self.assertEqual([t.id for t in tickets],
+                         [e.target.id for e in sent])
+
+    def test_consolidated_order(self):
+        self.env.config.set('announcer', 'consolidate_batches', 'true')
+        tickets = self._tickets(*['Ticket %d' % i for i in range(5)])
+        # every ticket has another recipient, so each gets its own message
+        self.announcer._get_subscriptions = lambda evt: [('email',
+            'user%s' % evt.target.id, 1, None, 'text/plain')]
+        sent = []
+        self.announcer._distribute = lambda evt, subs: sent.append(evt)
+        self.announcer._real_send_batch([
+            TicketChangeEvent('ticket', 'created', t) for t in tickets])
+        self.assertEqual([t.id for t in tickets],
+                         [e.target.id for e in sent])
+
+    def test_deleted_ticket(self):
+        """The events of a ticket deleted before they are dispatched are
+        skipped, the other events queued with them are still sent."""
+        tickets = self._tickets('One', 'Two')
+        self._queue([TicketChangeEvent('ticket', 'created', t)
+                     for t in tickets])
+        tickets[0].delete()
+        sent = []
+        self.announcer._real_send_batch = sent.extend
+        self.assertTrue(self.announcer._dispatch_next())
+        self.assertEqual([tickets[1].id], [e.target.id for e in sent])
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT COUNT(*) FROM announcement_queue")
+        self.assertEqual(0, cursor.fetchone()[0])
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(EventStateTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(QueuedEventTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import smtplib
+import socket
+import time
+import unittest
+
+from trac.test import EnvironmentStub
+
+from announcer.distributors.mail import PartialDeliveryError, \
+                                        SmtpEmailSender
+
+class FakeSMTP(object):
+    """Stands in for `smtplib.SMTP`, recording the commands it gets.
+
+    Recipients listed in `refused` are refused with the given code, and the
+    replies to DATA are taken from `data_replies`, raising the exceptions
+    found there.
+    """
+
+    def __init__(self, extensions=(), refused=None, data_replies=None):
+        self.extensions = extensions
+        self.refused = refused or {}
+        self.data_replies = data_replies or []
+        self.commands = []
+        self.writes = 0
+        self.replies = []
+        self.rset_error = None
+        self.closed = False
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return name.lower() in self.extensions
+
+    def putcmd(self, command):
+        self.writes += 1
+        self._command(command)
+
+    def send(self, data):
+        self.writes += 1
+        for command in data.split('\r\n')[:-1]:
+            self._command(command)
+
+    def _command(self, command):
+        self.commands.append(command)
+        code = 250
+        if command.startswith('RCPT TO:'):
+            code = self.refused.get(command[9:-1], 250)
+        self.replies.append((code, 'OK'))
+
+    def getreply(self):
+        return self.replies.pop(0)
+
+    def data(self, message):
+        self.commands.append('DATA')
+        if self.data_replies:
+            reply = self.data_replies.pop(0)
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+        return (250, 'OK')
+
+    def rset(self):
+        self.commands.append('RSET')
+        if self.rset_error:
+            raise self.rset_error
+        return (250, 'OK')
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+class SmtpTestBase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'announcer.*'])
+        self.sender = SmtpEmailSender(self.env)
+        self.sessions = []
+        self.sender._connect = self._connect
+
+    def _connect(self):
+        smtp = FakeSMTP(**getattr(self, 'smtp_args', {}))
+        self.sessions.append(smtp)
+        return smtp
+
+class ConnectionPoolTestCase(SmtpTestBase):
+    def test_reuse(self):
+        self.sender.send('trac@example.org', ['a@example.org'], 'Body')
+        self.sender.send('trac@example.org', ['b@example.org'], 'Body')
+        self.assertEqual(1, len(self.sessions))
+        # the pooled connection is checked before it is used again
+        self.assertEqual('RSET', self.sessions[0].commands[3])
+        self.assertFalse(self.sessions[0].closed)
+
+    def test_failed_rset(self):
+        self.sender.send('trac@example.org', ['a@example.org'], 'Body')
+        self.sessions[0].rset_error = socket.error('Connection reset')
+        self.sender.send('trac@example.org', ['b@example.org'], 'Body')
+        self.assertEqual(2, len(self.sessions))
+        self.assertTrue(self.sessions[0].closed)
+        self.assertEqual(['MAIL FROM:<trac@example.org>',
+                          'RCPT TO:<b@example.org>', 'DATA'],
+                         self.sessions[1].commands)
+
+    def test_idle_timeout(self):
+        self.env.config.set('smtp', 'idle_timeout', '30')
+        self.sender.send('trac@example.org', ['a@example.org'], 'Body')
+        self.sender._pool.values()[0][0].last_used = time.time() - 60
+        self.sender.send('trac@example.org', ['b@example.org'], 'Body')
+        self.assertEqual(2, len(self.sessions))
+        self.assertTrue(self.sessions[0].closed)
+        self.assertFalse('RSET' in self.sessions[0].commands)
+
+    def test_reaper(self):
+        self.env.config.set('smtp', 'idle_timeout', '0')
+        self.sender.send('trac@example.org', ['a@example.org'], 'Body')
+        self.sender._pool.values()[0][0].last_used = time.time() - 1
+        self.sender._reap()
+        self.assertTrue(self.sessions[0].closed)
+        self.assertEqual({}, self.sender._pool)
+
+class TransactionTestCase(SmtpTestBase):
+    recipients = ['a@example.org', 'b@example.org', 'c@example.org',
+                  'd@example.org']
+
+    def setUp(self):
+        SmtpTestBase.setUp(self)
+        self.env.config.set('smtp', 'max_recipients', '2')
+
+    def _send(self):
+        return self.sender.send('trac@example.org', self.recipients, 'Body')
+
+    def test_pipelining(self):
+        self.smtp_args = {'extensions': ('pipelining',)}
+        self.assertEqual({}, self._send())
+        (smtp,) = self.sessions
+        # MAIL and both RCPT commands of a transaction are sent at once
+        self.assertEqual(2, smtp.writes)
+        self.assertEqual(['MAIL FROM:<trac@example.org>',
+                          'RCPT TO:<a@example.org>',
+                          'RCPT TO:<b@example.org>', 'DATA',
+                          'MAIL FROM:<trac@example.org>',
+                          'RCPT TO:<c@example.org>',
+                          'RCPT TO:<d@example.org>', 'DATA'], smtp.commands)
+
+    def test_without_pipelining(self):
+        self.assertEqual({}, self._send())
+        self.assertEqual(6, self.sessions[0].writes)
+
+    def test_refused_recipients(self):
+        self.smtp_args = {'refused': {'c@example.org': 550,
+                                      'd@example.org': 550}}
+        self.assertEqual(['c@example.org', 'd@example.org'],
+                         sorted(self._send()))
+        # no DATA for a transaction without recipients
+        self.assertEqual(['RCPT TO:<d@example.org>', 'RSET'],
+                         self.sessions[0].commands[-2:])
+
+    def test_failure_in_first_transaction(self):
+        self.smtp_args = {'data_replies': [(451, 'Try again later')]}
+        self.assertRaises(smtplib.SMTPDataError, self._send)
+
+    def test_failure_after_delivery(self):
+        self.smtp_args = {'refused': {'b@example.org': 550,
+                                      'c@example.org': 550},
+                          'data_replies': [(250, 'OK'),
+                                           (452, 'Insufficient storage')]}
+        try:
+            self._send()
+            self.fail('PartialDeliveryError not raised')
+        except PartialDeliveryError, e:
+            self.assertEqual(['a@example.org'], e.delivered)
+            self.assertEqual(['b@example.org', 'c@example.org'],
+                             sorted(e.refused))
+            self.assertEqual(452, e.error.smtp_code)
+        # the failed transaction was ended, so the session can be reused
+        self.assertEqual('RSET', self.sessions[0].commands[-1])
+        self.assertEqual(1, len(self.sender._pool.values()[0]))
+
+    def test_lost_connection_after_delivery(self):
+        self.smtp_args = {'data_replies': [
+            (250, 'OK'), smtplib.SMTPServerDisconnected('Gone')]}
+        try:
+            self._send()
+            self.fail('PartialDeliveryError not raised')
+        except PartialDeliveryError, e:
+            self.assertEqual(['a@example.org', 'b@example.org'],
+                             e.delivered)
+        self.assertTrue(self.sessions[0].closed)
+
+class BatchTestCase(SmtpTestBase):
+    def _send_batch(self, count):
+        return self.sender.send_batch([
+            ('trac@example.org', ['%s@example.org' % i], 'Body')
+            for i in range(count)])
+
+    def test_failed_message(self):
+        self.smtp_args = {'data_replies': [(250, 'OK'), (554, 'Rejected'),
+                                           (250, 'OK')]}
+        results = self._send_batch(3)
+        self.assertEqual({}, results[0])
+        self.assertTrue(isinstance(results[1], smtplib.SMTPDataError))
+        self.assertEqual({}, results[2])
+        # the session is reset and used for the following message
+        self.assertEqual(1, len(self.sessions))
+        self.assertEqual(['DATA', 'RSET', 'MAIL FROM:<trac@example.org>'],
+                         self.sessions[0].commands[5:8])
+
+    def test_lost_connection(self):
+        self.smtp_args = {'data_replies': [
+            smtplib.SMTPServerDisconnected('Gone')]}
+        results = self._send_batch(2)
+        self.assertTrue(isinstance(results[0],
+                                   smtplib.SMTPServerDisconnected))
+        self.assertEqual({}, results[1])
+        self.assertEqual(2, len(self.sessions))
+        self.assertTrue(self.sessions[0].closed)
+
+    def test_unreachable_server(self):
+        def connect():
+            self.sessions.append(None)
+            raise socket.error('Connection refused')
+        self.sender._connect = connect
+        results = self._send_batch(3)
+        self.assertEqual(1, len(self.sessions))
+        self.assertEqual(3, len([r for r in results
+                                 if isinstance(r, socket.error)]))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ConnectionPoolTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(TransactionTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(BatchTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+from trac.test import Mock, MockPerm
+from trac.web.api import RequestDone
+from trac.web.href import Href
+from trac.web.session import DetachedSession
+from trac.wiki.model import WikiPage
+
+from announcer.model import *
+from announcer.producers import WikiChangeEvent
+from announcer.subscribers import GeneralWikiSubscriber, WatchSubscriber, \
+                                  WikiPatternIndex
+from announcer.tests.model import SubscriptionTestBase
+
+def _attributes(*patterns):
+    return [{'sid': sid, 'authenticated': 1, 'target': target}
+            for sid, target in patterns]
+
+class WikiPatternIndexTestCase(unittest.TestCase):
+    def test_prefixes(self):
+        index = WikiPatternIndex(_attributes(('joe', 'Wiki*'),
+                                             ('ann', 'WikiStart Sandbox')))
+        self.assertEqual([], index.combined)
+        self.assertEqual(set([('joe', 1), ('ann', 1)]),
+                         index.match('WikiStart'))
+        self.assertEqual(set([('joe', 1)]), index.match('WikiFormatting'))
+        self.assertEqual(set(), index.match('Start'))
+
+    def test_patterns(self):
+        index = WikiPatternIndex(_attributes(('joe', 'Wiki*Start'),
+                                             ('ann', 'W[a-z]*'),
+                                             ('bob', 'Wiki*Start'),
+                                             ('tom', 'Sand(box|pit)')))
+        self.assertEqual(1, len(index.combined))
+        self.assertEqual(set([('joe', 1), ('ann', 1), ('bob', 1)]),
+                         index.match('WikiStart'))
+        self.assertEqual(set([('ann', 1)]), index.match('WikiFormatting'))
+        self.assertEqual(set([('tom', 1)]), index.match('Sandpit'))
+
+    def test_backreference(self):
+        index = WikiPatternIndex(_attributes(('joe', '(Ab)*\\1'),
+                                             ('ann', '(A)b.*')))
+        self.assertEqual(1, len(index.patterns))
+        self.assertEqual(set([('joe', 1), ('ann', 1)]),
+                         index.match('AbAb'))
+
+    def test_many_patterns(self):
+        index = WikiPatternIndex(_attributes(*[('user%d' % i, 'P[a]ge%d$' % i)
+                                               for i in range(250)]))
+        self.assertEqual(3, len(index.combined))
+        self.assertEqual(set([('user5', 1)]), index.match('Page5'))
+        self.assertEqual(set([('user249', 1)]), index.match('Page249'))
+
+    def test_invalid_pattern(self):
+        index = WikiPatternIndex(_attributes(('joe', 'Wiki[*'),
+                                             ('ann', 'Wiki.*')))
+        self.assertEqual(set([('ann', 1)]), index.match('WikiStart'))
+
+class GeneralWikiSubscriberTestCase(SubscriptionTestBase):
+    def setUp(self):
+        SubscriptionTestBase.setUp(self)
+        self.subscriber = GeneralWikiSubscriber(self.env)
+        self._add('joe', klass='GeneralWikiSubscriber')
+        self._add('ann', klass='GeneralWikiSubscriber')
+        SubscriptionAttribute.add(self.env, 'joe', 1, 'GeneralWikiSubscriber',
+                                  'wiki', ('Wiki.*',))
+
+    def _event(self, name):
+        return WikiChangeEvent('wiki', 'changed', WikiPage(self.env, name))
+
+    def _matches(self, event):
+        return sorted([s[2] for s in self.subscriber.matches(event)])
+
+    def _match(self, name):
+        return self._matches(self._event(name))
+
+    def test_index_is_reused(self):
+        self.assertEqual(['joe'], self._match('WikiStart'))
+        index = self.subscriber._get_index()
+        result, queries = self._count_queries(self._matches,
+                                              self._event('WikiFormatting'))
+        self.assertEqual(['joe'], result)
+        self.assertTrue(index is self.subscriber._get_index())
+        # the generation and the subscriptions of the matching users
+        self.assertEqual(2, queries)
+
+    def test_index_is_rebuilt_after_changes(self):
+        self.assertEqual([], self._match('Sandbox'))
+        SubscriptionAttribute.add(self.env, 'ann', 1, 'GeneralWikiSubscriber',
+                                  'wiki', ('Sand.*',))
+        self.assertEqual(['ann'], self._match('Sandbox'))
+
+    def test_index_is_rebuilt_after_changes_elsewhere(self):
+        self.assertEqual(['joe'], self._match('WikiStart'))
+        # as another process would change the patterns
+        @self.env.with_transaction()
+        def do_update(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE subscription_attribute SET target='Sand.*'
+            """)
+            cursor.execute("""
+                UPDATE system SET value='other'
+                 WHERE name='announcer_subscription_generation:'
+                            || 'GeneralWikiSubscriber'
+            """)
+        self.assertEqual([], self._match('WikiStart'))
+        self.assertEqual(['joe'], self._match('Sandbox'))
+
+class WatchSubscriberTestCase(SubscriptionTestBase):
+    def setUp(self):
+        SubscriptionTestBase.setUp(self)
+        self.subscriber = WatchSubscriber(self.env)
+
+    def _request(self, path_info, **args):
+        def redirect(url):
+            raise RequestDone
+        return Mock(path_info=path_info, args=args, perm=MockPerm(),
+                    href=Href('/trac'), redirect=redirect, chrome={},
+                    session=DetachedSession(self.env, 'joe'))
+
+    def _watch(self, action=None):
+        args = action and {'action': action} or {}
+        self.assertRaises(RequestDone, self.subscriber.process_request,
+                          self._request('/watch/ticket/1', **args))
+
+    def _watches(self):
+        return self.subscriber._get_watches('joe', 1)
+
+    def test_watches_are_cached(self):
+        self.assertEqual(frozenset(), self._watches())
+        watches, queries = self._count_queries(self._watches)
+        # only the generation is read
+        self.assertEqual(1, queries)
+
+    def test_changes_elsewhere(self):
+        self.assertEqual(frozenset(), self._watches())
+        # as another process would watch the ticket
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO subscription_attribute
+                            (sid, authenticated, class, realm, target)
+                     VALUES ('joe', 1, 'WatchSubscriber', 'ticket', '1')
+            """)
+            cursor.execute("""
+                INSERT INTO system (name, value)
+                     VALUES ('announcer_subscription_generation:'
+                             || 'WatchSubscriber', 'other')
+            """)
+        self.assertEqual(frozenset([('ticket', u'1')]), self._watches())
+
+    def test_toggle(self):
+        self._watch()
+        self.assertEqual(frozenset([('ticket', u'1')]), self._watches())
+        self._watch()
+        self.assertEqual(frozenset(), self._watches())
+
+    def test_explicit_action(self):
+        self._watch('watch')
+        self._watch('watch')
+        self.assertEqual(1, len(SubscriptionAttribute.find_by_sid_and_class(
+                self.env, 'joe', 1, 'WatchSubscriber')))
+        self._watch('unwatch')
+        self._watch('unwatch')
+        self.assertEqual(frozenset(), self._watches())
+
+    def test_links(self):
+        req = self._request('/ticket/1')
+        self.subscriber.render_watcher(req)
+        self.subscriber.set_watch('joe', 1, 'ticket', '1')
+        self.subscriber.render_watcher(req)
+        self.assertEqual(['/trac/watch/ticket/1?action=watch',
+                          '/trac/watch/ticket/1?action=unwatch'],
+                         [link.attrib.get('href')
+                          for link in req.chrome['ctxtnav']])
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(WikiPatternIndexTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(GeneralWikiSubscriberTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(WatchSubscriberTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -34,6 +34,8 @@ try:
 except:
     from email.Header import Header
 
+from genshi.template import NewTextTemplate
+
 from trac.util.text import to_unicode
 try:
     # Method only available in Trac 0.11.3 or higher.
@@ -56,6 +58,22 @@ except:
 
 MAXHEADERLEN = 76
 
+_subject_templates = {}
+
+def subject_template(source):
+    """Returns the compiled text template for a subject format string.
+
+    Templates are cached by their source, so changing the option the
+    format is read from takes effect right away.
+    """
+    template = _subject_templates.get(source)
+    if template is None:
+        if len(_subject_templates) > 100:
+            _subject_templates.clear()
+        template = NewTextTemplate(source.encode('utf8'))
+        _subject_templates[source] = template
+    return template
+
 def next_decorator(event, message, decorates):
     """
     Helper method for IAnnouncerEmailDecorators.  Call the next decorator
@@ -28,8 +28,11 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
-import re
+import Queue
+import os
+import threading
 
+from email.utils import parseaddr
 from time import time
 
 from trac.core import *
@@ -58,12 +61,71 @@ class CryptoTxt:
                               "Please check and correct your installation."))
         try:
             self.gpg = GPG(gpgbinary=self.gpg_binary, gnupghome=self.gpg_home)
-            # get list of available public keys once for later use
-            self.pubkeys = self.gpg.list_keys() # same as gpg.list_keys(False)
         except ValueError:
             raise TracError(_("Missing the crypto binary. " \
                               "Please check and set full path " \
                               "with option 'gpg_binary'."))
+        self._lock = threading.Lock()
+        self._keyring_state = None
+        self._refresh()
+
+    def _keyring_files(self):
+        home = self.gpg_home or os.environ.get('GNUPGHOME') or \
+               os.path.expanduser('~/.gnupg')
+        return [os.path.join(home, name) for name in ('pubring.gpg',
+                'pubring.kbx', 'secring.gpg', 'private-keys-v1.d')]
+
+    def _get_keyring_state(self):
+        state = []
+        for path in self._keyring_files():
+            try:
+                st = os.stat(path)
+                state.append((st.st_mtime, st.st_size))
+            except OSError:
+                state.append(None)
+        return tuple(state)
+
+    def _refresh(self):
+        """Loads the keys again if the keyring changed since they were
+        last loaded.  Instances can therefore be kept around and shared.
+        """
+        state = self._get_keyring_state()
+        if state == self._keyring_state:
+            return
+        self._lock.acquire()
+        try:
+            if state != self._keyring_state:
+                self._load_pubkeys()
+                self._load_privkeys()
+                self._keyring_state = state
+        finally:
+            self._lock.release()
+
+    def _load_pubkeys(self):
+        # same as gpg.list_keys(False)
+        self.pubkeys = self.gpg.list_keys()
+        # map the addresses in the key UIDs to (key ID, expiration) tuples
+        index = {}
+        for k in self.pubkeys:
+            if not k.has_key('fingerprint'):
+                continue
+            expires = k.get('expires') and float(k['expires']) or None
+            entry = (k['fingerprint'][-16:], expires)
+            for uid in k.get('uids', []):
+                addr = parseaddr(uid)[1].lower()
+                if not addr:
+                    continue
+                entries = index.setdefault(addr, [])
+                if entry not in entries:
+                    entries.append(entry)
+        self._pubkey_index = index
+
+    def _load_privkeys(self):
+        # read private keys from keyring
+        privkeys = self.gpg.list_keys(True) # True => private keys
+        self._privkeys = [(k['fingerprint'],
+                           k.get('expires') and float(k['expires']) or None)
+                          for k in privkeys if k.has_key('fingerprint')]
 
 
     def sign(self, content, private_key=None):
@@ -86,42 +148,70 @@ class CryptoTxt:
         return str(cipher)
 
 
+    def encrypt_many(self, jobs, sign=False, private_key=None, workers=4):
+        """Encrypts, and optionally signs, a list of (content, pubkeys)
+        tuples with up to `workers` gpg processes running at once.
+
+        Returns the ciphertexts in the order of `jobs`.
+        """
+        results = [None] * len(jobs)
+        errors = []
+        queue = Queue.Queue()
+        for i, job in enumerate(jobs):
+            queue.put((i, job))
+
+        def work():
+            while True:
+                try:
+                    i, (content, pubkeys) = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    if sign:
+                        results[i] = self.sign_encrypt(content, pubkeys,
+                                                       private_key)
+                    else:
+                        results[i] = self.encrypt(content, pubkeys)
+                except Exception, e:
+                    errors.append(e)
+
+        # the calling thread is one of the workers
+        threads = [threading.Thread(target=work)
+                   for i in range(min(workers, len(jobs)) - 1)]
+        for thread in threads:
+            thread.start()
+        work()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
     def get_pubkey_ids(self, addr):
         """Find public key with UID matching address to encrypt to."""
 
-        pubkey_ids = []
-        if len(self.pubkeys) > 0 and self.pubkeys[-1].has_key('uids') and \
-                self.pubkeys[-1].has_key('fingerprint'):
-            # compile pattern before use for better performance
-            RCPT_RE = re.compile(addr)
-            for k in self.pubkeys:
-                for uid in k['uids']:
-                    match = RCPT_RE.search(uid)
-                    if match is not None:
-                        # check for key expiration
-                        if k['expires'] == '':
-                            pubkey_ids.append(k['fingerprint'][-16:])
-                        elif (time()+60) < float(k['expires']):
-                            pubkey_ids.append(k['fingerprint'][-16:])
-                        break
-        return pubkey_ids
+        self._refresh()
+        # skip keys expiring within the next minute
+        now = time() + 60
+        return [key_id for key_id, expires
+                in self._pubkey_index.get(addr.lower(), [])
+                if expires is None or now < expires]
 
     def _get_private_key(self, privkey=None):
         """Find private (secret) key to sign with."""
 
-        # read private keys from keyring
-        privkeys = self.gpg.list_keys(True) # True => private keys
-        if len(privkeys) > 0 and privkeys[-1].has_key('fingerprint'):
-            fingerprints = []
-            for k in privkeys:
-                fingerprints.append(k['fingerprint'])
-        else:
-            # no private key in keyring
+        # the keys are only read again from the keyring when it changed
+        self._refresh()
+        # skip keys expiring within the next minute
+        now = time() + 60
+        fingerprints = [fp for fp, expires in self._privkeys
+                        if expires is None or now < expires]
+        if not fingerprints:
+            # no usable private key in keyring
             return None
 
         if privkey:
             # check for existence of private key received as argument
-            # DEVEL: check for expiration as well
             if len(privkey) > 7 and len(privkey) <= 40:
                 for fp in fingerprints:
                     if fp.endswith(privkey):
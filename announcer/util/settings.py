@@ -30,6 +30,8 @@
 # ----------------------------------------------------------------------------
 import pickle
 
+from trac.util.compat import set
+
 from announcer.api import istrue
 
 def encode(*args):
@@ -188,3 +190,58 @@ class BoolSubscriptionSetting(object):
     def _attr_name(self):
         return "sub_%s"%(self.name)
 
+
+
+class SessionAttributes(object):
+    """Session attributes of a group of users, loaded with one query per
+    batch of names instead of one query per user and name.
+    """
+
+    # Maximum number of sids passed to a single query.
+    max_sids = 400
+
+    def __init__(self, env, sids, names=(), db=None):
+        self.env = env
+        self.sids = sorted(set(sids))
+        self.names = set()
+        self.values = {}
+        self.load(names, db)
+
+    def load(self, names, db=None):
+        """Fetches the attributes `names` of all users."""
+        names = list(set(names) - self.names)
+        self._fetch(self.sids, names, db)
+        self.names.update(names)
+
+    def add(self, sids, db=None):
+        """Adds users, fetching the attributes loaded so far for them."""
+        sids = list(set(sids) - set(self.sids))
+        self._fetch(sids, list(self.names), db)
+        self.sids = sorted(self.sids + sids)
+
+    def _fetch(self, sids, names, db=None):
+        if not names or not sids:
+            return
+        if not db:
+            db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        for i in range(0, len(sids), self.max_sids):
+            chunk = sids[i:i + self.max_sids]
+            cursor.execute("""
+                SELECT sid, authenticated, name, value
+                  FROM session_attribute
+                 WHERE name IN (%s)
+                   AND sid IN (%s)
+            """ % (','.join(['%s'] * len(names)),
+                   ','.join(['%s'] * len(chunk))), names + chunk)
+            for sid, authenticated, name, value in cursor:
+                self.values[(sid, authenticated and 1 or 0, name)] = value
+
+    def get(self, sid, authenticated, name, default=None):
+        """Returns the value of attribute `name` of a user, loading the
+        attribute for all users if it hasn't been asked for before.
+        """
+        if name not in self.names:
+            self.load((name,))
+        return self.values.get((sid, authenticated and 1 or 0, name),
+                               default)
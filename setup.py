@@ -90,11 +90,13 @@ setup(
     entry_points = {
         'trac.plugins': [
             'announcer.api = announcer.api',
+            'announcer.delivery = announcer.delivery',
             'announcer.distributors.mail = announcer.distributors.mail',
             'announcer.distributors.xmppd = announcer.distributors.xmppd[xmpp]',
             'announcer.email_decorators = announcer.email_decorators',
             'announcer.filters = announcer.filters',
             'announcer.formatters = announcer.formatters',
+            'announcer.metrics = announcer.metrics',
             'announcer.model = announcer.model',
             'announcer.pref = announcer.pref',
             'announcer.producers = announcer.producers',
@@ -106,6 +108,6 @@ setup(
             'announcer.opt.fullblog.announce = announcer.opt.fullblog.announce[fullblog]',
         ]
     },
-    test_suite = 'announcer.tests',
+    test_suite = 'announcer.tests.suite',
     **extra
 )